@@ -7,113 +7,1071 @@ Tools for loading data from CASU logfiles.
 
 import sys
 import os
-import csv
+import re
+import time
+import argparse
+import itertools
+import multiprocessing
+import gzip
+import struct
+import warnings
+import json
+import shutil
+import bisect
 
+import numpy as np
 import scipy.io as sio
 
-def load_from_csv(filepath):
-    """
-    Load log data from a csv file.
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+import logger
+
+LOG_NAME = re.compile(r'^(\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})-(.+?)(?:\.(\d{4}))?\.(csv|bin)(?:\.gz)?$')
+"""
+CASU log file name: 'YYYY-MM-DD-HH-MM-SS-name[.NNNN].ext[.gz]',
+where NNNN is the segment number of rotated logs.
+"""
+
+def parse_log_name(filepath):
     """
-    data = {}
+    Split a log file name into its parts.
 
+    :return: (start, casu, segment) tuple, where start is the
+             'YYYY-MM-DD-HH-MM-SS' log start time, casu is the
+             (Matlab-compatible) CASU name, and segment is the segment
+             number (None if the log is not segmented).
+    """
     filename = os.path.basename(filepath)
-    casu = ''
+    match = LOG_NAME.match(filename)
+    if match:
+        segment = match.group(3)
+        if segment is not None:
+            segment = int(segment)
+        return (match.group(1), match.group(2).replace('-','_'), segment)
     if len(filename) < 25:
         sys.exit('{0} is an invalid CASU log file name!.'.format(filename))
-    else:
-        casu = filename[20:-4].replace('-','_')
-        data[casu] = {}
+    return (filename[:19], filename[20:-4].replace('-','_'), None)
+
+def casu_name(filepath):
+    """
+    Get the (Matlab-compatible) CASU name from a log file name.
+    """
+    return parse_log_name(filepath)[1]
+
+def is_log_file(filename):
+    """
+    Check if filename is a (possibly segmented or compressed) CASU log file name.
+    """
+    return LOG_NAME.match(filename) is not None or filename[-4:] in ['.csv', '.bin']
+
+def open_log(filepath, mode = 'r'):
+    """
+    Open a plain or gzip-compressed log file.
+    """
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, mode)
+    return open(filepath, mode)
+
+HDF5_CHUNK_ROWS = 4096
+""" Number of rows per chunk of the HDF5 output datasets """
+
+CHUNK_SIZE = 16*1024*1024
+"""
+Approximate number of bytes of a csv logfile parsed at once.
+"""
+
+def values_array(rows):
+    """
+    Convert a list of value rows to a 2D array,
+    unless the rows differ in length.
+    """
+    if rows and len(set([len(row) for row in rows])) == 1:
+        return np.array(rows, dtype=float)
+    return rows
 
-    with open(filepath) as datafile:
-        datareader = csv.reader(datafile,delimiter=';')
-        dataid = None
-        for row in datareader:
-            if len(row) > 2:
+def concat_values(parts):
+    """
+    Concatenate value arrays (or lists of value rows) in order.
+    """
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return []
+    if (all([isinstance(part, np.ndarray) for part in parts]) and
+            len(set([part.shape[1] for part in parts])) == 1):
+        return np.vstack(parts)
+    rows = []
+    for part in parts:
+        rows.extend([list(row) for row in part])
+    return values_array(rows)
+
+def parse_rows(lines):
+    """
+    Parse 'timestamp;value;value;...' lines (logfile rows without the
+    record id).
+
+    If all the lines have the same number of fields, they are parsed
+    in one go; otherwise (or if some of the fields are not numbers)
+    they are parsed line by line, skipping invalid lines.
+
+    :return: (t, values) tuple, where t is the vector of timestamps, and
+             values the 2D array of values (a list of rows if the rows
+             differ in length).
+    """
+    ncols = lines[0].count(';') + 1
+    if len(set([line.count(';') for line in lines])) == 1:
+        try:
+            with warnings.catch_warnings():
+                # Older numpy versions only warn about invalid data
+                warnings.simplefilter('error')
+                flat = np.fromstring(';'.join(lines), dtype=float, sep=';')
+            if flat.size == len(lines)*ncols:
+                flat = flat.reshape((len(lines), ncols))
+                return (flat[:,0].copy(), flat[:,1:].copy())
+        except (ValueError, DeprecationWarning):
+            pass
+
+    t = []
+    rows = []
+    for line in lines:
+        fields = line.split(';')
+        try:
+            ts = float(fields[0]) # timestamp
+            values = [float(x) for x in fields[1:]]
+        except ValueError:
+            # Accelerometers are currently not providing any data
+            # We don't want to bother users with that
+            continue
+        t.append(ts)
+        rows.append(values)
+    return (np.array(t, dtype=float), values_array(rows))
+
+def read_chunks(datafile, end = None):
+    """
+    Read lines from datafile, from its current position up to the byte
+    offset end (or the end of the file), in chunks of about CHUNK_SIZE bytes.
+
+    :return: A generator of line lists.
+    """
+    rest = ''
+    while True:
+        size = CHUNK_SIZE
+        if end is not None:
+            size = min(size, end - datafile.tell())
+        buf = ''
+        if size > 0:
+            buf = datafile.read(size)
+        if not buf:
+            if rest:
+                yield [rest]
+            return
+        lines = (rest + buf).split('\n')
+        rest = lines.pop()
+        if lines:
+            yield lines
+
+def complete_lines_end(filepath, start, end):
+    """
+    Returns the byte offset after the last complete line of filepath
+    between the offsets start and end (start if there is no complete line).
+    """
+    with open(filepath, 'rb') as datafile:
+        pos = end
+        while pos > start:
+            block_start = max(start, pos - 65536)
+            datafile.seek(block_start)
+            i = datafile.read(pos - block_start).rfind('\n')
+            if i >= 0:
+                return block_start + i + 1
+            pos = block_start
+    return start
+
+def iter_csv(filepath, start = 0, end = None, complete = False):
+    """
+    Load log data from a csv file, one chunk at a time.
+
+    The file is read in chunks of about CHUNK_SIZE bytes; the rows of each
+    chunk are grouped by record id, and each group is parsed into arrays
+    at once.
+
+    :param int start: Byte offset to start reading at (must be the start of a line).
+    :param int end: Byte offset to stop reading at (None reads to the end of the file).
+    :param bool complete: The data ends with a complete line, so its final row
+                          is kept even if it has fewer fields than the previous one.
+    :return: A generator of the data in each chunk (see :func:`load`).
+    """
+    casu = casu_name(filepath)
+
+    tails = {}  # Record id -> number of fields in the last parsed row
+    pending = None # The last row read; it may be incomplete
+    with open_log(filepath) as datafile:
+        datafile.seek(start)
+        # The final empty chunk marks the end of the data
+        for lines in itertools.chain(read_chunks(datafile, end), [[]]):
+            groups = {}
+            if pending:
+                groups[pending[0]] = [pending[1]]
+            for line in lines:
+                (dataid, sep, row) = line.rstrip('\r\n').partition(';')
                 # Guard against incomplete rows
                 # (e.g. interrupted program)
-                dataid = row[0].replace('-','_')
-                t_id = 't_' + dataid
+                if ';' not in row:
+                    continue
                 if not dataid:
                     # Empty data ids appear in some datasets
                     # This actually should not happen
-                    # This is a quick fix until we figure out 
+                    # This is a quick fix until we figure out
                     # the real cause of the problem
                     continue
-                if dataid not in data[casu]:
-                    # New row id
-                    data[casu][dataid] = []
-                    data[casu][t_id] = []
-                try:
-                    ts = float(row[1]) # timestamp
-                    data[casu][t_id].append(ts)
-                    data[casu][dataid].append([float(x) for x in row[2:]])
-                except ValueError:
-                    #print('ValueError in row {0}: {1}'.format(datareader.line_num,row))
-                    # Accelerometers are currently not providing any data
-                    # We don't want to bother users with that
-                    pass
-
-        # Check final row (my be incomplete)
-        if dataid:
-            # Some data were present
-            if len(data[casu][dataid]) > 1:
-                # At least two rows were present
-                if not len(data[casu][dataid][-1]) == len(data[casu][dataid][-2]):
+                groups.setdefault(dataid, []).append(row)
+                pending = (dataid, row)
+
+            if lines:
+                # Hold back the last row until we know whether it is the final one
+                if pending:
+                    groups[pending[0]].pop()
+            elif pending and not complete:
+                # Check final row (may be incomplete)
+                (dataid, row) = pending
+                if dataid in tails and tails[dataid] != row.count(';'):
                     # Remove last row if it's incomplete
-                    data[casu][dataid] = data[casu][dataid][:-1]
+                    groups[dataid].pop()
+
+            data = {casu: {}}
+            for rawid in groups:
+                if groups[rawid]:
+                    (t, values) = parse_rows(groups[rawid])
+                    tails[rawid] = groups[rawid][-1].count(';')
+                else:
+                    (t, values) = (np.array([]), [])
+                dataid = rawid.replace('-','_')
+                if dataid in data[casu]:
+                    # Different raw record ids may map to the same name
+                    t = np.concatenate([data[casu]['t_' + dataid], t])
+                    values = concat_values([data[casu][dataid], values])
+                data[casu]['t_' + dataid] = t
+                data[casu][dataid] = values
+            if data[casu]:
+                yield data
+
+def load_from_csv(filepath, start = 0, end = None, complete = False):
+    """
+    Load log data from a csv file.
 
+    :param int start: Byte offset to start reading at (must be the start of a line).
+    :param int end: Byte offset to stop reading at (None reads to the end of the file).
+    :param bool complete: The data ends with a complete line (see :func:`iter_csv`).
+    """
+    data = merge_data(iter_csv(filepath, start, end, complete))
+    data.setdefault(casu_name(filepath), {})
     return data
 
-def process_folder(foldername):
+def parse_bin(buf, pos, casu, record_ids):
     """
-    Recurse into subfolders and process all csv files.
+    Parse binary log records (see the :mod:`logger` module) from buf,
+    starting at offset pos.
+
+    :param string casu: CASU name.
+    :param dict record_ids: Record type -> record id map of the types
+                            declared so far; updated in place.
+    :return: (data, end) tuple, where end is the offset after
+             the last complete record.
     """
     data = {}
+    data[casu] = {}
+
+    for dataid in record_ids.values():
+        data[casu][dataid] = []
+        data[casu]['t_' + dataid] = []
+
+    while pos + logger.BIN_DECLARATION.size <= len(buf):
+        (record_type, n) = logger.BIN_DECLARATION.unpack_from(buf, pos)
+        if record_type == 0:
+            # Record type declaration
+            end = pos + logger.BIN_DECLARATION.size + n
+            if end > len(buf):
+                break
+            dataid = buf[end-n:end].replace('-','_')
+            record_ids[len(record_ids) + 1] = dataid
+            if dataid not in data[casu]:
+                data[casu][dataid] = []
+                data[casu]['t_' + dataid] = []
+            pos = end
+        else:
+            # Data record; guard against an incomplete last
+            # record (e.g. interrupted program)
+            end = pos + logger.BIN_RECORD.size + 8*n
+            if end > len(buf):
+                break
+            ts = logger.BIN_RECORD.unpack_from(buf, pos)[2]
+            values = struct.unpack_from('<%dd' % n, buf, pos + logger.BIN_RECORD.size)
+            dataid = record_ids[record_type]
+            data[casu]['t_' + dataid].append(ts)
+            data[casu][dataid].append(list(values))
+            pos = end
+
+    for dataid in record_ids.values():
+        data[casu]['t_' + dataid] = np.array(data[casu]['t_' + dataid], dtype=float)
+        data[casu][dataid] = values_array(data[casu][dataid])
+
+    return (data, pos)
+
+def iter_bin(filepath):
+    """
+    Load log data from a binary log file (see the :mod:`logger` module),
+    one chunk of about CHUNK_SIZE bytes at a time.
+
+    :return: A generator of the data in each chunk (see :func:`load`).
+    """
+    casu = casu_name(filepath)
+    record_ids = {}
+    with open_log(filepath, 'rb') as datafile:
+        if datafile.read(len(logger.BIN_MAGIC)) != logger.BIN_MAGIC:
+            sys.exit('{0} is not a binary CASU log file!'.format(filepath))
+        rest = ''
+        while True:
+            chunk = datafile.read(CHUNK_SIZE)
+            buf = rest + chunk
+            (data, pos) = parse_bin(buf, 0, casu, record_ids)
+            # Keep the incomplete last record for the next chunk
+            rest = buf[pos:]
+            yield data
+            if not chunk:
+                break
+
+def load_from_bin(filepath):
+    """
+    Load log data from a binary log file (see the :mod:`logger` module).
+    """
+    return merge_data(iter_bin(filepath))
+
+def gzip_size(filepath):
+    """
+    Returns the uncompressed size of the gzip-compressed file filepath,
+    as recorded in the gzip trailer (modulo 4 GB).
+    """
+    with open(filepath, 'rb') as datafile:
+        datafile.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', datafile.read(4))[0]
+
+def load_increment(filepath, state):
+    """
+    Load the data appended to a log file since it was last loaded.
+
+    Only complete lines (or records) are loaded; the rest is left for
+    the next time. Compressed logs are closed segments, so they are
+    loaded once; if the segment was loaded before it was compressed,
+    only the data following the part loaded then is loaded.
+
+    :param dict state: The state of the file when it was last loaded,
+                       as stored in the manifest (empty if never);
+                       updated in place.
+    :return: The new data, or None if there is none.
+    """
+    stat = os.stat(filepath)
+    offset = state.get('offset', 0)
+    compressed = filepath.endswith('.gz')
+    if (state and state.get('compressed', False) == compressed and
+            stat.st_size == state['size'] and stat.st_mtime == state['mtime']):
+        return None
+    if state.get('compressed', False) or (not compressed and stat.st_size < offset):
+        print('WARNING: {0} was rewritten since it was last aggregated, skipping it!'.format(filepath))
+        print('Run without --incremental to reprocess all the data.')
+        return None
+
+    # Offsets are positions in the uncompressed data,
+    # so they remain valid once the segment is compressed
+    if filepath.endswith('.bin') or filepath.endswith('.bin.gz'):
+        with open_log(filepath, 'rb') as datafile:
+            datafile.seek(offset)
+            buf = datafile.read()
+        pos = 0
+        if offset == 0:
+            if len(buf) < len(logger.BIN_MAGIC):
+                return None
+            if not buf.startswith(logger.BIN_MAGIC):
+                sys.exit('{0} is not a binary CASU log file!'.format(filepath))
+            pos = len(logger.BIN_MAGIC)
+        # JSON object keys are strings
+        record_ids = dict([(int(k), v) for (k, v) in state.get('types', {}).items()])
+        (data, pos) = parse_bin(buf, pos, casu_name(filepath), record_ids)
+        end = offset + pos
+        state['types'] = record_ids
+    elif compressed:
+        data = load_from_csv(filepath, offset)
+        end = gzip_size(filepath)
+    else:
+        end = complete_lines_end(filepath, offset, stat.st_size)
+        # The final row is complete, and must not be dropped, because
+        # the next increment starts after it
+        data = load_from_csv(filepath, offset, end, complete = True)
+
+    state['size'] = stat.st_size
+    state['mtime'] = stat.st_mtime
+    state['offset'] = end
+    state['compressed'] = compressed
+    return data
+
+def iter_records(filepath):
+    """
+    Load log data from a csv or binary (and possibly compressed) log file,
+    one chunk at a time, so that the memory use does not depend on the
+    size of the file.
+
+    :return: A generator of the data in each chunk (see :func:`load`).
+    """
+    if filepath.endswith('.bin') or filepath.endswith('.bin.gz'):
+        return iter_bin(filepath)
+    return iter_csv(filepath)
+
+def load(filepath):
+    """
+    Load log data from a csv or binary (and possibly compressed) log file.
+
+    :return: A dictionary with one entry per CASU, mapping each
+             record id to its array of values, and 't_' + record id
+             to its vector of timestamps.
+    """
+    if filepath.endswith('.bin') or filepath.endswith('.bin.gz'):
+        return load_from_bin(filepath)
+    return load_from_csv(filepath)
+
+def merge_data(datasets):
+    """
+    Merge the data loaded from consecutive log segments (or from
+    different CASUs), concatenating the records of each CASU in order.
+
+    Each record is concatenated only once, so merging n segments costs
+    time proportional to the total data size.
+    """
+    parts = {}
+    for new_data in datasets:
+        for casu in new_data:
+            for dataid in new_data[casu]:
+                parts.setdefault(casu, {}).setdefault(dataid, []).append(new_data[casu][dataid])
+
+    data = {}
+    for casu in parts:
+        data[casu] = {}
+        for dataid in parts[casu]:
+            if len(parts[casu][dataid]) == 1:
+                data[casu][dataid] = parts[casu][dataid][0]
+            elif dataid.startswith('t_'):
+                data[casu][dataid] = np.concatenate(parts[casu][dataid])
+            else:
+                data[casu][dataid] = concat_values(parts[casu][dataid])
+    return data
+
+def load_mat(filepath):
+    """
+    Load data aggregated to a Matlab file back into the form returned
+    by :func:`load` (a dictionary of CASU dictionaries of arrays).
+    """
+    mat = sio.loadmat(filepath, squeeze_me=False, struct_as_record=False)
+    data = {}
+    for casu in mat:
+        if casu.startswith('__'):
+            continue
+        struct = mat[casu][0, 0]
+        data[casu] = {}
+        for dataid in struct._fieldnames:
+            values = getattr(struct, dataid)
+            if dataid.startswith('t_'):
+                values = values.ravel().astype(float)
+            elif values.dtype == object:
+                # Rows of different lengths are stored as a cell array
+                values = [list(np.ravel(row)) for row in values.ravel()]
+            elif values.size == 0:
+                values = []
+            data[casu][dataid] = values
+    return data
+
+def split_widths(t, values):
+    """
+    Split value rows of different lengths into 2D arrays of rows of the same length.
+
+    :return: A list of (width, t, values) tuples.
+    """
+    if isinstance(values, np.ndarray):
+        return [(values.shape[1], t, values)]
+    rows = {}
+    for (ts, row) in itertools.izip(t, values):
+        rows.setdefault(len(row), []).append((ts, row))
+    return [(width, np.array([ts for (ts, row) in rows[width]], dtype=float),
+             np.array([row for (ts, row) in rows[width]], dtype=float))
+            for width in sorted(rows)]
+
+def write_data(writer, data):
+    """
+    Append loaded log data (see :func:`load`) to an output writer.
+    """
+    for casu in data:
+        for dataid in data[casu]:
+            if not dataid.startswith('t_'):
+                writer.append(casu, dataid, data[casu]['t_' + dataid], data[casu][dataid])
+
+class MatWriter:
+    """
+    Matlab (.mat) output: the data is collected in memory,
+    and saved when the writer is closed.
+
+    :param string outname: Output path, without the extension.
+    :param bool append: Add the data to the existing output file.
+    """
+
+    extension = '.mat'
+
+    def __init__(self, outname, append = False):
+        self.path = outname + self.extension
+        self.__parts = []
+        if append and os.path.exists(self.path):
+            self.__parts.append(load_mat(self.path))
+
+    def append(self, casu, dataid, t, values):
+        """
+        Append timestamps t and the corresponding value rows
+        to the record dataid of CASU casu.
+        """
+        self.__parts.append({casu: {'t_' + dataid: t, dataid: values}})
+
+    def close(self):
+        sio.savemat(self.path, merge_data(self.__parts), oned_as='column')
+
+class ChunkedWriter:
+    """
+    Base class of the outputs written while the logs are being parsed,
+    with one appendable 2D dataset per record.
+
+    Rows of a record that differ in length from its first row go to the
+    record id + '_' + row length dataset.
+    """
+
+    def __init__(self):
+        self._widths = {} # (casu, dataset) -> row length
+
+    def append(self, casu, dataid, t, values):
+        """
+        Append timestamps t and the corresponding value rows
+        to the record dataid of CASU casu.
+        """
+        if not len(t):
+            if (casu, dataid) not in self._widths:
+                self._widths[(casu, dataid)] = None
+                self._declare(casu, dataid)
+            return
+        for (width, t_part, values_part) in split_widths(t, values):
+            name = dataid
+            if self._widths.get((casu, dataid)) is None:
+                self._widths[(casu, dataid)] = width
+            elif self._widths[(casu, dataid)] != width:
+                name = '{0}_{1}'.format(dataid, width)
+                self._widths[(casu, name)] = width
+            self._append(casu, name, t_part, values_part)
+
+    def _declare(self, casu, name):
+        """
+        Record that the dataset exists, before any rows are appended to it.
+        """
+        pass
+
+    def _append(self, casu, name, t, values):
+        raise NotImplementedError()
+
+class ColumnWriter(ChunkedWriter):
+    """
+    Column store output: a folder with a raw little-endian float64 file
+    for the timestamps (casu/t_<record>.f8) and the values (casu/<record>.f8,
+    row by row) of each record, described by index.json. The files
+    can be memory-mapped, and are appended to in place.
+
+    :param string outname: Output path, without the extension.
+    :param bool append: Add the data to the existing output.
+    """
+
+    extension = '.cols'
+
+    def __init__(self, outname, append = False):
+        ChunkedWriter.__init__(self)
+        self.path = outname + self.extension
+        self.__index = {}
+        index_path = os.path.join(self.path, 'index.json')
+        if append and os.path.exists(index_path):
+            with open(index_path) as index_file:
+                self.__index = json.load(index_file)['records']
+            for casu in self.__index:
+                for (name, record) in self.__index[casu].items():
+                    self._widths[(casu, name)] = record['width']
+                    # Drop rows written after the index was last saved
+                    # (e.g. interrupted run)
+                    (t_path, values_path) = self.__paths(casu, name)
+                    with open(t_path, 'r+b') as t_file:
+                        t_file.truncate(8*record['rows'])
+                    with open(values_path, 'r+b') as values_file:
+                        values_file.truncate(8*record['rows']*(record['width'] or 0))
+        else:
+            if os.path.exists(self.path):
+                if not os.path.exists(index_path):
+                    sys.exit('{0} exists, and is not a column store!'.format(self.path))
+                shutil.rmtree(self.path)
+            os.makedirs(self.path)
+
+    def __paths(self, casu, name):
+        return (os.path.join(self.path, casu, 't_' + name + '.f8'),
+                os.path.join(self.path, casu, name + '.f8'))
+
+    def _declare(self, casu, name):
+        if name not in self.__index.get(casu, {}):
+            if casu not in self.__index:
+                if not os.path.isdir(os.path.join(self.path, casu)):
+                    os.makedirs(os.path.join(self.path, casu))
+                self.__index[casu] = {}
+            self.__index[casu][name] = {'rows': 0, 'width': None}
+            for path in self.__paths(casu, name):
+                open(path, 'wb').close()
+
+    def _append(self, casu, name, t, values):
+        self._declare(casu, name)
+        record = self.__index[casu][name]
+        record['width'] = values.shape[1]
+        (t_path, values_path) = self.__paths(casu, name)
+        with open(t_path, 'ab') as t_file:
+            t_file.write(t.astype('<f8').tostring())
+        with open(values_path, 'ab') as values_file:
+            values_file.write(values.astype('<f8').tostring())
+        record['rows'] += len(t)
+
+    def close(self):
+        with open(os.path.join(self.path, 'index.json'), 'w') as index_file:
+            json.dump({'version': 1, 'records': self.__index}, index_file,
+                      indent=1, sort_keys=True)
+
+class Hdf5Writer(ChunkedWriter):
+    """
+    HDF5 output (requires h5py): one group per CASU, with chunked,
+    resizable 't_<record>' (timestamps) and '<record>' (values) datasets.
+    Records without rows get empty datasets (with no columns, until
+    rows are appended).
+
+    :param string outname: Output path, without the extension.
+    :param bool append: Add the data to the existing output file.
+    """
+
+    extension = '.h5'
+
+    def __init__(self, outname, append = False):
+        ChunkedWriter.__init__(self)
+        if h5py is None:
+            sys.exit('The hdf5 output format requires the h5py package (pip install assisipy[hdf5])!')
+        self.path = outname + self.extension
+        self.__file = h5py.File(self.path, 'a' if append else 'w')
+        for casu in self.__file:
+            for name in self.__file[casu]:
+                if not name.startswith('t_'):
+                    # Declared records have no row length yet
+                    self._widths[(casu, name)] = self.__file[casu][name].shape[1] or None
+
+    def _declare(self, casu, name):
+        group = self.__file.require_group(casu)
+        if name not in group:
+            # Replaced once the row length is known
+            group.create_dataset('t_' + name, shape=(0,), dtype='<f8')
+            group.create_dataset(name, shape=(0, 0), dtype='<f8')
+
+    def _append(self, casu, name, t, values):
+        group = self.__file.require_group(casu)
+        width = values.shape[1]
+        if name in group and group[name].maxshape[0] is not None:
+            # Declared before its row length was known
+            del group['t_' + name]
+            del group[name]
+        if name not in group:
+            group.create_dataset('t_' + name, shape=(0,), maxshape=(None,),
+                                 chunks=(HDF5_CHUNK_ROWS,), dtype='<f8')
+            group.create_dataset(name, shape=(0, width), maxshape=(None, width),
+                                 chunks=(HDF5_CHUNK_ROWS, width), dtype='<f8')
+        for (dataset, part) in ((group['t_' + name], t), (group[name], values)):
+            n = dataset.shape[0]
+            dataset.resize(n + len(part), axis=0)
+            dataset[n:] = part
+
+    def close(self):
+        self.__file.close()
+
+WRITERS = {'mat': MatWriter, 'cols': ColumnWriter, 'hdf5': Hdf5Writer}
+""" Output writers, by format name """
+
+class LogStore:
+    """
+    Read access to aggregated CASU data, by CASU, record and time range.
+
+    Column stores (see :class:`ColumnWriter`) are memory-mapped, and HDF5
+    files are read lazily, so only the requested parts of the data are
+    read from the disk. Matlab files can not be mapped, so they are
+    loaded as a whole.
+
+    Time ranges are found by binary search on the timestamp vectors,
+    which are assumed to be sorted (as logged).
+
+    :param string path: Aggregated data (a .cols folder, .h5 or .mat file).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__file = None
+        self.__index = None
+        self.__data = None
+        if os.path.isdir(path):
+            index_path = os.path.join(path, 'index.json')
+            if not os.path.exists(index_path):
+                raise ValueError('{0} is not a column store!'.format(path))
+            with open(index_path) as index_file:
+                self.__index = json.load(index_file)['records']
+        elif path.endswith('.h5'):
+            if h5py is None:
+                raise ValueError('Reading HDF5 files requires the h5py package (pip install assisipy[hdf5])!')
+            self.__file = h5py.File(path, 'r')
+        else:
+            self.__data = load_mat(path)
+
+    def casus(self):
+        """
+        Returns the sorted list of CASU names.
+        """
+        if self.__index is not None:
+            return sorted(self.__index)
+        if self.__file is not None:
+            return sorted(self.__file)
+        return sorted(self.__data)
+
+    def records(self, casu):
+        """
+        Returns the sorted list of records of CASU casu
+        (e.g. 'temp', 'ir_raw', 'fft_amp', 'Peltier').
+        """
+        if self.__index is not None:
+            names = self.__index[casu]
+        elif self.__file is not None:
+            names = self.__file[casu]
+        else:
+            names = self.__data[casu]
+        return sorted([name for name in names if not name.startswith('t_')])
+
+    def timestamps(self, casu, record):
+        """
+        Returns the (memory-mapped or lazily read) timestamp vector of a record.
+        """
+        return self.__column(casu, 't_' + record)
+
+    def values(self, casu, record):
+        """
+        Returns the (memory-mapped or lazily read) value array of a record,
+        with one row per timestamp.
+        """
+        return self.__column(casu, record)
+
+    def __column(self, casu, name):
+        if self.__file is not None:
+            return self.__file[casu][name]
+        if self.__data is not None:
+            return self.__data[casu][name]
+        if name.startswith('t_'):
+            record = self.__index[casu][name[2:]]
+            shape = (record['rows'],)
+        else:
+            record = self.__index[casu][name]
+            shape = (record['rows'], record['width'] or 0)
+        if not record['rows']:
+            return np.empty(shape)
+        return np.memmap(os.path.join(self.path, casu, name + '.f8'),
+                         dtype='<f8', mode='r', shape=shape)
+
+    def query(self, casu, record, t0 = None, t1 = None):
+        """
+        Select the samples of a record logged in the time range [t0, t1).
+
+        :param float t0: Start time (None selects from the first sample).
+        :param float t1: End time (None selects up to the last sample).
+        :return: (t, values) tuple of the selected timestamps and value rows.
+        """
+        t = self.timestamps(casu, record)
+        start = 0
+        end = len(t)
+        if t0 is not None:
+            start = search_sorted(t, t0)
+        if t1 is not None:
+            end = search_sorted(t, t1)
+        return (t[start:end], self.values(casu, record)[start:end])
+
+    def close(self):
+        """
+        Close the underlying file.
+        """
+        if self.__file is not None:
+            self.__file.close()
+
+def search_sorted(t, value):
+    """
+    Returns the index of the first element of the sorted vector t
+    that is not smaller than value.
+    """
+    if isinstance(t, np.ndarray):
+        return int(np.searchsorted(t, value))
+    # Lazily read (HDF5) datasets are bisected element by element
+    return bisect.bisect_left(t, value)
+
+def find_logs(foldername):
+    """
+    Recurse into subfolders and find all log files.
+
+    A segment can be found both plain and compressed (e.g. if it was
+    collected before and after the logger compressed it); the compressed
+    file, which is already closed, is then used.
+
+    :return: A dictionary mapping CASU names to lists of (start, segment, path) tuples.
+    """
+    found = {}
 
     dirs = os.walk(foldername)
     for (dirpath, dirnames, filenames) in dirs:
         for filename in filenames:
-            if filename[-4:] == '.csv':
-                new_data = load_from_csv(os.path.join(dirpath,filename))
-                if new_data.keys():
-                    casu = new_data.keys()[0]
-                    if casu in data.keys():
-                        print('WARNING: Found more than one logfile for {0}!'.format(casu))
-                        print('The output file will contain data from only one logfile!')
-                data = dict(data, **new_data)
+            if is_log_file(filename):
+                (start, casu, segment) = parse_log_name(filename)
+                segments = found.setdefault(casu, {})
+                if (start, segment) in segments and not filename.endswith('.gz'):
+                    continue
+                segments[(start, segment)] = os.path.join(dirpath,filename)
 
-    return data
+    logs = {}
+    for casu in found:
+        logs[casu] = [(start, segment, path)
+                      for ((start, segment), path) in found[casu].items()]
+
+    return logs
+
+def select_logs(foldername):
+    """
+    Find the log files to process in a folder (recursively).
+
+    If there is more than one log for a CASU, only the latest one is
+    selected; segments of rotated logs are selected in order.
+
+    :return: A list of log file paths.
+    """
+    paths = []
+
+    logs = find_logs(foldername)
+    for casu in sorted(logs):
+        starts = sorted(set([start for (start, segment, path) in logs[casu]]))
+        if len(starts) > 1:
+            print('WARNING: Found more than one logfile for {0}!'.format(casu))
+            print('The output file will contain data from only one logfile (started {0})!'.format(starts[-1]))
+        segments = sorted([(segment, path) for (start, segment, path) in logs[casu]
+                           if start == starts[-1]])
+        paths.extend([path for (segment, path) in segments])
+
+    return paths
+
+def load_task(task):
+    """
+    Process pool task: load a whole log file, or the data appended to it.
+
+    :param tuple task: (path, state) tuple; state is None to load the whole
+                       file, otherwise see :func:`load_increment`.
+    :return: (data, state, size) tuple, where size is the number of bytes read.
+    """
+    (path, state) = task
+    if state is None:
+        return (load(path), None, os.path.getsize(path))
+    state = dict(state)
+    offset = state.get('offset', 0)
+    data = load_increment(path, state)
+    return (data, state, state.get('offset', 0) - offset)
+
+def stream_task(task, writer):
+    """
+    Like :func:`load_task`, but append the data to writer
+    one chunk at a time, instead of returning it.
+    """
+    (path, state) = task
+    if state is not None:
+        (data, state, size) = load_task(task)
+        if data:
+            write_data(writer, data)
+        return (None, state, size)
+    for data in iter_records(path):
+        write_data(writer, data)
+    return (None, None, os.path.getsize(path))
+
+def process_folder(foldername, jobs = 1, verbose = False, manifest = None, writer = None):
+    """
+    Recurse into subfolders and process all log files.
+
+    Segments of rotated logs are merged in order.
+
+    :param int jobs: Number of processes parsing the log files in parallel.
+    :param bool verbose: Report the progress and the parsing throughput.
+    :param dict manifest: If given, only load the data appended to the log
+                          files since they were recorded in the manifest
+                          (a map of log segments, see :func:`manifest_key`,
+                          to file states), and update the manifest.
+    :param writer: If given, append the data to this output writer
+                   (see :data:`WRITERS`) as it is parsed, and return None.
+                   With a single job, the log files are then parsed one
+                   chunk at a time, so the memory use does not depend on
+                   the size of the logs; parallel jobs parse whole files.
+    """
+    paths = select_logs(foldername)
+    keys = [manifest_key(path) for path in paths]
+    if manifest is None:
+        tasks = [(path, None) for path in paths]
+    else:
+        tasks = [(path, manifest.get(key, {})) for (path, key) in zip(paths, keys)]
+    total_size = sum([os.path.getsize(path) for path in paths])
+
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(load_task, tasks)
+    elif writer is not None:
+        results = itertools.imap(lambda task: stream_task(task, writer), tasks)
+    else:
+        results = itertools.imap(load_task, tasks)
+
+    datasets = []
+    size = 0
+    start_time = time.time()
+    try:
+        for (i, (path, key, (new_data, state, new_size))) in enumerate(
+                itertools.izip(paths, keys, results)):
+            if new_data:
+                if writer is None:
+                    datasets.append(new_data)
+                else:
+                    write_data(writer, new_data)
+            if manifest is not None:
+                manifest[key] = state
+            size += new_size
+            if verbose:
+                elapsed = max(time.time() - start_time, 1e-6)
+                print('[{0}/{1}] {2} ({3:.1f}/{4:.1f} MB, {5:.1f} MB/s)'.format(
+                    i + 1, len(paths), path, size/1e6, total_size/1e6, size/1e6/elapsed))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if verbose:
+        elapsed = max(time.time() - start_time, 1e-6)
+        print('Parsed {0} files ({1:.1f} MB) in {2:.1f} s ({3:.1f} MB/s), using {4} process(es).'.format(
+            len(paths), size/1e6, elapsed, size/1e6/elapsed, jobs))
+
+    if writer is None:
+        return merge_data(datasets)
+
+def manifest_path(outpath):
+    """
+    Returns the path of the manifest of the aggregated data output outpath.
+    """
+    return outpath + '.manifest.json'
+
+def manifest_key(filepath):
+    """
+    Returns the manifest key of the log segment stored in filepath:
+    'casu/YYYY-MM-DD-HH-MM-SS[.NNNN]'.
+
+    The key does not depend on the location of the file, or on whether
+    it is compressed, so that the state of a segment carries over
+    when the logger compresses it.
+    """
+    (start, casu, segment) = parse_log_name(filepath)
+    key = casu + '/' + start
+    if segment is not None:
+        key += '.{0:04d}'.format(segment)
+    return key
+
+def load_manifest(outpath):
+    """
+    Load the manifest of the log files aggregated to outpath.
+
+    :return: A map of log segments to file states (see :func:`process_folder`),
+             empty if there is no manifest, or no output to go with it.
+    """
+    path = manifest_path(outpath)
+    if not (os.path.exists(path) and os.path.exists(outpath)):
+        return {}
+    with open(path) as manifest_file:
+        saved = json.load(manifest_file)
+    if saved.get('version', 1) > 1:
+        return saved['files']
+    # Version 1 manifests are keyed by file paths
+    manifest = {}
+    for (filepath, state) in saved['files'].items():
+        if state is not None:
+            state['compressed'] = filepath.endswith('.gz')
+        manifest[manifest_key(filepath)] = state
+    return manifest
+
+def save_manifest(outpath, manifest):
+    """
+    Save the manifest of the log files aggregated to outpath.
+    """
+    with open(manifest_path(outpath), 'w') as manifest_file:
+        json.dump({'version': 2, 'files': manifest}, manifest_file,
+                  indent=1, sort_keys=True)
 
 def main():
     """
     Main script entry point.
     """
-    # TODO: Use argparse and add reasonable options
-    # Document usage
-    # Consider if the program should take an .assisi file as input?
+    # TODO: Consider if the program should take an .assisi file as input?
+    parser = argparse.ArgumentParser(
+        description='Aggregate CASU logfiles into a Matlab (.mat) file, '
+        'a memory-mappable column store, or an HDF5 file.')
+    parser.add_argument('path',
+                        help='Logfile, or folder containing logfiles (in subfolders, '
+                        'e.g. as retrieved by collect_data.py).')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes parsing logfiles in parallel.')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False,
+                        help='Do not report progress.')
+    parser.add_argument('-i', '--incremental', action='store_true', default=False,
+                        help='Only parse the data logged since the previous (incremental) run, '
+                        'and append it to the existing output file.')
+    parser.add_argument('-f', '--format', choices=sorted(WRITERS), default='mat',
+                        help='Output format. mat keeps all the data in memory; '
+                        'cols (raw column files) and hdf5 are written while '
+                        'the logs are parsed (default: mat).')
+    args = parser.parse_args()
+
+    manifest = None
 
-    data = {}
-    
-    # The first argument is the name
-    # of the file/folder to process
     outname = ''
-    if len(sys.argv) < 2:
-        sys.exit('Please provide a file or folder to process.')
-    elif sys.argv[1][-4:] == '.csv':
-        # We are assuming that we need to process a single .csv file
-        data = load_from_csv(sys.argv[1])
-        outname = sys.argv[1][:-4]
+    if is_log_file(os.path.basename(args.path)) and not os.path.isdir(args.path):
+        if args.incremental:
+            parser.error('--incremental only applies to folders.')
+        # We are assuming that we need to process a single log file
+        outname = re.sub(r'\.(csv|bin)(\.gz)?$', '', args.path)
+        writer = WRITERS[args.format](outname)
+        for data in iter_records(args.path):
+            write_data(writer, data)
     else:
         # We are assuming that the argument is a folder
         # to be processed. It is assumed that it contains
         # subfolders, each of which corresponds to one CASU.
         # Each subfolder is assumed to contain one or more
-        # .csv files.
-        data = process_folder(sys.argv[1])
-        outname = sys.argv[1].rstrip(os.sep)
+        # log files.
+        outname = args.path.rstrip(os.sep)
+        if args.incremental:
+            manifest = load_manifest(outname + WRITERS[args.format].extension)
+        writer = WRITERS[args.format](outname, append = bool(manifest))
+        process_folder(args.path, args.jobs, not args.quiet, manifest, writer)
 
-    sio.savemat(outname,data,oned_as='column')
+    writer.close()
+    if manifest is not None:
+        # Only record the progress once the data is safely stored
+        save_manifest(writer.path, manifest)
 
 
 if __name__ == '__main__':
@@ -8,12 +8,25 @@ Tool for remotely running CASU controllers.
 # none of the fabric tools are used [directly], import removed
 #from fabric.api import settings, cd, run, env
 
-import yaml
+from project import Project
 
 #import os.path
 import os
+import sys
 import argparse
 import subprocess
+import pipes
+import threading
+
+import remote
+import comm
+import supervisor
+
+START_TIMEOUT_MARGIN = 30.0
+"""
+Time (in seconds) synchronized controllers wait for the start signal
+beyond the synchronization timeout, before giving up.
+"""
 
 class AssisiRun:
     """
@@ -27,26 +40,38 @@ class AssisiRun:
         self.proj_name = os.path.splitext(os.path.basename(project_name))[0]
         self.project_root = os.path.dirname(os.path.abspath(project_name))
         self.sandbox_dir = self.proj_name + '_sandbox'
-        self.fabfile_name = os.path.join(self.sandbox_dir, self.proj_name + '.py')
-        self.depspec = {}
-        with open(project_name) as project:
-            project_spec = yaml.safe_load(project)
-            with open(os.path.join(self.project_root, project_spec['dep'])) as depfile:
-                self.depspec = yaml.safe_load(depfile)
+        self.depspec = Project(project_name, require=('dep',), nbg=False).dep
 
         # Running controllers
         self.running = {}
 
-    def run(self, layer_select='all'):
+    def run(self, layer_select='all', jobs=8, per_host=remote.PER_HOST,
+            sync_addr=None, sync_timeout=60.0, supervise_addr=None, stall_timeout=20.0):
         """
         Execute the controllers.
+
+        All the controllers are started from this process, by a pool of
+        jobs threads, over one connection per host (at most per_host
+        controllers are started on the same host at the same time).
+        Their output is printed, prefixed with the CASU name, until
+        they all finish.
+
+        If sync_addr ('tcp://host:port', host being the address of this
+        machine as seen from the CASUs) is given, the start is synchronized:
+        every controller runs up to the point where its Casu is connected,
+        and then waits until all the controllers are ready (at most
+        sync_timeout seconds), to be released at the same time.
+        The measured start skew is reported for every CASU.
+
+        If supervise_addr ('tcp://host:port', as sync_addr) is given,
+        the controllers send heartbeats to this process, which prints
+        a table of their health, and restarts the ones that fail or stall
+        (receive no data for stall_timeout seconds), see :class:`supervisor.Supervisor`;
+        the controllers then run until they all finish successfully.
+
+        returns a map of CASU names to controller exit statuses
+        (-1 for the controllers that could not be started).
         """
-        #env.parallel = True
-        cwd = os.getcwd()
-        print('Changing directory to {0}'.format(self.project_root))
-        os.chdir(self.project_root)
-        print('Preparing files for deployment!')
-        # counter = 0 NOTE: var not used
 
         # Select particular layers
         selected_layers = self.depspec.keys()
@@ -57,18 +82,107 @@ class AssisiRun:
                     "[F] {} is not a layer in this deployment! aborting.".format(
                         layer_select))
 
-        for layer in selected_layers:
-            for casu in self.depspec[layer]:
-                taskname = layer.replace('-','_') + '_' + casu.replace('-','_')
-                cmd = 'fab -f {0} {1}'.format(self.fabfile_name, taskname)
-                print(cmd)
-                self.running[taskname] = subprocess.Popen(cmd,shell='True')
-
-        for taskname in self.running:
-            self.running[taskname].wait()
+        tasks = [(layer, casu) for layer in selected_layers for casu in self.depspec[layer]]
+        pool = remote.ConnectionPool(per_host)
+        # The barrier has to listen before the controllers get ready
+        barrier = None
+        releaser = None
+        if sync_addr:
+            barrier = comm.StartBarrier(sync_addr)
+        monitor = None
+        if supervise_addr:
+            # Restarted controllers are not synchronized
+            names = dict([(layer + '/' + casu, (layer, casu)) for (layer, casu) in tasks])
+            monitor = supervisor.Supervisor(
+                supervise_addr, lambda name: self.__start(pool, None, supervise_addr, *names[name]),
+                stall_timeout)
+        statuses = {}
+        failed = {}
+        try:
+            for ((layer, casu), channel, error) in remote.run_tasks(
+                    lambda task: self.__start(pool, sync_addr, supervise_addr, *task,
+                                              sync_timeout=sync_timeout), tasks, jobs):
+                taskname = layer + '/' + casu
+                if error is not None:
+                    print('[E] Starting the controller of {0} failed: {1}'.format(taskname, error))
+                    if monitor is None:
+                        failed[taskname] = -1
+                else:
+                    print('Started the controller of {0}.'.format(taskname))
+                    self.running[channel] = taskname
+                if monitor is not None:
+                    # The supervisor retries the failed starts
+                    monitor.add(taskname, channel)
+
+            if barrier is not None:
+                releaser = threading.Thread(target=self.__release,
+                                            args=(barrier, dict(self.running), sync_timeout))
+                releaser.daemon = True
+                releaser.start()
+            if monitor is not None:
+                statuses = monitor.run()
+            else:
+                statuses = remote.stream_output(self.running)
+                statuses.update(failed)
+        finally:
+            # Closing the channels hangs up on the controllers still running
+            for channel in self.running:
+                channel.close()
+            self.running = {}
+            pool.close()
+            # ZMQ sockets can not be closed while another thread uses them
+            if barrier is not None:
+                barrier.stop()
+                if releaser is not None:
+                    releaser.join()
+                barrier.close()
+            if monitor is not None:
+                monitor.close()
+
+        return statuses
+
+    def __release(self, barrier, running, timeout):
+        """
+        Release the started controllers at the same time, and report the start skew;
+        then keep releasing the controllers that get ready late.
+        """
+        channels = dict([(name, channel) for (channel, name) in running.items()])
+        try:
+            starts = barrier.release(channels.keys(), ready_timeout=timeout,
+                                     alive=lambda name: not channels[name].exit_status_ready())
+            comm.report_start(starts)
+            barrier.release_late()
+        except Exception as e:
+            print('[E] Synchronized start failed: {0}'.format(e))
+
+    def __start(self, pool, sync_addr, supervise_addr, layer, casu, sync_timeout = None):
+        """
+        Start the controller of one CASU (under the start barrier at sync_addr,
+        and sending heartbeats to supervise_addr, if given).
 
-        # back to original directory.
-        os.chdir(cwd)
+        :return: The channel of the controller.
+        """
+        spec = self.depspec[layer][casu]
+        code_dir = os.path.join(spec['prefix'], layer, casu)
+        env = ''
+        start_timeout = None
+        if sync_addr and sync_timeout is not None:
+            # Do not wait forever if this process is gone
+            start_timeout = str(sync_timeout + START_TIMEOUT_MARGIN)
+        for (var, value) in [(comm.START_ADDR_ENV, sync_addr),
+                             (comm.START_TIMEOUT_ENV, start_timeout),
+                             (comm.SUPERVISOR_ADDR_ENV, supervise_addr)]:
+            if value:
+                env += '{0}={1} '.format(var, pipes.quote(value))
+        if env:
+            env += '{0}={1} '.format(comm.CONTROLLER_ID_ENV, pipes.quote(layer + '/' + casu))
+        command = 'cd {0} && {1}./{2} {3} {4}'.format(
+            pipes.quote(code_dir), env, pipes.quote(os.path.basename(spec['controller'])),
+            pipes.quote(casu + '.rtc'), " ".join(spec.get('args', [])))
+        with pool.slot(spec['hostname']):
+            connection = pool.get(spec['hostname'], spec['user'])
+            # Run in a login shell, as fabric does
+            return connection.start('/bin/bash -l -c ' + pipes.quote(command))
 
 def main():
     parser = argparse.ArgumentParser(description='Run a set of CASU controllers.')
@@ -76,16 +190,40 @@ def main():
                         help='name of .assisi file specifying the project details.')
     parser.add_argument('--layer', default='all',
                         help='Name of single layer to run controllers for')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Number of controllers to start concurrently')
+    parser.add_argument('--per-host', type=int, default=remote.PER_HOST,
+                        help='Maximum number of controllers to start concurrently '
+                        'on the same host')
+    parser.add_argument('--sync', metavar='tcp://HOST:PORT', default=None,
+                        help='Synchronize the start of the controllers, releasing them all '
+                        'at once when they are connected, through a barrier at HOST:PORT '
+                        '(this machine, as seen from the CASUs; PORT and PORT+1 are used)')
+    parser.add_argument('--sync-timeout', type=float, default=60.0,
+                        help='Maximum time (in seconds) to wait for the controllers to be ready')
+    parser.add_argument('--supervise', metavar='tcp://HOST:PORT', default=None,
+                        help='Monitor the heartbeats of the controllers, sent to HOST:PORT '
+                        '(this machine, as seen from the CASUs), and restart the ones that '
+                        'fail or stall')
+    parser.add_argument('--stall-timeout', type=float, default=20.0,
+                        help='Restart supervised controllers that receive no data '
+                        'for this many seconds')
     args = parser.parse_args()
 
     project = AssisiRun(args.project)
     try:
-        project.run(args.layer)
+        statuses = project.run(args.layer, args.jobs, args.per_host, args.sync,
+                               args.sync_timeout, args.supervise, args.stall_timeout)
 
     finally:
         # cleanup the terminal (tty loses the "echo" flag)
         subprocess.call(["stty", "sane"])
 
+    failed = sorted([name for (name, status) in statuses.items() if status != 0])
+    if failed:
+        print('[E] Controllers failed: {0}'.format(', '.join(failed)))
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
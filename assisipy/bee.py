@@ -9,9 +9,17 @@ import sys
 
 import zmq
 
+try:
+    # Only needed by BeeSwarm
+    import numpy as np
+except ImportError:
+    np = None
+
 from msg import dev_msgs_pb2
 from msg import base_msgs_pb2
 
+import comm
+
 
 LENGTH = 2
 """
@@ -94,22 +102,31 @@ ARRAY = 10000
 Special value to get all sensor values from an array of sensors.
 """
 
+N_OBJECT_SENSORS = 5
+""" Number of object sensors (OBJECT_SIDE_RIGHT ... OBJECT_SIDE_LEFT) """
+
+N_TEMP_SENSORS = 4
+""" Number of temperature sensors (TEMP_SENSOR_FRONT ... TEMP_SENSOR_RIGHT) """
+
 class Bee:
     """ 
     The low-level interface to Bee 'robots'. 
     This clas provides an api for programming bee behaviors.
     It creates a connection to the data source, i.e., the simulated bee.
-    Waits for the bee of specified by 'name' to be spawned into the simulator.
+    Waits for the bee of specified by 'name' to be spawned into the simulator,
+    and for one full update of its data (unless it is created with :meth:`connect_async`).
 
     :param string rtc_file_name: Name of the run-time-configuration (RTC) file. This file specifies the simulation connection parameters and the name of the simulated bee object.
     :param string name: The name of the bee (if not specified in the RTC file).
+    :param float timeout: Maximum time (in seconds) to wait for the bee; :class:`comm.ConnectionTimeout` is raised if no data is received in time. None waits forever.
+    :param bool wait: Wait for the connection (see :meth:`connect_async`).
     :param dict kwargs: accepts strings to override values for:
         `pub_addr` (defaults to localhost:5556)
         `sub_addr` (defautls to localhost:5555)
 
     """
     
-    def __init__(self, rtc_file_name='', name = 'Bee', **kwargs):
+    def __init__(self, rtc_file_name='', name = 'Bee', timeout = None, wait = True, **kwargs):
         
         
         if rtc_file_name:
@@ -132,8 +149,21 @@ class Bee:
         self.__color_setpoint = base_msgs_pb2.ColorStamped()
         self.__airflow_reading = dev_msgs_pb2.AirflowReading()
 
+        # Incoming message handlers
+        self.__lock = threading.Lock()
+        self.__messages = comm.MessageTable(self.__lock, 'Bee ' + self.__name)
+        self.__messages.add('Object', 'Ranges', self.__object_readings)
+        self.__messages.add('Base', 'Enc', self.__encoder_readings)
+        self.__messages.add('Base', 'GroundTruth', self.__true_pose)
+        self.__messages.add('Base', 'VelRef', self.__vel_setpoints)
+        self.__messages.add('Light', 'Readings', self.__light_readings)
+        self.__messages.add('Temp', 'Temperatures', self.__temp_readings)
+        self.__messages.add('Color', 'ColorVal', self.__color_setpoint)
+        self.__messages.add('Airflow', 'Reading', self.__airflow_reading)
+
         # Connect the publisher socket
-        self.__connected = False
+        self.__connected = threading.Event()
+        self.__stop = False
         self.__context = zmq.Context(1)
         self.__pub = self.__context.socket(zmq.PUB)
         try:
@@ -145,16 +175,42 @@ class Bee:
         # Create the data update thread
         self.__comm_thread = threading.Thread(target=self.__update_readings)
         self.__comm_thread.daemon = True
-        self.__lock =threading.Lock()
         self.__comm_thread.start()
 
-        # Wait for the connection, check every second
-        while not self.__connected:
-            time.sleep(1)
-        print('{0} connected!'.format(self.__name))
+        if wait:
+            try:
+                self.wait_connected(timeout)
+            except comm.ConnectionTimeout:
+                # Release the connections, nobody else will
+                self.stop()
+                raise
+
+    @classmethod
+    def connect_async(cls, *args, **kwargs):
+        """
+        Create a Bee interface without waiting for the connection;
+        call :meth:`wait_connected` (or :func:`comm.wait_all`) before using it.
+        Takes the same parameters as the constructor.
+
+        Use this to connect many bees at the same time::
 
-        # Wait one more second to get all the data
-        time.sleep(0.5)
+            bees = [Bee.connect_async(name = name) for name in names]
+            comm.wait_all(bees, timeout = 10)
+        """
+        kwargs['wait'] = False
+        return cls(*args, **kwargs)
+
+    def wait_connected(self, timeout = None):
+        """
+        Block until the bee is connected, i.e. until one full
+        update of its data has been received.
+
+        :param float timeout: Maximum waiting time in seconds (None waits forever).
+        :raises comm.ConnectionTimeout: If the data was not received in time.
+        """
+        if not self.__connected.is_set():
+            comm.wait_ready(self.__connected, timeout, 'Bee ' + self.__name)
+            print('{0} connected!'.format(self.__name))
 
     def __update_readings(self):
         """ 
@@ -168,69 +224,61 @@ class Bee:
             sys.exit(1) # TODO: This might have some issues, as we're within a thread
 
         self.__sub.setsockopt(zmq.SUBSCRIBE, self.__name)
-                    
-        while True:
+
+        # The simulator sends all the data of a bee in every step, so
+        # once the first frame repeats, all of it has been received
+        seen = set()
+        # Wake up periodically to be able to stop the thread
+        poller = zmq.Poller()
+        poller.register(self.__sub, zmq.POLLIN)
+        while not self.__stop:
+            if not poller.poll(500):
+                continue
             [name, dev, cmd, data] = self.__sub.recv_multipart()
-            self.__connected = True
-            
-            ### Range readings ###
-            if dev == 'Object':
-                if cmd == 'Ranges':
-                    # Protect write with a lock
-                    # to make sure all data is written before access
-                    with self.__lock:
-                        self.__object_readings.ParseFromString(data)
+            self.__messages.dispatch(dev, cmd, data)
+            if seen is not None:
+                if (dev, cmd) in seen:
+                    self.__connected.set()
+                    seen = None
                 else:
-                    print('Unknown command {0} for {1}'.format(cmd, self.__name))
+                    seen.add((dev, cmd))
+        self.__sub.close()
 
-            ### Base data ###
-            elif dev == 'Base':
-                if cmd == 'Enc':
-                    with self.__lock:
-                        self.__encoder_readings.ParseFromString(data)
-                elif cmd == 'GroundTruth':
-                    with self.__lock:
-                        self.__true_pose.ParseFromString(data)
-                elif cmd == 'VelRef':
-                    with self.__lock:
-                        self.__vel_setpoints.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for Bee {1}'.format(cmd, self.__name))
-            ### Light sensors ###
-            elif dev == 'Light':
-                if cmd == 'Readings':
-                    with self.__lock:
-                        self.__light_readings.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for Bee {1}'.format(cmd, self.__name))
+    def stop(self):
+        """
+        Stop the receive thread and close the connection.
+        """
+        self.__stop = True
+        self.__comm_thread.join()
+        self.__pub.close()
+        self.__context.term()
 
-            ### Temperature sensors ###
-            elif dev == 'Temp':
-                if cmd == 'Temperatures':
-                    with self.__lock:
-                        self.__temp_readings.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for Bee {1}'.format(cmd, self.__name))
-                    
-            ### Diagnostic color actuator ###
-            elif dev == 'Color':
-                if cmd == 'ColorVal':
-                    with self.__lock:
-                        self.__color_setpoint.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for Bee {1}'.format(cmd, self.__name))
+    def wait_for_update(self, device = None, timeout = None):
+        """
+        Block until new data is received from a device.
 
-            ### Air flow sensor ###
-            elif dev == 'Airflow':
-                if cmd == 'Reading':
-                    with self.__lock:
-                        self.__airflow_reading.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for airflow of Bee {1}'.format(cmd, self.__name))
+        Use this to run control loops at the sensor rate,
+        instead of polling the getters with time.sleep().
 
-            else:
-                print('Unknown device {0} for Bee {1}'.format(dev, self.__name))
+        :param string device: Device name, as used in the ASSISI protocol
+                              ('Object', 'Base', 'Light', 'Temp', 'Color', 'Airflow').
+                              If None, any new data will do.
+        :param float timeout: Maximum waiting time in seconds (None waits forever).
+        :return: True if new data was received, False on timeout.
+        """
+        return self.__messages.wait(device, timeout)
+
+    def on_update(self, device, callback):
+        """
+        Register a function to be called each time new data is received from a device.
 
+        The callback is called as callback(device) from the receive thread,
+        so it should return quickly.
+
+        :param string device: Device name (see :meth:`wait_for_update`); None for all devices.
+        :param callback: The function to call.
+        """
+        self.__messages.add_callback(device, callback)
 
     def get_range(self, id):
         """ 
@@ -419,6 +467,338 @@ class Bee:
                self.__color_setpoint.color.green,
                self.__color_setpoint.color.blue)
 
+class BeeSwarm:
+    """
+    Interface to many simulated bees at once.
+
+    Unlike a list of :class:`Bee` objects, the swarm uses a single
+    ZMQ context, a single subscriber socket (for all the bee names),
+    a single publisher socket and a single receive thread, no matter
+    how many bees it has. The readings are stored in preallocated
+    NumPy arrays, with one row per bee, in the order of `names`::
+
+        swarm = BeeSwarm(names = ['Bee-{0:03d}'.format(i) for i in range(300)])
+        while True:
+            swarm.wait_for_update()
+            ranges = swarm.get_ranges()
+            turn = ranges[:, OBJECT_FRONT] < 1.0
+            swarm.set_vels(numpy.where(turn, -0.5, 1.0), 1.0)
+
+    Requires numpy, which is installed with assisipy (``pip install assisipy``);
+    from a source checkout, install it separately (``pip install numpy``).
+    The other classes of this module do not need it.
+
+    :param list names: Names of the bees.
+    :param string pub_addr: Simulator command address (defaults to tcp://127.0.0.1:5556).
+    :param string sub_addr: Simulator data address (defaults to tcp://127.0.0.1:5555).
+    :param float timeout: Maximum time (in seconds) to wait for the bees; :class:`comm.ConnectionTimeout` is raised if some of them have not sent their data by then. None waits forever.
+    :param bool wait: Wait for the connection (see :meth:`wait_connected`).
+    """
+
+    def __init__(self, names, pub_addr = 'tcp://127.0.0.1:5556',
+                 sub_addr = 'tcp://127.0.0.1:5555', timeout = None, wait = True):
+        if np is None:
+            raise ImportError('BeeSwarm requires the numpy package (pip install numpy)!')
+        self.__names = list(names)
+        self.__index = dict([(name, i) for (i, name) in enumerate(self.__names)])
+        if len(self.__index) != len(self.__names):
+            raise ValueError('Duplicate bee names in the swarm!')
+        n = len(self.__names)
+
+        # Readings, one row per bee
+        self.__ranges = np.zeros((n, N_OBJECT_SENSORS))
+        self.__max_range = np.zeros(n)
+        self.__objects = np.empty((n, N_OBJECT_SENSORS), dtype = object)
+        self.__objects[:] = ''
+        self.__temps = np.zeros((n, N_TEMP_SENSORS))
+        self.__light = np.zeros((n, 3))
+        self.__airflow = np.zeros((n, 2))
+        self.__poses = np.zeros((n, 3))
+        self.__updates = np.zeros(n, dtype = np.int64)
+
+        # Incoming frame handlers, with the buffers they parse into
+        # (used only by the receive thread)
+        self.__handlers = {
+            ('Object', 'Ranges'): (dev_msgs_pb2.ObjectArray(), self.__update_objects),
+            ('Base', 'GroundTruth'): (base_msgs_pb2.PoseStamped(), self.__update_pose),
+            ('Light', 'Readings'): (base_msgs_pb2.ColorStamped(), self.__update_light),
+            ('Temp', 'Temperatures'): (dev_msgs_pb2.TemperatureArray(), self.__update_temps),
+            ('Airflow', 'Reading'): (dev_msgs_pb2.AirflowReading(), self.__update_airflow)}
+
+        self.__lock = threading.Lock()
+        self.__updated = threading.Condition(threading.Lock())
+        self.__waiting = 0
+        self.__frames = 0
+        self.__stop = False
+
+        # A bee is connected once its first frame repeats (see Bee)
+        self.__seen = [set() for name in self.__names]
+        self.__missing = set(self.__names)
+        self.__connected = threading.Event()
+        if not self.__names:
+            self.__connected.set()
+
+        self.__pub_addr = pub_addr
+        self.__sub_addr = sub_addr
+        self.__context = zmq.Context(1)
+        self.__pub = self.__context.socket(zmq.PUB)
+        # Commands for all the bees are sent at once
+        self.__pub.setsockopt(zmq.SNDHWM, max(1000, 4 * n))
+        try:
+            self.__pub.connect(self.__pub_addr)
+        except zmq.error.ZMQError:
+            print('CONNECTION ERROR: Failed to connect to {0}'.format(self.__pub_addr))
+            sys.exit(1)
+
+        self.__comm_thread = threading.Thread(target=self.__update_readings)
+        self.__comm_thread.daemon = True
+        self.__comm_thread.start()
+
+        if wait:
+            try:
+                self.wait_connected(timeout)
+            except comm.ConnectionTimeout:
+                # Release the connections, nobody else will
+                self.stop()
+                raise
+
+    def wait_connected(self, timeout = None):
+        """
+        Block until one full update of the data of every bee has been received.
+
+        :param float timeout: Maximum waiting time in seconds (None waits forever).
+        :raises comm.ConnectionTimeout: If the data of some bees was not received in time.
+        """
+        if self.__connected.is_set():
+            return
+        try:
+            comm.wait_ready(self.__connected, timeout, 'the swarm')
+        except comm.ConnectionTimeout:
+            missing = sorted(self.__missing)
+            raise comm.ConnectionTimeout(', '.join(['Bee ' + name for name in missing]), timeout)
+        print('{0} bees connected!'.format(len(self.__names)))
+
+    def __update_readings(self):
+        """
+        Get data of all the bees and update the arrays.
+        """
+        self.__sub = self.__context.socket(zmq.SUB)
+        # All the bees report in every simulator step
+        self.__sub.setsockopt(zmq.RCVHWM, max(1000, 8 * len(self.__names)))
+        try:
+            self.__sub.connect(self.__sub_addr)
+        except zmq.error.ZMQError:
+            print('CONNECTION ERROR: Failed to connect to {0}'.format(self.__sub_addr))
+            sys.exit(1) # TODO: This might have some issues, as we're within a thread
+        for name in self.__names:
+            self.__sub.setsockopt(zmq.SUBSCRIBE, name)
+
+        # Wake up periodically to be able to stop the thread
+        poller = zmq.Poller()
+        poller.register(self.__sub, zmq.POLLIN)
+        while not self.__stop:
+            if not poller.poll(500):
+                continue
+            # Handle everything that has arrived, in one go
+            while True:
+                try:
+                    [name, dev, cmd, data] = self.__sub.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                # Subscriptions are prefix matches (Bee-1 also matches Bee-10),
+                # so dispatch on the exact name
+                i = self.__index.get(name)
+                if i is None:
+                    continue
+                handler = self.__handlers.get((dev, cmd))
+                if handler is not None:
+                    (buffer, update) = handler
+                    buffer.ParseFromString(data)
+                    with self.__lock:
+                        update(i, buffer)
+                        self.__updates[i] += 1
+                if self.__seen[i] is not None:
+                    if (dev, cmd) in self.__seen[i]:
+                        self.__seen[i] = None
+                        self.__missing.discard(name)
+                        if not self.__missing:
+                            self.__connected.set()
+                    else:
+                        self.__seen[i].add((dev, cmd))
+            self.__frames += 1
+            if self.__waiting:
+                with self.__updated:
+                    self.__updated.notify_all()
+        self.__sub.close()
+
+    def __update_objects(self, i, msg):
+        k = min(len(msg.range), N_OBJECT_SENSORS)
+        self.__ranges[i, :k] = msg.range[:k]
+        k = min(len(msg.type), N_OBJECT_SENSORS)
+        self.__objects[i, :k] = msg.type[:k]
+        self.__max_range[i] = msg.max_range
+
+    def __update_pose(self, i, msg):
+        self.__poses[i] = (msg.pose.position.x, msg.pose.position.y, msg.pose.orientation.z)
+
+    def __update_light(self, i, msg):
+        self.__light[i] = (msg.color.red, msg.color.green, msg.color.blue)
+
+    def __update_temps(self, i, msg):
+        k = min(len(msg.temp), N_TEMP_SENSORS)
+        self.__temps[i, :k] = msg.temp[:k]
+
+    def __update_airflow(self, i, msg):
+        self.__airflow[i] = (msg.intensity, msg.direction)
+
+    def stop(self):
+        """
+        Stop the receive thread and close the connection.
+        """
+        self.__stop = True
+        self.__comm_thread.join()
+        self.__pub.close()
+        self.__context.term()
+
+    def names(self):
+        """
+        Returns the names of the bees, in the order of the array rows.
+        """
+        return list(self.__names)
+
+    def index(self, name):
+        """
+        Returns the array row of bee name.
+        """
+        return self.__index[name]
+
+    def __len__(self):
+        return len(self.__names)
+
+    def wait_for_update(self, timeout = None):
+        """
+        Block until new data is received (from any bee).
+
+        :param float timeout: Maximum waiting time in seconds (None waits forever).
+        :return: True if new data was received, False on timeout.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.__updated:
+            frames = self.__frames
+            self.__waiting += 1
+            try:
+                while self.__frames == frames:
+                    if deadline is None:
+                        self.__updated.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                        self.__updated.wait(remaining)
+            finally:
+                self.__waiting -= 1
+        return True
+
+    def get_update_counts(self):
+        """
+        Returns the number of data frames received from each bee (N array).
+        """
+        with self.__lock:
+            return self.__updates.copy()
+
+    def get_ranges(self):
+        """
+        Returns the object sensor ranges of all bees, as an (N, 5) array;
+        columns are the sensors OBJECT_SIDE_RIGHT ... OBJECT_SIDE_LEFT.
+        Ranges of sensors not detecting anything are set to
+        the maximum range (the sensors report 0.0).
+        """
+        with self.__lock:
+            ranges = self.__ranges.copy()
+            max_range = self.__max_range.copy()
+        # Same fix as in Bee.get_object_with_range
+        return np.where(ranges < 0.000001, max_range[:, np.newaxis], ranges)
+
+    def get_objects(self):
+        """
+        Returns the object types detected by the object sensors of
+        all bees, as an (N, 5) array of strings (see :meth:`get_ranges`).
+        """
+        with self.__lock:
+            return self.__objects.copy()
+
+    def get_temps(self):
+        """
+        Returns the temperature readings of all bees, as an (N, 4) array;
+        columns are the sensors TEMP_SENSOR_FRONT ... TEMP_SENSOR_RIGHT.
+        """
+        with self.__lock:
+            return self.__temps.copy()
+
+    def get_light_rgb(self):
+        """
+        Returns the light intensities sensed by all bees, as an (N, 3) array
+        of (r, g, b) rows (see :meth:`Bee.get_light_rgb`).
+        """
+        with self.__lock:
+            return self.__light.copy()
+
+    def get_airflow(self):
+        """
+        Returns the airflow sensed by all bees, as an (N, 2) array
+        of (intensity, direction) rows.
+        """
+        with self.__lock:
+            return self.__airflow.copy()
+
+    def get_true_poses(self):
+        """
+        Returns the true poses of all bees, as an (N, 3) array of (x, y, yaw) rows.
+        """
+        with self.__lock:
+            return self.__poses.copy()
+
+    def __rows(self, values):
+        """
+        Broadcast values (a scalar, or one value per bee) to an N array.
+        """
+        rows = np.empty(len(self.__names))
+        rows[:] = values
+        return rows
+
+    def set_vels(self, vel_left, vel_right):
+        """
+        Set the wheel velocities of all bees (see :meth:`Bee.set_vel`).
+
+        :param vel_left: Left wheel velocities, one per bee (or a single value for all).
+        :param vel_right: Right wheel velocities, one per bee (or a single value for all).
+        """
+        vel_left = self.__rows(vel_left)
+        vel_right = self.__rows(vel_right)
+        vel = dev_msgs_pb2.DiffDrive()
+        for (name, left, right) in zip(self.__names, vel_left, vel_right):
+            vel.vel_left = left
+            vel.vel_right = right
+            self.__pub.send_multipart([name, 'Base', 'Vel', vel.SerializeToString()])
+
+    def set_colors(self, r = 0.93, g = 0.79, b = 0):
+        """
+        Set the colors of all bees (see :meth:`Bee.set_color`).
+
+        :param r: Red component intensities, between 0 and 1, one per bee (or a single value for all).
+        :param g: Green component intensities.
+        :param b: Blue component intensities.
+        """
+        (r, g, b) = [np.clip(self.__rows(c), 0, 1) for c in (r, g, b)]
+        color = base_msgs_pb2.ColorStamped()
+        for (i, name) in enumerate(self.__names):
+            color.color.red = r[i]
+            color.color.green = g[i]
+            color.color.blue = b[i]
+            self.__pub.send_multipart([name, 'Color', 'Set', color.SerializeToString()])
+
 
 if __name__ == '__main__':
     
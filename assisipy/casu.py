@@ -6,6 +6,7 @@
 import threading
 import time
 import sys
+from collections import deque, OrderedDict, namedtuple
 
 import zmq
 
@@ -13,11 +14,13 @@ import yaml # For parsing configuration (.rtc) files
 
 # For logging
 from datetime import datetime
-import csv
+import logger
 
 from msg import dev_msgs_pb2
 from msg import base_msgs_pb2
 
+import comm
+
 # Device ID definitions (for convenience)
 
 """ IR range sensors """
@@ -87,20 +90,153 @@ VIBE_FREQ_MAX = 1500
 VIBE_PERIOD_MIN = 100
 VIBE_AMP_MAX = 50
 
+# Inter-casu message queue ordering
+MSG_FIFO = 'fifo'
+""" Read inter-casu messages in the order they were received """
+MSG_LIFO = 'lifo'
+""" Read the most recently received inter-casu message first """
+MSG_LATEST = 'latest'
+""" Keep only the latest inter-casu message from each sender """
+
+MSG_QUEUE_LEN = 1000
+"""
+Default maximum number of queued inter-casu messages.
+"""
+
+def _setpoint_rows(dev, on, fields = None):
+    """
+    Returns a log row formatter for actuator setpoint frames.
+
+    :param string dev: Actuator device name.
+    :param bool on: Actuator state.
+    :param fields: A function returning the list of setpoint values to log.
+    """
+    state = '1' if on else '0'
+    if fields is None:
+        return lambda t, msg: [[dev, t, state]]
+    return lambda t, msg: [[dev, t, state] + fields(msg)]
+
+class Snapshot(namedtuple('Snapshot',
+                           ['ir_range', 'ir_raw', 'temp', 'fft_freq', 'fft_amp',
+                            'ir_time', 'temp_time', 'fft_time',
+                            'ir_seq', 'temp_seq', 'fft_seq'])):
+    """
+    An immutable record of all current Casu sensor readings.
+
+    Readings are tuples, indexed in the same way as the corresponding
+    sensor arrays (e.g. ``snapshot.temp[TEMP_WAX - TEMP_F]``), and are
+    empty until the first frame from the device is received.
+    For each device (``ir``, ``temp``, ``fft``), ``<device>_time`` is
+    the local time the readings were received at, and ``<device>_seq``
+    is the number of frames received from the device so far.
+    """
+    __slots__ = ()
+
+class MessageQueue:
+    """
+    Bounded queue of inter-casu messages.
+
+    When the queue is full, the oldest message is dropped.
+    The queue is not thread-safe; :class:`Casu` protects it with its lock.
+
+    :param int maxlen: Maximum number of queued messages (None for unbounded).
+    :param string order: Message ordering, one of MSG_FIFO, MSG_LIFO or MSG_LATEST.
+    """
+
+    def __init__(self, maxlen = MSG_QUEUE_LEN, order = MSG_LIFO):
+        if order not in [MSG_FIFO, MSG_LIFO, MSG_LATEST]:
+            raise ValueError('Unknown message queue order {0}!'.format(order))
+        self.__maxlen = maxlen
+        self.__order = order
+        if order == MSG_LATEST:
+            # Senders, ordered by the time of their latest message
+            self.__queue = OrderedDict()
+        else:
+            self.__queue = deque(maxlen = maxlen)
+        self.dropped = 0
+        """ Number of messages dropped because the queue was full """
+        self.replaced = 0
+        """ Number of messages replaced by a newer one from the same sender (MSG_LATEST only) """
+
+    def __len__(self):
+        return len(self.__queue)
+
+    def put(self, msg):
+        """
+        Add a message to the queue.
+        """
+        if self.__order == MSG_LATEST:
+            if msg['sender'] in self.__queue:
+                del self.__queue[msg['sender']]
+                self.replaced += 1
+            elif len(self.__queue) == self.__maxlen:
+                self.__queue.popitem(last = False)
+                self.dropped += 1
+            self.__queue[msg['sender']] = msg
+        else:
+            if len(self.__queue) == self.__maxlen:
+                # The deque drops the oldest message by itself
+                self.dropped += 1
+            self.__queue.append(msg)
+
+    def get(self):
+        """
+        Remove and return the next message, or None if the queue is empty.
+        """
+        if not self.__queue:
+            return None
+        if self.__order == MSG_FIFO:
+            return self.__queue.popleft()
+        elif self.__order == MSG_LIFO:
+            return self.__queue.pop()
+        else:
+            return self.__queue.popitem(last = False)[1]
+
+    def get_many(self, max_n = None):
+        """
+        Remove and return up to max_n messages (all of them if max_n is None).
+        """
+        n = len(self.__queue)
+        if max_n is not None:
+            n = min(n, max_n)
+        return [self.get() for i in range(n)]
+
 class Casu:
     """
     The low-level interface to Casu devices.
 
     Initializes the object and starts listening for data.
     The fully constructed object is returned only after
-    the data connection has been established.
+    the data connection has been established (and, if the controller
+    is run with a synchronized start, after the start signal,
+    see :func:`comm.wait_for_start`), unless it is
+    created with :meth:`connect_async`.
 
     :param string rtc_file_name: Name of the run-time configuration (RTC) file. If no file is provided, the default configuration is used; if `name` is provided, this parameter is ignored (and no RTC file is read).
     :param string name: Casu name (note: this value takes precedence over `rtc_file_name` if both provided: thus no RTC file is read)
     :param bool log: A variable indicating whether to log all incoming and outgoing data. If set to true, a logfile in the form 'YYYY-MM-DD-HH-MM-SS-name.csv' is created.
+    :param string log_folder: Folder to store the logfile in.
+    :param string log_format: Logfile format, logger.LOG_CSV (default) or logger.LOG_BIN (compact binary records, stored in a '.bin' file).
+    :param float log_flush_interval: Maximum time (in seconds) before logged data is written to the file. Data is written by a background thread.
+    :param float log_rotate_interval: If set, start a new logfile segment every log_rotate_interval seconds. Segments are named 'YYYY-MM-DD-HH-MM-SS-name.NNNN.csv'.
+    :param int log_rotate_size: If set, start a new logfile segment when the current one reaches log_rotate_size bytes.
+    :param bool log_compress: Gzip the logfile segments once they are closed.
+    :param int log_keep: If set, keep only the log_keep most recent logfile segments, deleting older ones.
+    :param int msg_queue_len: Maximum number of queued inter-casu messages; when the queue is full, the oldest message is dropped.
+    :param string msg_order: Inter-casu message ordering: MSG_LIFO (newest first, default), MSG_FIFO (oldest first) or MSG_LATEST (only the latest message from each sender).
+    :param bool msg_timestamps: Send the send time with each inter-casu message, for the latency statistics of the receivers (see :meth:`get_message_stats`). Off by default, because neighbors running an older assisipy version can not receive such messages.
+    :param CasuGroup group: The group this Casu belongs to. Group members share the group's ZMQ context and receive thread, and are returned without waiting for the connection (the group does the waiting). Normally set by :class:`CasuGroup` only.
+    :param float timeout: Maximum time (in seconds) to wait for the connection; :class:`comm.ConnectionTimeout` is raised if no data is received from the Casu in time. None waits forever.
+    :param bool wait: Wait for the connection (see :meth:`connect_async`).
     """
 
-    def __init__(self, rtc_file_name='casu.rtc', name = '', log = False, log_folder = '.'):
+    def __init__(self, rtc_file_name='casu.rtc', name = '', log = False, log_folder = '.',
+                 log_format = logger.LOG_CSV, log_flush_interval = 1.0,
+                 log_rotate_interval = None, log_rotate_size = None,
+                 log_compress = False, log_keep = None,
+                 msg_queue_len = MSG_QUEUE_LEN, msg_order = MSG_LIFO,
+                 msg_timestamps = False, group = None,
+                 timeout = None, wait = True):
 
 
         if name:
@@ -137,21 +273,22 @@ class Casu:
 
         # Actuator setpoint buffers
         self.__peltier_setpoint = dev_msgs_pb2.Temperature()
-        self.__peltier_on = False
         self.__airflow_setpoint = dev_msgs_pb2.Airflow()
-        self.__airflow_on = False
         self.__diagnostic_led_setpoint = base_msgs_pb2.ColorStamped()
-        self.__diagnostic_led_on = False
         self.__speaker_setpoint = dev_msgs_pb2.VibrationSetpoint()
-        self.__speaker_on = False
         self.__vibration_pattern = dev_msgs_pb2.VibrationPattern()
-        self.__vibration_pattern_on = False
 
         # Create the data update thread
-        self.__connected = False
-        self.__context = zmq.Context(1)
-        self.__comm_thread = threading.Thread(target=self.__update_readings)
-        self.__comm_thread.daemon = True
+        # (group members are updated from the group's thread)
+        self.__connected = threading.Event()
+        self.__announced = False
+        self.__group = group
+        if group is None:
+            self.__context = zmq.Context(1)
+            self.__comm_thread = threading.Thread(target=self.__update_readings)
+            self.__comm_thread.daemon = True
+        else:
+            self.__context = group.context()
         self.__lock =threading.Lock()
 
         # Set up logging
@@ -161,12 +298,58 @@ class Casu:
             now_str = now_str.replace(' ','-').replace(':','-')
             if log_folder[-1] != '/':
                 log_folder = log_folder + '/'
-            self.log_path = log_folder + now_str + '-' + self.__name + '.csv'
-            self.__logfile = open(self.log_path,'wb')
-            self.__logger = csv.writer(self.__logfile,delimiter=';')
+            self.log_path = log_folder + now_str + '-' + self.__name + '.' + log_format
+            self.__logger = logger.LogWriter(self.log_path, log_format, log_flush_interval,
+                                             rotate_interval = log_rotate_interval,
+                                             rotate_size = log_rotate_size,
+                                             compress = log_compress, keep = log_keep)
+
+        # Latest sensor readings, replaced as a whole
+        # by the receive thread on each sensor frame
+        self.__snapshot = Snapshot((), (), (), (), (), 0.0, 0.0, 0.0, 0, 0, 0)
+
+        # Incoming message handlers
+        # (adding a device means adding its entries here)
+        self.__messages = comm.MessageTable(self.__lock, self.__name,
+                                            self.__write_to_log if log else None)
+        self.__messages.add('IR', 'Ranges', self.__ir_range_readings,
+                            rows = lambda t, m: [['ir_range', t] + list(m.range),
+                                                 ['ir_raw', t] + list(m.raw_value)])
+        self.__messages.add('Temp', 'Temperatures', self.__temp_readings,
+                            rows = lambda t, m: [['temp', t] + list(m.temp)])
+        # Assuming there is only one FFT reading (one accelerometer)
+        self.__messages.add('Fft', 'Measurements', self.__vibe_readings,
+                            rows = lambda t, m: [['fft_freq', t] + list(m.reading[0].freq),
+                                                 ['fft_amp', t] + list(m.reading[0].amplitude)])
+        # TODO: remove this as soon as simulator is updated
+        self.__messages.ignore('Acc')
+        for (cmd, on) in [('On', True), ('Off', False)]:
+            self.__messages.add('Peltier', cmd, self.__peltier_setpoint, on,
+                                _setpoint_rows('Peltier', on, lambda m: [m.temp]))
+            self.__messages.add('Airflow', cmd, self.__airflow_setpoint, on,
+                                _setpoint_rows('Airflow', on, lambda m: [m.intensity]))
+            self.__messages.add('DiagnosticLed', cmd, self.__diagnostic_led_setpoint, on,
+                                _setpoint_rows('DiagnosticLed', on,
+                                               lambda m: [m.color.red, m.color.green, m.color.blue]))
+            self.__messages.add('Speaker', cmd, self.__speaker_setpoint, on,
+                                _setpoint_rows('Speaker', on, lambda m: [m.freq, m.amplitude]))
+        self.__messages.add('VibrationPattern', 'On', self.__vibration_pattern, True,
+                            _setpoint_rows('VibrationPattern', True,
+                                           lambda m: (list(m.vibe_periods) + list(m.vibe_freqs)
+                                                      + list(m.vibe_amps))))
+        self.__messages.add('VibrationPattern', 'Off', self.__vibration_pattern, False,
+                            _setpoint_rows('VibrationPattern', False))
+        for dev in ['IR', 'Temp', 'Fft']:
+            self.__messages.add_callback(dev, self.__update_snapshot)
 
         # Create inter-casu communication sockets
-        self.__msg_queue = []
+        self.__msg_queue = MessageQueue(msg_queue_len, msg_order)
+        self.__msg_timestamps = msg_timestamps
+        self.__msg_received = 0
+        self.__msg_timed = 0
+        self.__msg_latency_last = 0.0
+        self.__msg_latency_sum = 0.0
+        self.__msg_latency_max = 0.0
         if self.__msg_pub_addr and self.__neighbors:
             self.__msg_pub = self.__context.socket(zmq.PUB)
             try:
@@ -191,12 +374,46 @@ class Casu:
             print('CONNECTION ERROR: Failed to connect to {0}'.format(self.__pub_addr))
             sys.exit(1)
 
-        # Connect to the device and start receiving data
-        self.__comm_thread.start()
-        # Wait for the connection
-        while not self.__connected:
-            time.sleep(1)
-        print('{0} connected!'.format(self.__name))
+        if group is None:
+            # Connect to the device and start receiving data
+            self.__comm_thread.start()
+            if wait:
+                try:
+                    self.wait_connected(timeout)
+                except comm.ConnectionTimeout:
+                    # Nobody will stop the receive thread
+                    # and release the connections otherwise
+                    self.__stop = True
+                    self.__comm_thread.join()
+                    self._close()
+                    raise
+
+    @classmethod
+    def connect_async(cls, *args, **kwargs):
+        """
+        Create a Casu interface without waiting for the connection;
+        call :meth:`wait_connected` (or :func:`comm.wait_all`) before using it.
+        Takes the same parameters as the constructor.
+
+        Use this to connect many Casus at the same time.
+        """
+        kwargs['wait'] = False
+        return cls(*args, **kwargs)
+
+    def wait_connected(self, timeout = None):
+        """
+        Block until the data connection has been established,
+        i.e. until data from the Casu has been received.
+
+        :param float timeout: Maximum waiting time in seconds (None waits forever).
+        :raises comm.ConnectionTimeout: If no data was received in time.
+        """
+        comm.wait_ready(self.__connected, timeout, self.__name)
+        if self.__group is None and not self.__announced:
+            self.__announced = True
+            print('{0} connected!'.format(self.__name))
+            # Under a synchronized start, wait for the others
+            comm.wait_for_start(self.__context, self.__name)
 
 
     def __update_readings(self):
@@ -211,142 +428,154 @@ class Casu:
             sys.exit(1) # TODO: This might have some issues, as we're within a thread
         self.__sub.setsockopt(zmq.SUBSCRIBE, self.__name)
 
+        # Wait for sensor data and neighbor messages at the same time,
+        # waking up periodically to be able to stop the thread
+        poller = zmq.Poller()
+        poller.register(self.__sub, zmq.POLLIN)
+        if self.__msg_sub:
+            poller.register(self.__msg_sub, zmq.POLLIN)
+
+        # Health reports (when run under a supervisor)
+        heartbeat = comm.Heartbeat(self.__context, self.__name, self._health)
+
         while not self.__stop:
-            [name, dev, cmd, data] = self.__sub.recv_multipart()
-            self.__connected = True
-            ### Sensor measurements ###
-            if dev == 'IR':
-                if cmd == 'Ranges':
-                    # Protect write with a lock
-                    # to make sure all data is written before access
-                    with self.__lock:
-                        self.__ir_range_readings.ParseFromString(data)
-                    self.__write_to_log(['ir_range', time.time()] + [r for r in self.__ir_range_readings.range])
-                    self.__write_to_log(['ir_raw', time.time()] + [r for r in self.__ir_range_readings.raw_value])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, self.__name))
-            elif dev == 'Temp':
-                if cmd == 'Temperatures':
-                    with self.__lock:
-                        self.__temp_readings.ParseFromString(data)
-                    self.__write_to_log(['temp', time.time()] + [t for t in self.__temp_readings.temp])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, self.__name))
-            elif dev == 'Fft':
-                if cmd == 'Measurements':
-                    with self.__lock:
-                        self.__vibe_readings.ParseFromString(data)
-                    # Assuming there is only one FFT reading (one accelerometer)
-                    reading = self.__vibe_readings.reading[0]
-                    self.__write_to_log(['fft_freq', time.time()] + [f for f in reading.freq])
-                    self.__write_to_log(['fft_amp', time.time()] + [a for a in reading.amplitude])
-            elif dev == "Acc":
-                # TODO: remove this as soon as simulator is updated
-                pass
-
-            ### Actuator setpoints ###
-            elif dev == 'Peltier':
-                if cmd == 'Off':
-                    self.__peltier_on = False
-                    with self.__lock:
-                        self.__peltier_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Peltier', time.time(), '0', self.__peltier_setpoint.temp])
-                elif cmd == 'On':
-                    self.__peltier_on = True
-                    with self.__lock:
-                        self.__peltier_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Peltier', time.time(), '1',  self.__peltier_setpoint.temp])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, dev))
-            elif dev == 'Airflow':
-                if cmd == 'Off':
-                    self.__airflow_on = False
-                    with self.__lock:
-                        self.__airflow_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Airflow', time.time(), '0', self.__airflow_setpoint.intensity])
-                elif cmd == 'On':
-                    self.__airflow_on = True
-                    with self.__lock:
-                        self.__airflow_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Airflow', time.time(), '1', self.__airflow_setpoint.intensity])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, dev))
-            elif dev == 'DiagnosticLed':
-                if cmd == 'Off':
-                    self.__diagnostic_led_on = False
-                    with self.__lock:
-                        self.__diagnostic_led_setpoint.ParseFromString(data)
-                    self.__write_to_log(['DiagnosticLed', time.time(), '0'] +
-                                        [self.__diagnostic_led_setpoint.color.red,
-                                         self.__diagnostic_led_setpoint.color.green,
-                                         self.__diagnostic_led_setpoint.color.blue])
-                elif cmd == 'On':
-                    self.__diagnostic_led_on = True
-                    with self.__lock:
-                        self.__diagnostic_led_setpoint.ParseFromString(data)
-                    self.__write_to_log(['DiagnosticLed', time.time(), '1'] +
-                                        [self.__diagnostic_led_setpoint.color.red,
-                                         self.__diagnostic_led_setpoint.color.green,
-                                         self.__diagnostic_led_setpoint.color.blue])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, dev))
-            elif dev == 'Speaker':
-                if cmd == 'Off':
-                    self.__speaker_on = False
-                    with self.__lock:
-                        self.__speaker_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Speaker', time.time(), '0',
-                                         self.__speaker_setpoint.freq,
-                                         self.__speaker_setpoint.amplitude])
-                elif cmd == 'On':
-                    self.__speaker_on = True
-                    with self.__lock:
-                        self.__speaker_setpoint.ParseFromString(data)
-                    self.__write_to_log(['Speaker', time.time(), '1',
-                                         self.__speaker_setpoint.freq,
-                                         self.__speaker_setpoint.amplitude])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, dev))
-            elif dev == 'VibrationPattern':
-                if cmd == 'On':
-                    self.__vibration_pattern_on = True
-                    with self.__lock:
-                        self.__vibration_pattern.ParseFromString(data)
-                    self.__write_to_log(['VibrationPattern', time.time(), '1']
-                                        + [t for t in self.__vibration_pattern.vibe_periods]
-                                        + [f for f in self.__vibration_pattern.vibe_freqs]
-                                        + [a for a in self.__vibration_pattern.vibe_amps])
-                elif cmd == 'Off':
-                    self.__vibration_pattern_on = False
-                    with self.__lock:
-                        self.__vibration_pattern.ParseFromString(data)
-                    self.__write_to_log(['VibrationPattern',time.time(),'0'])
-                else:
-                    print('Unknown command {0} for {1}'.format(cmd, dev))
-            else:
-                print('Unknown device {0} for {1}'.format(dev, self.__name))
+            events = dict(poller.poll(500))
+            if self.__sub in events:
+                [name, dev, cmd, data] = self.__sub.recv_multipart()
+                self._process_frame(dev, cmd, data)
+            if self.__msg_sub in events:
+                self._process_messages()
+            heartbeat.tick()
+        heartbeat.close()
+        self.__sub.close(0)
+
+    def _process_frame(self, dev, cmd, data):
+        """
+        Update local data from a single (dev, cmd, data) frame
+        published by the Casu.
+
+        Called from the receive thread of this Casu,
+        or from the receive thread of its :class:`CasuGroup`.
+        """
+        self.__messages.dispatch(dev, cmd, data)
+        if not self.__connected.is_set():
+            self.__connected.set()
+
+    def __update_snapshot(self, dev):
+        """
+        Replace the snapshot with one containing the readings just received from dev.
+
+        Only called from the receive thread, which is also the only thread
+        writing the readings, so they are read without locking.
+        """
+        now = time.time()
+        seq = self.__messages.count(dev)
+        if dev == 'IR':
+            self.__snapshot = self.__snapshot._replace(
+                ir_range = tuple(self.__ir_range_readings.range),
+                ir_raw = tuple(self.__ir_range_readings.raw_value),
+                ir_time = now, ir_seq = seq)
+        elif dev == 'Temp':
+            self.__snapshot = self.__snapshot._replace(
+                temp = tuple(self.__temp_readings.temp),
+                temp_time = now, temp_seq = seq)
+        elif dev == 'Fft':
+            # Assuming there is only one FFT reading (one accelerometer)
+            reading = self.__vibe_readings.reading[0]
+            self.__snapshot = self.__snapshot._replace(
+                fft_freq = tuple(reading.freq),
+                fft_amp = tuple(reading.amplitude),
+                fft_time = now, fft_seq = seq)
+
+    def _health(self):
+        """
+        Returns the receive statistics reported in heartbeats (see :class:`comm.Heartbeat`).
+
+        Called from the receive thread of this Casu,
+        or from the receive thread of its :class:`CasuGroup`.
+        """
+        log_queue = 0
+        if self.__log:
+            log_queue = self.__logger.stats()['queued']
+        return {'frames': self.__messages.count(),
+                'msg_queue': len(self.__msg_queue),
+                'log_queue': log_queue,
+                'connected': self.__connected.is_set()}
+
+    def _msg_socket(self):
+        """
+        Returns the inter-casu message subscriber socket (None if there are no neighbors).
+        """
+        return self.__msg_sub
+
+    def _process_messages(self):
+        """
+        Move all pending inter-casu messages to the message queue.
 
-            ### Inter-CASU comms ###
-            if self.__msg_sub:
+        Called from the receive thread of this Casu,
+        or from the receive thread of its :class:`CasuGroup`.
+        """
+        received = []
+        latencies = []
+        while True:
+            try:
+                frames = self.__msg_sub.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                # Nobody else is sending us a message. No biggie.
+                break
+            now = time.time()
+            if len(frames) < 4:
+                print('Malformed message for {0} ignored'.format(self.__name))
+                continue
+            received.append({'sender':frames[2], 'data':frames[3]})
+            if len(frames) > 4:
+                # Messages from senders that report the send time
+                # (older senders do not)
                 try:
-                    [name, msg, sender, data] = self.__msg_sub.recv_multipart(zmq.NOBLOCK)
-                    # Protect the message queue update with a lock
-                    with self.__lock:
-                        self.__msg_queue.append({'sender':sender, 'data':data})
-                except zmq.ZMQError:
-                    # Nobody is sending us a message. No biggie.
+                    latencies.append(now - float(frames[4]))
+                except ValueError:
                     pass
 
+        # Protect the message queue update with a lock
+        with self.__lock:
+            for msg in received:
+                self.__msg_queue.put(msg)
+            for latency in latencies:
+                self.__msg_latency_last = latency
+                self.__msg_latency_sum += latency
+                self.__msg_latency_max = max(self.__msg_latency_max, latency)
+            self.__msg_received += len(received)
+            self.__msg_timed += len(latencies)
+
     def __cleanup(self):
         """
         Performs necessary cleanup operations, i.e. stops communication threads,
         closes connections and files.
         """
         # Wait for communicaton threads to finish
-        self.__comm_thread.join()
+        # (the group thread is stopped by the group)
+        if self.__group is None:
+            self.__comm_thread.join()
+
+        if self.__log:
+            self.__logger.close()
 
+    def _close(self):
+        """
+        Closes the connections and the log of a Casu whose receive thread
+        has already stopped, without stopping its devices
+        (used when the connection could not be established).
+
+        The ZMQ context is terminated too, unless it belongs to a :class:`CasuGroup`.
+        """
+        self.__pub.close(0)
+        if self.__msg_sub is not None:
+            self.__msg_pub.close(0)
+            self.__msg_sub.close(0)
         if self.__log:
-            self.__logfile.close()
+            self.__logger.close()
+        if self.__group is None:
+            self.__context.term()
 
     def name(self):
         """
@@ -354,6 +583,12 @@ class Casu:
         """
         return self.__name
 
+    def _sub_address(self):
+        """
+        Returns the address the Casu publishes its data on.
+        """
+        return self.__sub_addr
+
     def stop(self):
         """
         Stops the Casu interface and cleans up.
@@ -370,6 +605,43 @@ class Casu:
         self.__cleanup()
         print('{0} disconnected!'.format(self.__name))
 
+    def wait_for_update(self, device = None, timeout = None):
+        """
+        Block until new data is received from a device.
+
+        Use this to run control loops at the sensor rate,
+        instead of polling the getters with time.sleep().
+
+        :param string device: Device name, as used in the ASSISI protocol
+                              ('IR', 'Temp', 'Fft', 'Peltier', 'Airflow',
+                              'DiagnosticLed', 'Speaker', 'VibrationPattern').
+                              If None, any new data will do.
+        :param float timeout: Maximum waiting time in seconds (None waits forever).
+        :return: True if new data was received, False on timeout.
+        """
+        return self.__messages.wait(device, timeout)
+
+    def on_update(self, device, callback):
+        """
+        Register a function to be called each time new data is received from a device.
+
+        The callback is called as callback(device) from the receive thread,
+        so it should return quickly.
+
+        :param string device: Device name (see :meth:`wait_for_update`); None for all devices.
+        :param callback: The function to call.
+        """
+        self.__messages.add_callback(device, callback)
+
+    def snapshot(self):
+        """
+        Returns the current readings of all sensors as one consistent :class:`Snapshot`.
+
+        The snapshot is built by the receive thread when the readings
+        arrive, so this call neither locks nor copies.
+        """
+        return self.__snapshot
+
     def get_range(self, id):
         """
         Returns the range reading (in cm) corresponding to sensor id.
@@ -379,39 +651,39 @@ class Casu:
            This API call might become deprecated in favor of get_raw_value,
            to better reflect actual sensor capabilities.
         """
-        with self.__lock:
-            if self.__ir_range_readings.range:
-                return self.__ir_range_readings.range[id-IR_F]
-            else:
-                return -1
+        ranges = self.__snapshot.ir_range
+        if ranges:
+            return ranges[id-IR_F]
+        else:
+            return -1
 
     def get_ir_raw_value(self, id):
         """
         Returns the raw value from the IR proximity sensor corresponding to sensor id.
 
         """
-        with self.__lock:
-            if self.__ir_range_readings.raw_value:
-                if id == ARRAY:
-                    return [raw for raw in self.__ir_range_readings.raw_value]
-                else:
-                    return self.__ir_range_readings.raw_value[id-IR_F]
+        raw_values = self.__snapshot.ir_raw
+        if raw_values:
+            if id == ARRAY:
+                return list(raw_values)
             else:
-                return -1
+                return raw_values[id-IR_F]
+        else:
+            return -1
 
     def get_temp(self, id):
         """
         Returns the temperature reading of sensor id.
 
          """
-        with self.__lock:
-            if self.__temp_readings.temp:
-                if id == ARRAY:
-                    return [t for t in self.__temp_readings.temp]
-                else:
-                    return self.__temp_readings.temp[id - TEMP_F]
+        temps = self.__snapshot.temp
+        if temps:
+            if id == ARRAY:
+                return list(temps)
             else:
-                return -1
+                return temps[id - TEMP_F]
+        else:
+            return -1
 
     def set_temp(self, temp, id = PELTIER_ACT, slope = 0.025):
         """
@@ -454,7 +726,7 @@ class Casu:
         :return: (temp,on) tuple, where temp is the temperature setpoint,
         and on is True if the actuator is switched on.
         """
-        return(self.__peltier_setpoint.temp,self.__peltier_on)
+        return(self.__peltier_setpoint.temp, self.__messages.is_on('Peltier'))
 
     def set_speaker_vibration(self, freq, intens,  id = VIBE_ACT):
         """
@@ -505,7 +777,7 @@ class Casu:
         """
         Returns the speaker state.
         """
-        return self.__speaker_on
+        return self.__messages.is_on('Speaker')
 
     def set_vibration_pattern(self, vibe_periods, vibe_freqs, vibe_amps, id = VIBE_ACT):
         """
@@ -591,12 +863,11 @@ class Casu:
 
         Returns
         -------
-        tuple of lists: frequencies and amplitudes of 4 dominant FFT spectrum components
+        tuple of tuples: frequencies and amplitudes of 4 dominant FFT spectrum components
             (freqs, amps)
         """
-
-        return (self.__vibe_readings.reading[0].freq,
-                self.__vibe_readings.reading[0].amplitude)
+        snapshot = self.__snapshot
+        return (snapshot.fft_freq, snapshot.fft_amp)
 
     def set_diagnostic_led_rgb(self, r = 0, g = 0, b = 0, id = DLED_TOP):
         """
@@ -636,7 +907,7 @@ class Casu:
 
         :return: True/False
         """
-        return self.__diagnostic_led_on
+        return self.__messages.is_on('DiagnosticLed')
 
     def diagnostic_led_standby(self, id = DLED_TOP):
         """
@@ -672,7 +943,7 @@ class Casu:
         """
         Get the state of the airflow actuator.
         """
-        return self.__airflow_on
+        return self.__messages.is_on('Airflow')
 
     def airflow_standby(self, id  = AIRFLOW_ACT):
         """
@@ -703,22 +974,25 @@ class Casu:
         """
         success = False
         if direction in self.__neighbors:
-            self.__msg_pub.send_multipart([self.__neighbors[direction]['name'], 'Message',
-                                           self.__name, msg])
+            frames = [self.__neighbors[direction]['name'], 'Message', self.__name, msg]
+            if self.__msg_timestamps:
+                frames.append(repr(time.time()))
+            self.__msg_pub.send_multipart(frames)
             success = True
 
         return success
 
     def read_message(self):
         """
-        Retrieve the latest message from the buffer.
+        Retrieve the next message from the buffer
+        (by default the latest one, see the `msg_order` constructor parameter).
 
         Returns a dictionary with sender(string), and data (string) fields.
         """
         msg = []
         if self.__msg_queue:
             with self.__lock:
-                msg = self.__msg_queue.pop()
+                msg = self.__msg_queue.get()
 
                 # attempt to find the label (logical name for neighbour) from
                 # the records found in the RTC file (now part of the Casu
@@ -727,12 +1001,68 @@ class Casu:
 
         return msg
 
+    def read_messages(self, max_n = None):
+        """
+        Retrieve up to max_n messages from the buffer (all of them if max_n is None),
+        in the order defined by the `msg_order` constructor parameter.
+
+        Returns a list of dictionaries with sender(string), data (string)
+        and label (string) fields.
+        """
+        with self.__lock:
+            msgs = self.__msg_queue.get_many(max_n)
+        for msg in msgs:
+            msg['label'] = self.__phys_logi_map.get(msg['sender'], None)
+
+        return msgs
+
+    def get_message_stats(self):
+        """
+        Get inter-casu message statistics.
+
+        The latency is measured from the moment the neighbor sent the
+        message until it was moved to the message queue, so it includes
+        the clock offset between the sending and the receiving CASU.
+        It is measured only for the messages of neighbors created with
+        `msg_timestamps` set.
+
+        :return: A dictionary with the number of received (`received`),
+                 queued (`queued`), dropped on queue overflow (`dropped`)
+                 and replaced by a newer message from the same sender (`replaced`)
+                 messages, and the last, mean and maximum
+                 send-to-receive latency in seconds
+                 (`latency_last`, `latency_mean`, `latency_max`).
+        """
+        with self.__lock:
+            mean = 0.0
+            if self.__msg_timed:
+                mean = self.__msg_latency_sum / self.__msg_timed
+            return {'received': self.__msg_received,
+                    'queued': len(self.__msg_queue),
+                    'dropped': self.__msg_queue.dropped,
+                    'replaced': self.__msg_queue.replaced,
+                    'latency_last': self.__msg_latency_last,
+                    'latency_mean': mean,
+                    'latency_max': self.__msg_latency_max}
+
+    def get_log_stats(self):
+        """
+        Get logging statistics.
+
+        :return: A dictionary with the number of queued (`queued`),
+                 written (`written`) and dropped (`dropped`) log rows
+                 (see :meth:`logger.LogWriter.stats`), or None if logging is disabled.
+        """
+        if self.__log:
+            return self.__logger.stats()
+        return None
+
     def __write_to_log(self, data):
         """
-        Write one line of data to the logfile.
+        Queue one line of data for writing to the logfile.
         """
         if self.__log:
-            self.__logger.writerow(data)
+            self.__logger.write(data)
 
     def __read_comm_links(self, rtc):
         '''
@@ -754,6 +1084,193 @@ class Casu:
         return phys_logi_map
 
 
+class CasuGroup:
+    """
+    A group of Casu interfaces served by a single ZMQ context,
+    a single data subscriber socket and a single receive thread.
+
+    Use this instead of many individual Casu objects when one controller
+    manages many CASUs; the number of threads then stays constant as the
+    group grows. Members are ordinary :class:`Casu` objects, and
+    are accessed by name::
+
+        group = CasuGroup(rtc_file_names = ['casu-001.rtc', 'casu-002.rtc'])
+        group['casu-001'].set_diagnostic_led_rgb(r = 1)
+        for c in group:
+            print(c.get_temp(TEMP_WAX))
+
+    The fully constructed group is returned only after data from all
+    members has been received (and, under a synchronized start,
+    after the start signal).
+
+    Logging is the exception: each member logs to a logfile of its own,
+    written by a :class:`logger.LogWriter` thread of its own (plus
+    a compression thread, with `log_compress`), so with `log` set
+    a group of n members runs up to 2n more threads. Log only the members
+    you need (create the others in a separate group), or use longer
+    `log_flush_interval` values to keep these threads mostly idle.
+
+    :param list rtc_file_names: RTC file names of the member Casus.
+    :param list names: Names of member Casus using the default configuration (see :class:`Casu`).
+    :param float timeout: Maximum time (in seconds) to wait for data from all members; :class:`comm.ConnectionTimeout` is raised if some are missing by then. None waits forever.
+    :param dict kwargs: Other :class:`Casu` constructor parameters (e.g. `log`, `log_folder`, `msg_order`), applied to all members.
+    """
+
+    def __init__(self, rtc_file_names = [], names = [], timeout = None, **kwargs):
+
+        if not rtc_file_names and not names:
+            # Nobody would ever connect
+            raise ValueError('A Casu group needs at least one member!')
+        self.__context = zmq.Context(1)
+        self.__stop = False
+
+        # Create the members; they do not wait for the
+        # connection, because nobody is receiving their data yet
+        self.__names = []
+        self.__casus = {}
+        members = ([{'rtc_file_name': rtc} for rtc in rtc_file_names] +
+                   [{'name': name} for name in names])
+        for member in members:
+            member.update(kwargs)
+            casu = Casu(group = self, **member)
+            if casu.name() in self.__casus:
+                raise ValueError('Duplicate Casu name {0} in group!'.format(casu.name()))
+            self.__names.append(casu.name())
+            self.__casus[casu.name()] = casu
+
+        # Names of the Casus we have received data from
+        self.__connected = set()
+        self.__all_connected = threading.Event()
+        self.__comm_thread = threading.Thread(target=self.__update_readings)
+        self.__comm_thread.daemon = True
+        self.__comm_thread.start()
+
+        # Wait for the connection
+        try:
+            comm.wait_ready(self.__all_connected, timeout, 'group members')
+        except comm.ConnectionTimeout:
+            self.__close()
+            raise comm.ConnectionTimeout(', '.join([name for name in self.__names
+                                                    if name not in self.__connected]), timeout)
+        print('{0} connected!'.format(', '.join(self.__names)))
+        # Under a synchronized start, wait for the others
+        try:
+            comm.wait_for_start(self.__context, ','.join(self.__names))
+        except comm.ConnectionTimeout:
+            self.__close()
+            raise
+
+    def __close(self):
+        """
+        Stops the group receive thread and closes the connections of all
+        members, without stopping their devices (used when the connection
+        could not be established).
+        """
+        self.__stop = True
+        self.__comm_thread.join()
+        for casu in self.casus():
+            casu._close()
+        self.__context.term()
+
+    def __update_readings(self):
+        """
+        Get data from all member Casus and dispatch it to the members.
+        """
+        self.__sub = self.__context.socket(zmq.SUB)
+        addresses = set([casu._sub_address() for casu in self.__casus.values()])
+        for address in addresses:
+            try:
+                self.__sub.connect(address)
+            except zmq.error.ZMQError:
+                print('CONNECTION ERROR: Failed to connect to {0}'.format(address))
+                sys.exit(1) # TODO: This might have some issues, as we're within a thread
+        for name in self.__names:
+            self.__sub.setsockopt(zmq.SUBSCRIBE, name)
+
+        # Wait for sensor data and neighbor messages of all members,
+        # waking up periodically to be able to stop the thread
+        # even if no data is coming in
+        poller = zmq.Poller()
+        poller.register(self.__sub, zmq.POLLIN)
+        msg_sockets = {}
+        for casu in self.__casus.values():
+            if casu._msg_socket():
+                msg_sockets[casu._msg_socket()] = casu
+                poller.register(casu._msg_socket(), zmq.POLLIN)
+
+        # Health reports (when run under a supervisor), summed over the members
+        heartbeat = comm.Heartbeat(self.__context, ','.join(self.__names), self.__health)
+
+        while not self.__stop:
+            events = dict(poller.poll(500))
+            if self.__sub in events:
+                [name, dev, cmd, data] = self.__sub.recv_multipart()
+                # Subscriptions are prefix matches (casu-1 also matches casu-10),
+                # so dispatch on the exact name
+                casu = self.__casus.get(name)
+                if casu is not None:
+                    casu._process_frame(dev, cmd, data)
+                    if name not in self.__connected:
+                        self.__connected.add(name)
+                        if len(self.__connected) == len(self.__names):
+                            self.__all_connected.set()
+            for socket in events:
+                if socket in msg_sockets:
+                    msg_sockets[socket]._process_messages()
+            heartbeat.tick()
+        heartbeat.close()
+        self.__sub.close(0)
+
+    def __health(self):
+        """
+        Returns the receive statistics of all members, for the heartbeats.
+        """
+        health = {'frames': 0, 'msg_queue': 0, 'log_queue': 0,
+                  'connected': len(self.__connected) == len(self.__names)}
+        for casu in self.__casus.values():
+            member = casu._health()
+            for key in ['frames', 'msg_queue', 'log_queue']:
+                health[key] += member[key]
+        return health
+
+    def context(self):
+        """
+        Returns the ZMQ context shared by all group members.
+        """
+        return self.__context
+
+    def names(self):
+        """
+        Returns the names of the member Casus.
+        """
+        return list(self.__names)
+
+    def casus(self):
+        """
+        Returns the list of member Casus.
+        """
+        return [self.__casus[name] for name in self.__names]
+
+    def __getitem__(self, name):
+        return self.__casus[name]
+
+    def __contains__(self, name):
+        return name in self.__casus
+
+    def __iter__(self):
+        return iter(self.casus())
+
+    def __len__(self):
+        return len(self.__names)
+
+    def stop(self):
+        """
+        Stops all member Casus and the group receive thread.
+        """
+        for casu in self.casus():
+            casu.stop()
+        self.__stop = True
+        self.__comm_thread.join()
 
 
 if __name__ == '__main__':
@@ -5,11 +5,19 @@
 Tool for collecting data logged by CASUs after an experiment.
 """
 
-import yaml
-from fabric.api import get, run, settings
 import warnings
 import argparse
 import os, errno
+import time
+import pipes
+
+import remote
+from project import Project
+
+LOG_PATTERNS = ['*.csv', '*.bin', '*.csv.gz', '*.bin.gz']
+"""
+CASU logfile name patterns (text and binary logs, plain or compressed).
+"""
 
 def mkdir_p(path):
     '''
@@ -55,42 +63,38 @@ class DataCollector:
 
         self.collected = False
 
-        with open(project_file_name) as project_file:
-            project = yaml.safe_load(project_file)
-
-        # Read the .arena file
-        with open(os.path.join(self.project_root, project['arena'])) as arena_file:
-            self.arena = yaml.safe_load(arena_file)
+        # Read the .arena and deployment files
+        project = Project(project_file_name)
+        self.arena = project.arena
+        self.dep = project.dep
 
-        # Read the deployment file
-        with open(os.path.join(self.project_root, project['dep'])) as dep_file:
-            self.dep = yaml.safe_load(dep_file)
-
-    def collect(self, layer_select='all'):
+    def collect(self, layer_select='all', jobs=1, per_host=remote.PER_HOST,
+                incremental=False, compress=False):
         """
         Collect the data to the local machine.
-        """
 
-        # Create data folder on local machine
-        cwd = os.getcwd()
-        if cwd != self.project_root and not self.custom_logpath:
-        ##if cwd != self.project_root :
-            print('Changing directory to {0}'.format(self.project_root))
-            os.chdir(self.project_root)
+        The CASUs are processed by a pool of jobs threads. Each host is
+        connected to once, and at most per_host CASUs are processed
+        on the same host at the same time.
 
+        In incremental mode, only the data appended to the files since
+        they were last collected (and changed files) are transferred
+        (see :func:`remote.sync`). With compress, the data is gzipped
+        in transit.
+        """
 
+        # Create data folder on local machine
+        # (data_dir is relative to the project root, unless it is a custom path)
+        data_dir = os.path.join(self.project_root, self.data_dir)
         try:
             # attempt to create data directory (func is recursive if necessary)
-            mkdir_p(self.data_dir)
-            #os.mkdir(self.data_dir)
-            print('Created folder {0}.'.format(self.data_dir))
+            mkdir_p(data_dir)
+            print('Created folder {0}.'.format(data_dir))
         except OSError:
             # The data directory already exists
             # that's ok
             pass
 
-        os.chdir(self.data_dir)
-
         # Select particular layers
         selected_layers = self.dep.keys()
         if layer_select != 'all':
@@ -101,42 +105,53 @@ class DataCollector:
                         layer_select))
 
         # Download the data from deployment targets
-        for layer in selected_layers:
-        #for layer in self.dep:
+        tasks = [(layer, casu) for layer in selected_layers for casu in self.dep[layer]]
+        pool = remote.ConnectionPool(per_host)
+        stats = remote.TransferStats()
+        try:
+            for ((layer, casu), result, error) in remote.run_tasks(
+                    lambda task: self.__collect_casu(pool, stats, data_dir, incremental,
+                                                 compress, *task), tasks, jobs):
+                if error is not None:
+                    print('[E] Collecting data from {0}/{1} failed: {2}'.format(layer, casu, error))
+                    stats.fail(self.dep[layer][casu]['hostname'], layer + '/' + casu, error)
+                else:
+                    print('Collected {0} new or changed files from {1}/{2}.'.format(result, layer, casu))
+        finally:
+            pool.close()
+
+        stats.report()
+        self.collected = stats.failures() == 0
+
+    def __collect_casu(self, pool, stats, data_dir, incremental, compress, layer, casu):
+        """
+        Download the data of one CASU.
+
+        :return: The number of downloaded files.
+        """
+        spec = self.dep[layer][casu]
+        local_dir = os.path.join(data_dir, layer, casu)
+        mkdir_p(local_dir)
+        remote_dir = os.path.join(spec['prefix'], layer, casu)
+        patterns = LOG_PATTERNS + spec.get('results', [])
+
+        with pool.slot(spec['hostname']):
+            connection = pool.get(spec['hostname'], spec['user'])
+            start = time.time()
+            sftp = connection.sftp()
             try:
-                os.mkdir(layer)
-                print('Created folder {0}.'.format(layer))
-            except OSError:
-                # The directory already exists
-                pass
-            os.chdir(layer)
-            for casu in self.dep[layer]:
-                try:
-                    os.mkdir(casu)
-                    print('Created folder {0}.'.format(casu))
-                except OSError:
-                    # The directory already exists
-                    pass
-                os.chdir(casu)
-                with settings(host_string = self.dep[layer][casu]['hostname'],
-                              user = self.dep[layer][casu]['user'],
-                              warn_only = True):
-                    patterns = (['*.csv',] +
-                            self.dep[layer][casu].get('results', []) )
-
-                    for pattern in patterns:
-                        targetfiles = os.path.join(self.dep[layer][casu]['prefix'],
-                                layer, casu, pattern)
-                        get(targetfiles,'.')
-                        if self.clean:
-                            run('rm ' + targetfiles)
-
-                os.chdir('..')
-
-            os.chdir('..')
-
-        # Return to the original directory
-        os.chdir(cwd)
+                found = remote.glob(sftp, remote_dir, patterns)
+                (nfiles, nbytes) = remote.sync(connection, sftp, found, local_dir,
+                                               incremental, compress)
+            finally:
+                sftp.close()
+            stats.add(spec['hostname'], nbytes, nfiles, start, time.time())
+
+            if self.clean and found:
+                connection.check_run('rm -r ' + ' '.join(
+                    [pipes.quote(path) for (path, attr) in found]))
+
+        return nfiles
 
 
 def main():
@@ -150,12 +165,23 @@ def main():
                         help='Remove original log files after copying.')
     parser.add_argument('--layer', default='all',
                         help='Name of single layer to collect data for')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Number of CASUs to collect data from concurrently.')
+    parser.add_argument('--per-host', type=int, default=remote.PER_HOST,
+                        help='Maximum number of CASUs to collect data from '
+                        'concurrently on the same host.')
+    parser.add_argument('-i', '--incremental', action='store_true', default=False,
+                        help='Only transfer the data appended to the logs since '
+                        'they were last collected, and changed files.')
+    parser.add_argument('-z', '--compress', action='store_true', default=False,
+                        help='Compress the data in transit.')
     args = parser.parse_args()
     dc = DataCollector(args.project, args.clean, args.logpath)
     with warnings.catch_warnings():
         warnings.filterwarnings(
             action="ignore", category=FutureWarning, module="Crypto", lineno=141)
-        dc.collect(args.layer)
+        dc.collect(args.layer, args.jobs, args.per_host,
+                   args.incremental, args.compress)
 
 if __name__ == '__main__':
     main()
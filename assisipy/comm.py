@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Communication helpers shared by the interfaces to ASSISI system
+components (CASUs, simulated bees, simulator control).
+
+Also implements the synchronized start of CASU controllers: when a
+controller is run with the :data:`START_ADDR_ENV` environment variable
+set (e.g. by ``assisirun --sync``), it reports being ready as soon as its
+:class:`casu.Casu` (or :class:`casu.CasuGroup`) is connected, and then
+waits until a :class:`StartBarrier` releases all the controllers at once
+(controllers that get ready after that are released as they come).
+
+Similarly, when run with :data:`SUPERVISOR_ADDR_ENV` set (by
+``assisirun --supervise``), the receive thread of each :class:`casu.Casu`
+(or :class:`casu.CasuGroup`) sends periodic :class:`Heartbeat` reports to
+the supervisor.
+"""
+
+import os
+import json
+import threading
+import time
+
+import zmq
+
+START_ADDR_ENV = 'ASSISI_START_ADDR'
+""" Environment variable with the address of the start barrier """
+SUPERVISOR_ADDR_ENV = 'ASSISI_SUPERVISOR_ADDR'
+""" Environment variable with the address heartbeats are sent to """
+CONTROLLER_ID_ENV = 'ASSISI_CONTROLLER_ID'
+""" Environment variable with the name of the controller, as known to the start barrier and the supervisor """
+START_TIMEOUT_ENV = 'ASSISI_START_TIMEOUT'
+""" Environment variable with the maximum time (in seconds) to wait for the start signal """
+
+HEARTBEAT_INTERVAL = 1.0
+""" Interval (in seconds) between heartbeats """
+
+START_RESEND = 0.1
+""" Interval (in seconds) of repeating the start signal, until all controllers acknowledge it """
+
+# Set once this process has been released by the start barrier
+_started = False
+
+class MessageTable:
+    """
+    Dispatch table for incoming (dev, cmd, data) frames.
+
+    Maps each (dev, cmd) pair to a pre-bound handler, so the per-frame
+    cost is a single dictionary lookup. A handler parses the data into
+    its target protobuf buffer (under the lock), updates the on/off state
+    of the device and formats the log rows for the frame.
+
+    :param threading.Lock lock: The lock protecting the buffers.
+    :param string owner: Owner name, used in warnings about unknown frames.
+    :param log: A function writing one row to the log, or None if logging is disabled.
+    """
+
+    def __init__(self, lock, owner, log = None):
+        self.__lock = lock
+        self.__owner = owner
+        self.__log = log
+        self.__handlers = {}
+        self.__devices = set()
+        self.__ignored = set()
+        self.__on = {}
+
+        # Update notification
+        self.__counts = {None: 0}
+        self.__callbacks = {}
+        self.__updated = threading.Condition(threading.Lock())
+        self.__waiting = 0
+
+    def add(self, dev, cmd, buffer, on = None, rows = None):
+        """
+        Register a handler for (dev, cmd) frames.
+
+        :param string dev: Device name.
+        :param string cmd: Command name.
+        :param buffer: The protobuf message the frame data is parsed into.
+        :param bool on: The state the device is in after receiving the frame (None for sensors).
+        :param rows: A function taking the receive timestamp and the buffer, and returning a list of log rows.
+        """
+        self.__handlers[(dev, cmd)] = (buffer, on, rows)
+        self.__devices.add(dev)
+        if on is not None:
+            self.__on.setdefault(dev, False)
+
+    def ignore(self, dev):
+        """
+        Silently drop all frames from device dev.
+        """
+        self.__ignored.add(dev)
+
+    def dispatch(self, dev, cmd, data):
+        """
+        Handle one incoming frame.
+
+        :return: True if the frame was handled, False otherwise.
+        """
+        handler = self.__handlers.get((dev, cmd))
+        if handler is None:
+            if dev in self.__ignored:
+                return False
+            elif dev in self.__devices:
+                print('Unknown command {0} for {1}'.format(cmd, self.__owner))
+            else:
+                print('Unknown device {0} for {1}'.format(dev, self.__owner))
+            return False
+
+        (buffer, on, rows) = handler
+        # Protect write with a lock
+        # to make sure all data is written before access
+        with self.__lock:
+            buffer.ParseFromString(data)
+        if on is not None:
+            self.__on[dev] = on
+        if rows and self.__log:
+            t = time.time()
+            for row in rows(t, buffer):
+                self.__log(row)
+
+        # Frames are only counted by this thread, so the counters
+        # are updated without locking
+        self.__counts[dev] = self.__counts.get(dev, 0) + 1
+        self.__counts[None] += 1
+        for callback in self.__callbacks.get(dev, []) + self.__callbacks.get(None, []):
+            try:
+                callback(dev)
+            except Exception as e:
+                print('Update callback for {0} of {1} failed: {2}'.format(dev, self.__owner, e))
+        # Wake up the waiters after the callbacks,
+        # so they see everything the callbacks update
+        if self.__waiting:
+            with self.__updated:
+                self.__updated.notify_all()
+        return True
+
+    def is_on(self, dev):
+        """
+        Returns the on/off state of device dev, as reported by its last frame.
+        """
+        return self.__on.get(dev, False)
+
+    def count(self, dev = None):
+        """
+        Returns the number of frames received from device dev
+        (from all devices if dev is None).
+        """
+        return self.__counts.get(dev, 0)
+
+    def wait(self, dev = None, timeout = None):
+        """
+        Block until a new frame is received from device dev
+        (from any device if dev is None).
+
+        :param float timeout: Maximum waiting time in seconds (None waits forever).
+        :return: True if a new frame was received, False on timeout.
+        """
+        count = self.count(dev)
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.__updated:
+            self.__waiting += 1
+            try:
+                while self.count(dev) == count:
+                    if deadline is None:
+                        self.__updated.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                        self.__updated.wait(remaining)
+            finally:
+                self.__waiting -= 1
+        return True
+
+    def add_callback(self, dev, callback):
+        """
+        Call callback(dev) from the receive thread
+        after each frame from device dev (from any device if dev is None).
+        """
+        # Replace the list instead of appending,
+        # so the receive thread never sees it changing
+        self.__callbacks[dev] = self.__callbacks.get(dev, []) + [callback]
+
+class ConnectionTimeout(Exception):
+    """
+    Raised when no data is received from a peer (a CASU, a simulated bee,
+    the simulator) within the connection timeout.
+
+    :param string peer: Name of the peer (or peers).
+    :param float timeout: The timeout, in seconds.
+    """
+
+    def __init__(self, peer, timeout):
+        Exception.__init__(self, 'No data received from {0} in {1} s '
+                           '(is it running, and are the addresses right?)'.format(peer, timeout))
+        self.peer = peer
+        self.timeout = timeout
+
+def wait_ready(event, timeout, peer):
+    """
+    Block until event is set (by a receive thread, once it has
+    received data from peer).
+
+    :param threading.Event event: The readiness event.
+    :param float timeout: Maximum waiting time in seconds (None waits forever).
+    :param string peer: Name of the peer, for the error message.
+    :raises ConnectionTimeout: If the event is not set in time.
+    """
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    # Wait in short steps; in Python 2, a single
+    # long wait can not be interrupted with Ctrl-C
+    while not event.is_set():
+        step = 1.0
+        if deadline is not None:
+            step = deadline - time.time()
+            if step <= 0:
+                raise ConnectionTimeout(peer, timeout)
+        event.wait(min(step, 1.0))
+
+def wait_all(objects, timeout = None):
+    """
+    Wait for many objects created with `connect_async()` (e.g. :meth:`bee.Bee.connect_async`)
+    to connect, all within the same timeout.
+
+    :param list objects: Objects with a `wait_connected(timeout)` method.
+    :param float timeout: Maximum total waiting time in seconds (None waits forever).
+    :raises ConnectionTimeout: If any of the objects did not connect in time
+                               (after waiting for all of them).
+    """
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    failed = []
+    for obj in objects:
+        remaining = None
+        if deadline is not None:
+            remaining = max(0.0, deadline - time.time())
+        try:
+            obj.wait_connected(remaining)
+        except ConnectionTimeout as e:
+            failed.append(e.peer)
+    if failed:
+        raise ConnectionTimeout(', '.join(failed), timeout)
+
+class Heartbeat:
+    """
+    Periodic health reports of a receive thread, sent to the supervisor
+    at :data:`SUPERVISOR_ADDR_ENV` (nothing is sent if it is not set).
+
+    Create it, and call :meth:`tick` on every iteration of the receive loop,
+    from the receive thread. The reports are JSON objects, with the
+    receive loop rate (`loop_rate`) and the frame receive rate (`recv_rate`)
+    since the previous report, and the values returned by the health function.
+
+    :param zmq.Context context: The context used for the heartbeat socket.
+    :param string name: Controller name (unless set by :data:`CONTROLLER_ID_ENV`).
+    :param health: A function returning a dictionary with the total number of
+                   received frames (`frames`), the message and log queue
+                   depths (`msg_queue`, `log_queue`) and the connection state (`connected`).
+    :param float interval: Interval between the reports, in seconds.
+    """
+
+    def __init__(self, context, name, health, interval = HEARTBEAT_INTERVAL):
+        self.__name = os.environ.get(CONTROLLER_ID_ENV, name)
+        self.__health = health
+        self.__interval = interval
+        self.__socket = None
+        address = os.environ.get(SUPERVISOR_ADDR_ENV)
+        if address:
+            self.__socket = context.socket(zmq.PUSH)
+            # Heartbeats are only useful when fresh; never
+            # pile them up (or block) while the supervisor is away
+            self.__socket.setsockopt(zmq.SNDHWM, 10)
+            self.__socket.setsockopt(zmq.LINGER, 0)
+            try:
+                self.__socket.connect(address)
+            except zmq.error.ZMQError:
+                print('CONNECTION ERROR: Failed to connect to {0}'.format(address))
+                self.__socket = None
+        self.__loops = 0
+        self.__last = (time.time(), 0, 0)
+
+    def tick(self):
+        """
+        Count one receive loop iteration, and send a report if one is due.
+        """
+        if self.__socket is None:
+            return
+        self.__loops += 1
+        now = time.time()
+        (last, last_loops, last_frames) = self.__last
+        if now - last < self.__interval:
+            return
+        health = self.__health()
+        health['loop_rate'] = (self.__loops - last_loops) / (now - last)
+        health['recv_rate'] = (health['frames'] - last_frames) / (now - last)
+        health['time'] = now
+        self.__last = (now, self.__loops, health['frames'])
+        try:
+            self.__socket.send_multipart(['hb', self.__name, json.dumps(health)], zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+    def close(self):
+        if self.__socket is not None:
+            # Heartbeats are not worth waiting for
+            self.__socket.close(0)
+            self.__socket = None
+
+def start_addresses(address):
+    """
+    Returns the (start signal, ready report) address pair of a start barrier
+    at address 'tcp://host:port'; reports are sent to port + 1.
+    """
+    try:
+        (host, port) = address.rsplit(':', 1)
+        return (address, '{0}:{1}'.format(host, int(port) + 1))
+    except ValueError:
+        raise ValueError('[F] Invalid start barrier address {0}!'.format(address))
+
+def wait_for_start(context, name, timeout = None):
+    """
+    If this process is run under a start barrier (:data:`START_ADDR_ENV` is set),
+    report being ready and block until the start signal.
+    Does nothing if not run under a barrier, or if already released.
+
+    :param zmq.Context context: The context used for the barrier sockets.
+    :param string name: Controller name (unless set by :data:`CONTROLLER_ID_ENV`).
+    :param float timeout: Maximum time (in seconds) to wait for the start signal
+                          (if None, :data:`START_TIMEOUT_ENV`, if set; otherwise forever).
+    :return: True if the process was released by a barrier, False otherwise.
+    :raises ConnectionTimeout: If the start signal is not received in time.
+    """
+    global _started
+    address = os.environ.get(START_ADDR_ENV)
+    if _started or not address:
+        return False
+    name = os.environ.get(CONTROLLER_ID_ENV, name)
+    if timeout is None and os.environ.get(START_TIMEOUT_ENV):
+        timeout = float(os.environ[START_TIMEOUT_ENV])
+    (go_addr, ready_addr) = start_addresses(address)
+
+    go = context.socket(zmq.SUB)
+    go.setsockopt(zmq.SUBSCRIBE, 'go')
+    go.connect(go_addr)
+    report = context.socket(zmq.PUSH)
+    report.setsockopt(zmq.LINGER, 1000)
+    report.connect(ready_addr)
+    try:
+        report.send_multipart(['ready', name, repr(time.time())])
+        print('{0} waiting for the start signal...'.format(name))
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        # Wait in short steps, to be interruptible with Ctrl-C
+        while not go.poll(500):
+            if deadline is not None and time.time() >= deadline:
+                raise ConnectionTimeout('the start barrier at {0}'.format(address), timeout)
+        go.recv_multipart()
+        released = time.time()
+        _started = True
+        report.send_multipart(['start', name, repr(released)])
+    finally:
+        go.close(0)
+        report.close()
+    return True
+
+class StartBarrier:
+    """
+    Releases a set of controllers (see :func:`wait_for_start`) at the same time.
+
+    The barrier binds its sockets on construction, so it should be created
+    before the controllers are started; readiness reports arriving
+    early are kept until :meth:`release` is called. Controllers that become
+    ready after the release are released as they come, by :meth:`release_late`.
+
+    :param string address: Barrier address 'tcp://host:port', as seen by the controllers;
+                           the barrier listens on port and port + 1 on all interfaces.
+    """
+
+    def __init__(self, address):
+        (_, ready_addr) = start_addresses(address)
+        self.address = address
+        self.__context = zmq.Context(1)
+        self.__go = self.__context.socket(zmq.PUB)
+        self.__reports = self.__context.socket(zmq.PULL)
+        for (socket, addr) in [(self.__go, address), (self.__reports, ready_addr)]:
+            port = addr.rsplit(':', 1)[1]
+            try:
+                socket.bind('tcp://*:' + port)
+            except zmq.error.ZMQError:
+                print('CONNECTION ERROR: Failed to bind to port {0}'.format(port))
+                self.close()
+                raise
+        self.__ready = {}
+        self.__released = {}
+        self.__acked = {}
+        self.__stopped = threading.Event()
+
+    def __receive(self, timeout):
+        """
+        Wait at most timeout seconds for one report, and record it.
+
+        :return: The (kind, name) of the report, or None.
+        """
+        if not self.__reports.poll(max(0, int(timeout * 1000))):
+            return None
+        (kind, name, t) = self.__reports.recv_multipart()
+        if kind == 'ready':
+            self.__ready[name] = float(t)
+            # A restarted controller waits again
+            self.__acked.pop(name, None)
+        elif kind == 'start':
+            self.__released[name] = float(t)
+            self.__acked[name] = time.time()
+        return (kind, name)
+
+    def release(self, names, ready_timeout = 60.0, start_timeout = 5.0, alive = None):
+        """
+        Wait for the controllers to be ready, and then release them all.
+
+        :param list names: Names of the controllers to wait for.
+        :param float ready_timeout: Maximum time (in seconds) to wait for the controllers
+                                    to be ready; the ones ready by then are released anyway.
+        :param float start_timeout: Maximum time to wait for the start acknowledgements.
+        :param alive: A function taking a controller name, and returning False if it has terminated
+                      (and thus will never be ready), or None.
+        :return: A map of controller names to (release latency, release time) pairs,
+                 for the controllers that acknowledged the start. The latency is the time
+                 from sending the start signal to receiving the acknowledgement (an upper
+                 bound of the delay), the release time is the time the controller was released,
+                 by its own clock.
+        """
+        names = set(names)
+        deadline = time.time() + ready_timeout
+        while time.time() < deadline and not self.__stopped.is_set():
+            waiting = [name for name in names - set(self.__ready)
+                       if alive is None or alive(name)]
+            if not waiting:
+                break
+            self.__receive(min(0.5, deadline - time.time()))
+        missing = names - set(self.__ready)
+        if missing:
+            print('[W] Not ready, not synchronized: {0}'.format(', '.join(sorted(missing))))
+        ready = names & set(self.__ready)
+
+        # Late subscribers miss the signal, so it is repeated until
+        # everybody answers; each controller reacts to the first one only
+        go_time = time.time()
+        deadline = go_time + start_timeout
+        while (ready - set(self.__acked) and time.time() < deadline
+               and not self.__stopped.is_set()):
+            self.__go.send_multipart(['go', repr(go_time)])
+            resend = time.time() + START_RESEND
+            while time.time() < resend:
+                self.__receive(resend - time.time())
+        missing = ready - set(self.__acked)
+        if missing:
+            print('[W] Start not acknowledged by: {0}'.format(', '.join(sorted(missing))))
+        return dict([(name, (self.__acked[name] - go_time, self.__released[name]))
+                     for name in ready - missing])
+
+    def release_late(self):
+        """
+        Release the controllers that become ready after :meth:`release`
+        (or that missed its start signal), until :meth:`stop` is called.
+        """
+        while not self.__stopped.is_set():
+            waiting = set(self.__ready) - set(self.__acked)
+            if waiting:
+                self.__go.send_multipart(['go', repr(time.time())])
+            report = self.__receive(START_RESEND if waiting else 0.5)
+            if report is not None and report[0] == 'start':
+                print('[W] {0} was released late, not synchronized.'.format(report[1]))
+
+    def stop(self):
+        """
+        Make :meth:`release` and :meth:`release_late` return (e.g. from another thread).
+        """
+        self.__stopped.set()
+
+    def close(self):
+        self.__go.close(0)
+        self.__reports.close(0)
+        self.__context.term()
+
+def report_start(starts):
+    """
+    Print the start skew of controllers released by a :class:`StartBarrier`.
+
+    :param dict starts: Map of controller names to (latency, release time) pairs,
+                        as returned by :meth:`StartBarrier.release`.
+    """
+    if not starts:
+        return
+    first = min([t for (_, t) in starts.values()])
+    lines = ['Start skew (latency: signal to acknowledgement; '
+             'offset: release time relative to the first, by the CASU clocks):']
+    for name in sorted(starts):
+        (latency, t) = starts[name]
+        lines.append('  {0:<24} latency {1:8.1f} ms   offset {2:8.1f} ms'.format(
+            name, latency * 1000, (t - first) * 1000))
+    latencies = [latency for (latency, _) in starts.values()]
+    lines.append('  max latency {0:.1f} ms, latency spread {1:.1f} ms, '
+                 'offset spread {2:.1f} ms'.format(
+                     max(latencies) * 1000, (max(latencies) - min(latencies)) * 1000,
+                     (max([t for (_, t) in starts.values()]) - first) * 1000))
+    print('\n'.join(lines))
@@ -2,13 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import yaml
-import pygraphviz as pgv
-from fabric.api import run, put, settings
 import warnings
 
 import argparse
 import os
+import sys
 import shutil
+import time
+import pipes
+import threading
+import json
+import hashlib
+
+import remote
+from project import Project
 
 
 """ Tools for automatically deploying CASU controllers. """
@@ -17,7 +24,7 @@ import shutil
 Note on handling warnings:
 
 There is a known bug in an upstream library, Crypto/blockalg. It is used by
-the paramiko library, which is used in fabric.
+the paramiko library, which is used for the ssh connections.
 
 The warnings are filtered out in this tool, using high specificity; if the
 version of paramiko or Crypto change (within aptitude repos for ubuntu 16.04 at
@@ -42,6 +49,22 @@ blindly hidden.
 
 '''
 
+PREPARE_MANIFEST = '.prepared.json'
+"""
+Sandbox manifest: maps 'layer/casu' to the digest of the inputs
+the sandbox folder of the CASU was generated from.
+"""
+
+def link_or_copy(src, dst):
+    """
+    Hard-link src to dst, or copy it, if it can not be linked
+    (e.g. when it is on another file system).
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
 class Deploy:
     """
     Class for performing deployment tasks.
@@ -54,7 +77,6 @@ class Deploy:
         self.proj_name = os.path.splitext(os.path.basename(project_file_name))[0]
         self.project_root = os.path.dirname(os.path.abspath(project_file_name))
         self.sandbox_dir = self.proj_name + '_sandbox'
-        self.fabfile_name = os.path.join(self.sandbox_dir, self.proj_name + '.py')
 
         self.arena = {}
         self.nbg = None
@@ -63,72 +85,62 @@ class Deploy:
 
         self.prepared = False
 
-        with open(project_file_name) as project_file:
-            project = yaml.safe_load(project_file)
-
-        # Read the .arena file
-        with open(os.path.join(self.project_root, project['arena'])) as arena_file:
-            self.arena = yaml.safe_load(arena_file)
+        # Read the .arena and deployment files, and the neighborhood graph
+        # (so long as one is defined)
+        project = Project(project_file_name)
+        self.arena = project.arena
+        self.nbg = project.nbg
+        self.dep = project.dep
 
-        # Read the neighborhood graph, so long as one is defined.
-        nbg_fname = project.get('nbg', None)
-        if nbg_fname is not None and nbg_fname.lower() not in ['none', 'null']:
-            # if one was missed but not explicitly so, should emit warning?
-            self.nbg = pgv.AGraph(os.path.join(self.project_root, nbg_fname))
-
-
-        # Read the deployment file
-        with open(os.path.join(self.project_root, project['dep'])) as dep_file:
-            self.dep = yaml.safe_load(dep_file)
+    def rtc(self, layer, casu):
+        """
+        Returns the runtime configuration (the contents of the .rtc file)
+        of a CASU.
+        """
+        rtc = {'name': casu,
+               'pub_addr': self.arena[layer][casu]['pub_addr'],
+               'sub_addr': self.arena[layer][casu]['sub_addr'],
+               'msg_addr': 'tcp://*:' + self.arena[layer][casu]['msg_addr'].split(':')[-1]}
+        neighbors = {} # Data to be written to the .rtc
+        if self.nbg is not None:
+            if not self.nbg.has_layer(layer):
+                print('WARNING: No connectivity info for layer {0}'.format(layer))
+            elif not self.nbg.has_casu(layer, casu):
+                print('WARNING: No connectivity info for CASU {0}'.format(casu))
+            else:
+                neighbors = self.nbg.neighbors(layer, casu)
+        rtc['neighbors'] = neighbors
+        return rtc
 
     def prepare(self, layer_select='all', allow_partial=False):
         """
         Prepare deployment in local folder.
+
+        The sandbox is updated in place: only the folders of the CASUs whose
+        configuration, controller or extra files changed since the last
+        preparation are regenerated (see PREPARE_MANIFEST), and the
+        controller and extra files are hard-linked rather than copied,
+        where possible.
         """
 
-        cwd = os.getcwd()
-        print('Changing directory to {0}'.format(self.project_root))
-        os.chdir(self.project_root)
         print('Preparing files for deployment!')
-
-        # Remove old fabfile, if it exists
-        _msg = "written"
-        if os.path.exists(self.fabfile_name):
-            _msg = "overwritten!"
-        print('The file {0} will be {1}'.format(self.fabfile_name, _msg))
-        try:
-            os.remove(self.fabfile_name)
-        except OSError:
-            # The fabfile does not exist,
-            # no bigie
-            pass
-
-        # Collect fabric tasks
-        fabfile_tasks = '''
-from fabric.api import cd, run, settings, parallel
-import warnings
-'''
-        fabfile_all = '''
-def all():
-'''
-
-        # Clean up and create new sandbox folder
         sandbox_path = os.path.join(self.project_root, self.sandbox_dir)
-        _msg = "created"
-        if os.path.exists(sandbox_path):
-            _msg = "overwritten"
-        print('The folder {0} will be {1}'.format(sandbox_path, _msg))
-        try:
-            shutil.rmtree(sandbox_path)
-        except OSError:
-            # The sandbox directory does not exist,
-            # no biggie
-            pass
-
-        # Create one folder per arena layer
-        # with subfolders for each casu
-        os.mkdir(self.sandbox_dir)
-        os.chdir(self.sandbox_dir)
+        manifest_path = os.path.join(sandbox_path, PREPARE_MANIFEST)
+
+        # Read the state of the sandbox folder
+        old_manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                old_manifest = json.load(manifest_file)
+            print('The folder {0} will be updated'.format(sandbox_path))
+        else:
+            _msg = "created"
+            if os.path.exists(sandbox_path):
+                # Left by an older version, start afresh
+                _msg = "overwritten"
+                shutil.rmtree(sandbox_path)
+            print('The folder {0} will be {1}'.format(sandbox_path, _msg))
+            os.makedirs(sandbox_path)
 
         # Select particular layers
         selected_layers = self.dep.keys()
@@ -139,10 +151,12 @@ def all():
                     "[F] {} is not a layer in this deployment! aborting.".format(
                         layer_select))
 
-
+        # One folder per arena layer
+        # with subfolders for each casu
+        manifest = {}
+        digests = {} # File path -> sha1, each file is only read once
+        regenerated = 0
         for layer in selected_layers:
-            os.mkdir(layer)
-            os.chdir(layer)
             for casu in self.arena[layer]:
                 if layer not in self.dep or casu not in self.dep[layer]:
                     # we cannot continue with this casu since incomplete info.
@@ -155,112 +169,82 @@ def all():
                         # names between files, perhaps?) Raise error.
                         raise ValueError("[F] incomplete info for casu {} (in layer {}): not specified in .dep file. Did you mean to use --allow-partial option?".format(casu, layer))
 
-                os.mkdir(casu)
-                os.chdir(casu)
-                # Create the .rtc file
-                with open(casu+'.rtc','a') as rtc_file:
-                    yaml.dump({'name':casu}, rtc_file, default_flow_style=False)
-                    yaml.dump({'pub_addr': self.arena[layer][casu]['pub_addr']},
-                               rtc_file, default_flow_style=False)
-                    yaml.dump({'sub_addr': self.arena[layer][casu]['sub_addr']},
-                              rtc_file, default_flow_style=False)
-                    yaml.dump({'msg_addr': 'tcp://*:' + self.arena[layer][casu]['msg_addr'].split(':')[-1]},
-                              rtc_file, default_flow_style=False)
-                    neighbors = {'neighbors':{}} # Data to be written to the .rtc
-                    if self.nbg is not None:
-                        sg = self.nbg.get_subgraph(layer)
-                        out_neighbors = [] # Data read from the .nbg file
-                        name_prefix = ''
-                        if sg is None:
-                            print('WARNING: No connectivity info for layer {0}'.format(layer))
-                        else:
-                            if sg.has_node(casu):
-                                out_neighbors = sg.out_neighbors(casu)
-                            elif sg.has_node(layer + '/' + casu):
-                                # The CASU name is prefixed with layer name
-                                name_prefix = layer + '/'
-                                out_neighbors = sg.out_neighbors(name_prefix + casu)
-                            else:
-                                print('WARNING: No connectivity info for CASU {0}'.format(casu))
-                            # Read all the neighbors and populate the .rtc
-                            for nb in out_neighbors:
-                                side = str(self.nbg.get_edge(name_prefix+casu,nb).attr['label'])
-                                nb_full_name = str(nb).split('/')
-                                nb_name = nb_full_name[-1]
-                                nb_layer = layer
-                                if len(nb_full_name) > 1:
-                                    nb_layer = nb_full_name[0]
-                                neighbors['neighbors'][side] = {'name': nb_name,
-                                                                'address': self.arena[nb_layer][nb_name]['msg_addr']}
-
-                    yaml.dump(neighbors, rtc_file, default_flow_style=False)
-
-                # Copy the controller
-                shutil.copy(os.path.join(self.project_root,self.dep[layer][casu]['controller']),'.')
-                # Copy additional files
-                extra = self.dep[layer][casu].get('extra',None)
-                if extra:
-                    for item in extra:
-                        shutil.copy(os.path.join(self.project_root,item),'.')
-
-                # compile extra args string
-                _extra_args = self.dep[layer][casu].get('args', [])
-                extra_args = " ".join(_extra_args)
-
-                # Append to fabfile
-                fabfile_tasks += '''
-@parallel
-def {task}():
-    with warnings.catch_warnings():
-        # ignore the CTR crypto IV warning
-        warnings.filterwarnings(action="ignore", category=FutureWarning, module="Crypto", lineno=141)
-        with settings(host_string='{host}', user='{username}'):
-            with cd('{code_dir}'):
-                run('./{command} {rtc} {extra_args}')
-                                  '''.format(task=(layer+'_'+casu).replace('-','_'),
-                                             host=self.dep[layer][casu]['hostname'],
-                                             username=self.dep[layer][casu]['user'],
-                                             code_dir=os.path.join(self.dep[layer][casu]['prefix'],layer,casu),
-                                             command=os.path.basename(self.dep[layer][casu]['controller']),
-                                             rtc=casu+'.rtc',
-                                             extra_args=extra_args,
-                                             )
-                fabfile_all += '    {task}()\n'.format(task=(layer+'_'+casu).replace('-','_'))
-                os.chdir('..')
-            os.chdir(sandbox_path)
-
-        os.chdir(self.project_root)
-
-        # Finalize the fabric file
-        with open(self.fabfile_name,'w') as fabfile:
-            fabfile.write(fabfile_tasks)
-            fabfile.write(fabfile_all)
-
-        print('Preparation done!')
-        print('Returning to original directory {0}'.format(cwd))
-        os.chdir(cwd)
+                # The controller and additional files
+                files = [os.path.join(self.project_root, self.dep[layer][casu]['controller'])]
+                files += [os.path.join(self.project_root, item)
+                          for item in self.dep[layer][casu].get('extra', None) or []]
+
+                # The CASU folder only needs to be regenerated
+                # if the .rtc file or any of the files change
+                rtc_text = yaml.dump(self.rtc(layer, casu), default_flow_style=False)
+                key = hashlib.sha1(rtc_text)
+                for path in files:
+                    if path not in digests:
+                        digests[path] = remote.file_sha1(path)
+                    key.update('\0{0}\0{1}'.format(os.path.basename(path), digests[path]))
+                name = layer + '/' + casu
+                manifest[name] = key.hexdigest()
+
+                casu_path = os.path.join(sandbox_path, layer, casu)
+                if old_manifest.get(name) != manifest[name] or not os.path.isdir(casu_path):
+                    if os.path.exists(casu_path):
+                        shutil.rmtree(casu_path)
+                    os.makedirs(casu_path)
+                    # Create the .rtc file
+                    with open(os.path.join(casu_path, casu + '.rtc'), 'w') as rtc_file:
+                        rtc_file.write(rtc_text)
+                    for path in files:
+                        link_or_copy(path, os.path.join(casu_path, os.path.basename(path)))
+                    regenerated += 1
+
+        # Remove the CASUs that are not deployed anymore
+        for name in set(old_manifest) - set(manifest):
+            shutil.rmtree(os.path.join(sandbox_path, name), ignore_errors=True)
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+        # Controllers are run by assisirun.py; remove the fabfile
+        # written by older versions, which would be out of date
+        fabfile_path = os.path.join(sandbox_path, self.proj_name + '.py')
+        if os.path.exists(fabfile_path):
+            os.remove(fabfile_path)
+
+        print('Preparation done ({0} of {1} CASUs regenerated)!'.format(regenerated, len(manifest)))
 
         self.prepared = True
 
-    def deploy(self, layer_select='all', allow_partial=False):
+    def deploy(self, layer_select='all', allow_partial=False, jobs=8,
+               per_host=remote.PER_HOST):
         """
         Perform deployment by copying files from the sandbox directory
         to their appropriate destinations.
 
+        The CASUs are deployed to concurrently, by a pool of jobs threads,
+        over one connection per host; at most per_host CASUs are deployed
+        to the same host at the same time.
+
+        Deployment is incremental: each distinct file is uploaded to a host
+        once, and hard-linked into the CASU folders, and only the files that
+        changed since the last deployment are updated. Files that are no
+        longer deployed are removed; other files in the CASU folders
+        (e.g. logs) are kept. The deployed files are hard links to the
+        stored ones, so controllers must not modify them in place (that
+        would change every CASU folder sharing the file); they can be
+        replaced by renaming a new file over them.
+
         arguments:
             `layer_select` : choose a single layer, or all layers to deploy to
             `allow_partial`: enable deployment specifications where the dep file
                            : specifies only a subset of the arena file's casus
+            `jobs`         : number of CASUs deployed to concurrently
+            `per_host`     : maximum number of concurrent deployments per host
 
+        returns True if all the CASUs were deployed to successfully.
         """
 
         if not self.prepared:
             self.prepare(layer_select=layer_select,allow_partial=allow_partial)
 
-        cwd = os.getcwd()
-
-        os.chdir(os.path.join(self.project_root, self.sandbox_dir))
-
         # Select particular layers
         selected_layers = self.dep.keys()
         if layer_select != 'all':
@@ -270,25 +254,173 @@ def {task}():
                     "[F] {} is not a layer in this deployment! aborting.".format(
                         layer_select))
 
-        for layer in selected_layers:
-            print('Deploying layer {0} ...'.format(layer))
-            os.chdir(layer)
-            for casu in self.dep[layer]:
-                os.chdir(casu)
-                # Connect to the target machine and deploy the files.
-                with settings(host_string = self.dep[layer][casu]['hostname'],
-                              user = self.dep[layer][casu]['user']):
-                    destdir = os.path.join(self.dep[layer][casu]['prefix'], layer, casu)
-                    run('mkdir -p ' + destdir)
-                    run('rm -rf ' + os.path.join(destdir,'*'))
-                    put('*', destdir)
-                    # Give executable permissions to the controller
-                    ctrl_name = os.path.basename(self.dep[layer][casu]['controller'])
-                    run('chmod +x ' + os.path.join(destdir, ctrl_name))
-                os.chdir('..')
-            os.chdir('..')
-
-        os.chdir(cwd)
+        tasks = [(layer, casu) for layer in selected_layers for casu in self.dep[layer]]
+        # Deployment state of each (host, user): the files in its
+        # content-addressed stores (and the ones being uploaded to them),
+        # and the manifests of its CASU folders
+        hosts = {}
+        for (layer, casu) in tasks:
+            spec = self.dep[layer][casu]
+            host = hosts.setdefault((spec['hostname'], spec['user']),
+                                    {'lock': threading.Lock(), 'listed': False,
+                                     'objects_dirs': set(), 'dirs': [],
+                                     'objects': set(), 'uploading': {},
+                                     'manifests': {}})
+            host['objects_dirs'].add(os.path.join(spec['prefix'], remote.OBJECTS_DIR))
+            host['dirs'].append(os.path.join(spec['prefix'], layer, casu))
+
+        print('Deploying {0} CASUs ...'.format(len(tasks)))
+        pool = remote.ConnectionPool(per_host)
+        stats = remote.TransferStats()
+        try:
+            for ((layer, casu), result, error) in remote.run_tasks(
+                    lambda task: self.__deploy_casu(pool, stats, hosts, *task), tasks, jobs):
+                if error is not None:
+                    print('[E] Deployment to {0}/{1} failed: {2}'.format(layer, casu, error))
+                    stats.fail(self.dep[layer][casu]['hostname'], layer + '/' + casu, error)
+                elif result:
+                    print('Deployed {0} changed files to {1}/{2}.'.format(result, layer, casu))
+                else:
+                    print('{0}/{1} is up to date.'.format(layer, casu))
+
+            # Remove the stored files that are not deployed anymore
+            # (i.e., that are not linked from anywhere)
+            for ((host, user), result, error) in remote.run_tasks(
+                    lambda key: pool.get(*key).check_run(
+                        'find {0} -type f -links 1 -delete'.format(' '.join(
+                            [pipes.quote(path) for path in sorted(hosts[key]['objects_dirs'])]))),
+                    hosts.keys(), jobs):
+                if error is not None:
+                    print('[W] Cleaning up {0} failed: {1}'.format(host, error))
+        finally:
+            pool.close()
+
+        stats.report()
+        return stats.failures() == 0
+
+    def __list_host(self, connection, host):
+        """
+        Read the contents of the content-addressed stores, and the manifests
+        of the CASU folders of a host (in one remote command).
+        """
+        lines = []
+        for path in sorted(host['objects_dirs']):
+            lines.append('mkdir -p {0} && echo @@objects {0} && ls {0}'.format(pipes.quote(path)))
+        for path in host['dirs']:
+            lines.append('echo @@manifest {0}; cat {1} 2>/dev/null; echo'.format(
+                pipes.quote(path), pipes.quote(os.path.join(path, remote.MANIFEST_FILE))))
+        section = None
+        manifests = {}
+        for line in connection.check_run('\n'.join(lines) + '\n').splitlines():
+            if line.startswith('@@objects '):
+                section = ('objects', line[len('@@objects '):])
+            elif line.startswith('@@manifest '):
+                section = ('manifest', line[len('@@manifest '):])
+                manifests[section[1]] = []
+            elif section is not None and line:
+                if section[0] == 'objects':
+                    host['objects'].add((section[1], line))
+                else:
+                    manifests[section[1]].append(line)
+        for path in manifests:
+            host['manifests'][path] = remote.parse_manifest('\n'.join(manifests[path]))
+        host['listed'] = True
+
+    def __claim_objects(self, connection, host, objects_dir, casu_dir, manifest):
+        """
+        Find the files of a CASU folder missing from the content-addressed
+        store of a host, and claim the ones nobody is uploading yet.
+
+        :return: (claimed, uploading) tuple: a map of the digests of the
+                 claimed files to their paths, which the caller has to
+                 upload (see :meth:`__upload_objects`), and a list of events
+                 set once the other files being uploaded are stored.
+        """
+        claimed = {}
+        uploading = []
+        with host['lock']:
+            if not host['listed']:
+                self.__list_host(connection, host)
+            for (name, sha1) in sorted(manifest.items()):
+                key = (objects_dir, sha1)
+                if key in host['objects'] or sha1 in claimed:
+                    continue
+                if key in host['uploading']:
+                    uploading.append(host['uploading'][key])
+                else:
+                    host['uploading'][key] = threading.Event()
+                    claimed[sha1] = os.path.join(casu_dir, name)
+        return (claimed, uploading)
+
+    def __upload_objects(self, connection, host, objects_dir, claimed):
+        """
+        Upload the claimed files to the content-addressed store of a host,
+        and release the claims (also if the upload fails).
+
+        :return: The number of bytes transferred.
+        """
+        stored = False
+        try:
+            data = remote.archive(claimed)
+            connection.check_run('tar -xzf - -C ' + pipes.quote(objects_dir), data)
+            stored = True
+        finally:
+            with host['lock']:
+                for sha1 in claimed:
+                    if stored:
+                        host['objects'].add((objects_dir, sha1))
+                    host['uploading'].pop((objects_dir, sha1)).set()
+        return len(data)
+
+    def __deploy_casu(self, pool, stats, hosts, layer, casu):
+        """
+        Deploy the sandbox folder of one CASU to its destination.
+
+        Files are uploaded once per host, to its content-addressed store
+        (see :data:`remote.OBJECTS_DIR`), and hard-linked to the CASU
+        folders; only the files that changed since the last deployment
+        are updated.
+
+        :return: The number of changed files.
+        """
+        spec = self.dep[layer][casu]
+        casu_dir = os.path.join(self.project_root, self.sandbox_dir, layer, casu)
+        manifest = remote.file_manifest(casu_dir)
+        destdir = os.path.join(spec['prefix'], layer, casu)
+        objects_dir = os.path.join(spec['prefix'], remote.OBJECTS_DIR)
+        host = hosts[(spec['hostname'], spec['user'])]
+
+        with pool.slot(spec['hostname']):
+            connection = pool.get(spec['hostname'], spec['user'])
+            start = time.time()
+            nbytes = 0
+            nfiles = 0
+            # Files shared by several CASUs are uploaded by the first one;
+            # the host lock is only held while claiming them, so that
+            # the CASUs of a host are uploaded to concurrently
+            while True:
+                (claimed, uploading) = self.__claim_objects(
+                    connection, host, objects_dir, casu_dir, manifest)
+                if claimed:
+                    nbytes += self.__upload_objects(connection, host, objects_dir, claimed)
+                    nfiles += len(claimed)
+                if not uploading:
+                    break
+                # Wait for the other uploads, and claim
+                # the files whose upload failed
+                for event in uploading:
+                    event.wait()
+
+            old_manifest = host['manifests'].get(destdir, {})
+            changed = len([name for name in manifest if old_manifest.get(name) != manifest[name]])
+            if manifest != old_manifest:
+                # Give executable permissions to the controller
+                connection.check_run('sh -e', remote.link_script(
+                    objects_dir, destdir, manifest, old_manifest,
+                    [os.path.basename(spec['controller'])]))
+            stats.add(spec['hostname'], nbytes, nfiles, start, time.time())
+
+        return changed
 
 def main():
     parser = argparse.ArgumentParser(description='Transfer controller code to CASUs (physical or simulated)')
@@ -301,11 +433,16 @@ def main():
                         'with a complete arena file, if only a subset of casus are '
                         'declared in the dep file, this will be permitted',
                         action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Number of CASUs to deploy to concurrently')
+    parser.add_argument('--per-host', type=int, default=remote.PER_HOST,
+                        help='Maximum number of CASUs to deploy to concurrently '
+                        'on the same host')
     args = parser.parse_args()
 
     project = Deploy(args.project)
     with warnings.catch_warnings():
-        # ignore the CTR warning in paramiko/fabric
+        # ignore the CTR warning in paramiko
         warnings.filterwarnings(
             action="ignore", category=FutureWarning, module="Crypto", lineno=141)
 
@@ -314,7 +451,9 @@ def main():
             project.prepare(args.layer, args.allow_partial)
         else:
             # the deployment stage does preparation if not already done
-            project.deploy(args.layer, args.allow_partial)
+            if not project.deploy(args.layer, args.allow_partial,
+                                  args.jobs, args.per_host):
+                sys.exit(1)
 
 if __name__ == '__main__':
     main()
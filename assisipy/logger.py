@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous, buffered writer for CASU logfiles.
+
+Rows are handed over to a bounded queue, and written in batches
+by a background thread, so logging does not slow down the thread
+receiving the data.
+
+Two formats are supported:
+
+* ``csv``: one ``;``-separated text line per row
+  (``record id;timestamp;value;value;...``).
+* ``bin``: a compact binary format. The file starts with :data:`BIN_MAGIC`,
+  followed by records, all little-endian:
+
+  * record type declaration: ``uint16 0, uint16 n``, followed by the
+    n byte long record id; the declared types are numbered 1, 2, ...
+    in the order of declaration;
+  * data record: ``uint16 type, uint16 n, float64 timestamp``,
+    followed by n float64 values.
+
+Logs can be split into segments, by time or by size. Segments of
+the log 'YYYY-MM-DD-HH-MM-SS-name.csv' are named
+'YYYY-MM-DD-HH-MM-SS-name.NNNN.csv' (NNNN = 0000, 0001, ...), and can be
+gzip-compressed ('.csv.gz') once they are closed.
+"""
+
+import os
+import shutil
+import gzip
+import threading
+import time
+import struct
+import csv
+import Queue
+
+LOG_CSV = 'csv'
+""" Text (csv) log format """
+LOG_BIN = 'bin'
+""" Binary log format """
+
+BIN_MAGIC = 'ASSISILOG1\n'
+""" Binary logfile signature """
+
+BIN_DECLARATION = struct.Struct('<HH')
+BIN_RECORD = struct.Struct('<HHd')
+
+class CsvEncoder:
+    """
+    Writes rows as csv text lines.
+    """
+
+    def __init__(self, logfile):
+        self.__writer = csv.writer(logfile, delimiter=';')
+
+    def write(self, rows):
+        self.__writer.writerows(rows)
+
+class BinEncoder:
+    """
+    Writes rows as binary records.
+    """
+
+    def __init__(self, logfile):
+        self.__file = logfile
+        self.__types = {}
+        logfile.write(BIN_MAGIC)
+
+    def write(self, rows):
+        chunks = []
+        for row in rows:
+            record_id = str(row[0])
+            if record_id not in self.__types:
+                self.__types[record_id] = len(self.__types) + 1
+                chunks.append(BIN_DECLARATION.pack(0, len(record_id)))
+                chunks.append(record_id)
+            values = []
+            for value in row[2:]:
+                try:
+                    values.append(float(value))
+                except (TypeError, ValueError):
+                    values.append(float('nan'))
+            chunks.append(BIN_RECORD.pack(self.__types[record_id], len(values), row[1]))
+            chunks.append(struct.pack('<%dd' % len(values), *values))
+        self.__file.write(''.join(chunks))
+
+ENCODERS = {LOG_CSV: CsvEncoder, LOG_BIN: BinEncoder}
+
+def segment_path(path, segment):
+    """
+    Returns the path of segment number segment of the log path.
+    """
+    (root, ext) = os.path.splitext(path)
+    return '{0}.{1:04d}{2}'.format(root, segment, ext)
+
+def compress_file(path):
+    """
+    Gzip the file path (to path.gz), and remove the original.
+
+    :return: The path of the compressed file.
+    """
+    with open(path, 'rb') as src:
+        with gzip.open(path + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    os.remove(path)
+    return path + '.gz'
+
+class LogWriter:
+    """
+    Asynchronous logfile writer.
+
+    :param string path: Logfile path.
+    :param string fmt: Logfile format (LOG_CSV or LOG_BIN).
+    :param float flush_interval: Maximum time (in seconds) a row spends in the queue before it is written to the file.
+    :param int queue_len: Maximum number of queued rows; rows logged while the queue is full are dropped (and counted).
+    :param float rotate_interval: If set, start a new segment every rotate_interval seconds (unless no rows were written to the current one).
+    :param int rotate_size: If set, start a new segment when the current one reaches rotate_size bytes (segments exceed it by at most one row).
+    :param bool compress: Gzip segments once they are closed (in a separate thread).
+    :param int keep: If set, keep only the keep most recent segments (including the one being written), deleting older ones.
+    """
+
+    def __init__(self, path, fmt = LOG_CSV, flush_interval = 1.0, queue_len = 10000,
+                 rotate_interval = None, rotate_size = None, compress = False, keep = None):
+        if fmt not in ENCODERS:
+            raise ValueError('Unknown log format {0}!'.format(fmt))
+        if keep is not None and keep < 1:
+            raise ValueError('At least one log segment has to be kept!')
+        self.path = path
+        self.__fmt = fmt
+        self.__flush_interval = flush_interval
+        self.__rotate_interval = rotate_interval
+        self.__rotate_size = rotate_size
+        self.__segmented = bool(rotate_interval or rotate_size)
+        self.__compress = compress
+        self.__keep = keep
+        self.__segment = 0
+        self.__closed_segments = []
+        self.__queue = Queue.Queue(queue_len)
+        self.__batch_len = max(queue_len, 1)
+        self.__stop = object()
+        self.__written = 0
+        self.__dropped = 0
+        self.__max_queued = 0
+
+        # Open the file here, to report errors to the caller
+        self.__open_segment()
+        if compress:
+            # Closed segments, waiting to be compressed
+            self.__closed = Queue.Queue()
+            self.__compress_thread = threading.Thread(target=self.__compress_segments)
+            self.__compress_thread.daemon = True
+            self.__compress_thread.start()
+        self.__thread = threading.Thread(target=self.__write_rows)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def write(self, row):
+        """
+        Queue one row for writing. Never blocks.
+        """
+        try:
+            self.__queue.put_nowait(row)
+        except Queue.Full:
+            self.__dropped += 1
+
+    def close(self):
+        """
+        Write all queued rows and close the logfile.
+        """
+        self.__queue.put(self.__stop)
+        self.__thread.join()
+        if self.__compress:
+            # Also wait for the last segments to be compressed
+            self.__closed.put(self.__stop)
+            self.__compress_thread.join()
+
+    def stats(self):
+        """
+        :return: A dictionary with the number of currently queued (`queued`),
+                 written (`written`) and dropped (`dropped`) rows,
+                 and the maximum number of rows that were waiting
+                 to be written at the same time (`max_queued`).
+        """
+        return {'queued': self.__queue.qsize(),
+                'written': self.__written,
+                'dropped': self.__dropped,
+                'max_queued': self.__max_queued}
+
+    def __open_segment(self):
+        """
+        Open the file for the current segment.
+        """
+        if self.__segmented:
+            self.__file_path = segment_path(self.path, self.__segment)
+        else:
+            self.__file_path = self.path
+        self.__file = open(self.__file_path, 'wb')
+        self.__segment_start = time.time()
+        self.__segment_rows = 0
+        self.__encoder = ENCODERS[self.__fmt](self.__file)
+
+    def __close_segment(self, last = False):
+        """
+        Close the current segment, and hand it over to the compression
+        thread (or apply the retention limit right away, if the segments
+        are not compressed).
+        """
+        self.__file.close()
+        if self.__compress:
+            self.__closed.put((self.__file_path, last))
+        else:
+            self.__retain(self.__file_path, last)
+
+    def __rotate(self):
+        """
+        Close the current segment and start the next one.
+        """
+        self.__close_segment()
+        self.__segment += 1
+        self.__open_segment()
+
+    def __retain(self, closed_path, last):
+        """
+        Delete the segments exceeding the retention limit.
+        """
+        self.__closed_segments.append(closed_path)
+        if self.__keep is not None:
+            # Unless this is the last one, the next segment counts as well
+            keep = self.__keep
+            if not last:
+                keep -= 1
+            while len(self.__closed_segments) > keep:
+                os.remove(self.__closed_segments.pop(0))
+
+    def __compress_segments(self):
+        """
+        Compress closed segments (in the order they were closed),
+        and apply the retention limit.
+
+        Runs in its own thread, so that the writer thread
+        keeps emptying the queue while a segment is compressed.
+        """
+        while True:
+            segment = self.__closed.get()
+            if segment is self.__stop:
+                break
+            (closed_path, last) = segment
+            try:
+                closed_path = compress_file(closed_path)
+            except (IOError, OSError) as e:
+                print('WARNING: Failed to compress {0}: {1}'.format(closed_path, e))
+            self.__retain(closed_path, last)
+
+    def __write_batch(self, batch):
+        """
+        Write a batch of rows, starting a new segment
+        as soon as the current one reaches the size limit.
+        """
+        if self.__rotate_size:
+            # Check the size before each row, so that a segment
+            # exceeds the limit by at most one row
+            for row in batch:
+                if self.__segment_rows and self.__file.tell() >= self.__rotate_size:
+                    self.__rotate()
+                self.__encoder.write([row])
+                self.__segment_rows += 1
+        else:
+            self.__encoder.write(batch)
+            self.__segment_rows += len(batch)
+        self.__file.flush()
+        self.__written += len(batch)
+
+    def __rotate_interval_due(self):
+        """
+        Check if the current segment should be closed because of its age.
+
+        Empty segments are not closed; their time starts over instead.
+        """
+        if not (self.__rotate_interval and
+                time.time() - self.__segment_start >= self.__rotate_interval):
+            return False
+        if not self.__segment_rows:
+            self.__segment_start = time.time()
+            return False
+        return True
+
+    def __write_rows(self):
+        """
+        Collect queued rows and write them in batches.
+        """
+        batch = []
+        stopping = False
+        next_flush = time.time() + self.__flush_interval
+        while not stopping:
+            try:
+                row = self.__queue.get(timeout = max(0.0, next_flush - time.time()))
+                # Take everything else that is already waiting,
+                # up to one queue length at a time
+                while True:
+                    if row is self.__stop:
+                        stopping = True
+                        break
+                    batch.append(row)
+                    if len(batch) >= self.__batch_len:
+                        break
+                    row = self.__queue.get_nowait()
+            except Queue.Empty:
+                pass
+
+            if len(batch) > self.__max_queued:
+                self.__max_queued = len(batch)
+            if stopping or len(batch) >= self.__batch_len or time.time() >= next_flush:
+                if batch:
+                    self.__write_batch(batch)
+                    batch = []
+                next_flush = time.time() + self.__flush_interval
+                if not stopping and self.__rotate_interval_due():
+                    self.__rotate()
+
+        if self.__segmented or self.__compress:
+            self.__close_segment(last = True)
+        else:
+            self.__file.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+CASU neighborhood index.
+
+The neighborhood graph (.nbg file) is parsed once into a plain index,
+mapping each (layer, casu) to its neighbors, by side, with their
+message addresses resolved from the arena. The index is made of plain
+dictionaries, so it can be stored, and used without pygraphviz
+(e.g. by the simulator tools or at runtime).
+
+In the graph, each layer is a subgraph; CASUs in other layers
+are referred to as 'layer/casu', and the edge labels are the sides.
+"""
+
+class NeighborhoodIndex:
+    """
+    Neighborhood index.
+
+    :param dict index: Map of layer names to maps of CASU names
+                       to their neighbors, by side (as returned by :meth:`to_dict`).
+    """
+
+    def __init__(self, index = None):
+        self.__index = index or {}
+
+    @classmethod
+    def from_graph(cls, graph, arena):
+        """
+        Build the index from a neighborhood graph.
+
+        :param pygraphviz.AGraph graph: The neighborhood graph.
+        :param dict arena: The arena specification, used to resolve the neighbor addresses.
+        """
+        index = {}
+        for sg in graph.subgraphs():
+            layer = str(sg.name)
+            casus = index.setdefault(layer, {})
+            prefix = layer + '/'
+            for node in sg.nodes():
+                node = str(node)
+                if node.startswith(prefix):
+                    # The CASU name is prefixed with layer name
+                    node = node[len(prefix):]
+                if '/' not in node:
+                    casus.setdefault(node, {})
+            for edge in sg.edges():
+                source = str(edge[0])
+                if source.startswith(prefix):
+                    source = source[len(prefix):]
+                if '/' in source:
+                    # CASUs of other layers are not listed in this layer
+                    continue
+                nb_full_name = str(edge[1]).split('/')
+                nb_name = nb_full_name[-1]
+                nb_layer = layer
+                if len(nb_full_name) > 1:
+                    nb_layer = nb_full_name[0]
+                try:
+                    address = arena[nb_layer][nb_name]['msg_addr']
+                except (KeyError, TypeError):
+                    raise ValueError('[F] Neighbor {0}/{1} of CASU {2}/{3} is not in the arena!'.format(
+                        nb_layer, nb_name, layer, source))
+                side = str(edge.attr['label'])
+                casus.setdefault(source, {})[side] = {'name': nb_name, 'address': address}
+        return cls(index)
+
+    @classmethod
+    def from_file(cls, nbg_file_name, arena):
+        """
+        Build the index from a neighborhood graph (.nbg) file.
+        """
+        import pygraphviz as pgv
+        return cls.from_graph(pgv.AGraph(nbg_file_name), arena)
+
+    def has_layer(self, layer):
+        """
+        Returns True if the graph defines the connectivity of the layer.
+        """
+        return layer in self.__index
+
+    def has_casu(self, layer, casu):
+        """
+        Returns True if the graph defines the connectivity of the CASU.
+        """
+        return casu in self.__index.get(layer, {})
+
+    def neighbors(self, layer, casu):
+        """
+        Returns the neighbors of a CASU, as a map of sides to
+        {'name': neighbor name, 'address': neighbor message address}
+        dictionaries (the .rtc file format).
+        """
+        return dict([(side, dict(nb)) for (side, nb)
+                     in self.__index.get(layer, {}).get(casu, {}).items()])
+
+    def to_dict(self):
+        """
+        Returns the index as plain dictionaries.
+        """
+        return self.__index
+
+    @classmethod
+    def from_dict(cls, index):
+        """
+        Create the index from the dictionaries returned by :meth:`to_dict`.
+        """
+        return cls(index)
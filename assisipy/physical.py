@@ -3,24 +3,28 @@ Python API for manipulating simulated physical objects.
 """
 
 import threading
-import time
 
 import zmq
 
 from msg import base_msgs_pb2
 
+import comm
+
 class Object:
     """ 
     Interface to simulated physical objects. 
 
-    Connects to the simulated physical object. 
+    Connects to the simulated physical object, and waits for
+    its data (unless created with :meth:`connect_async`).
 
     :param string rtc_file_name: Name of the RTC file.
     :param string name: Unique name of the spawned physical object.
+    :param float timeout: Maximum time (in seconds) to wait for the object; :class:`comm.ConnectionTimeout` is raised if no data is received in time. None waits forever.
+    :param bool wait: Wait for the connection (see :meth:`connect_async`).
 
     """
     
-    def __init__(self, rtc_file_name='', name = 'object'):
+    def __init__(self, rtc_file_name='', name = 'object', timeout = None, wait = True):
 
         
         if rtc_file_name:
@@ -29,14 +33,15 @@ class Object:
         else:
             # Use default values
             self.__pub_addr = 'tcp://127.0.0.1:5556'
-            self.__sub_addr = 'tcp://127.0.0.1:5555',
+            self.__sub_addr = 'tcp://127.0.0.1:5555'
             self.__name = name
             self.x = 0
             self.y = 0
             self.yaw = 0
 
             # Create the data update thread
-            self.__connected = False
+            self.__connected = threading.Event()
+            self.__stop = False
             self.__context = zmq.Context(1)
             self.__comm_thread = threading.Thread(target=self.__update_readings)
             self.__comm_thread.daemon = True
@@ -47,13 +52,34 @@ class Object:
             self.__pub = self.__context.socket(zmq.PUB)
             self.__pub.connect(self.__pub_addr)
 
-            # Wait for the connection
-            while not self.__connected:
-                pass
-            print('{0} connected!'.format(self.__name))
+            if wait:
+                try:
+                    self.wait_connected(timeout)
+                except comm.ConnectionTimeout:
+                    # Release the connections, nobody else will
+                    self.stop()
+                    raise
+
+    @classmethod
+    def connect_async(cls, *args, **kwargs):
+        """
+        Create the object interface without waiting for the connection;
+        call :meth:`wait_connected` (or :func:`comm.wait_all`) before using it.
+        Takes the same parameters as the constructor.
+        """
+        kwargs['wait'] = False
+        return cls(*args, **kwargs)
+
+    def wait_connected(self, timeout = None):
+        """
+        Block until the position of the object has been received.
 
-            # Wait one more second to get all the data
-            time.sleep(1)
+        :param float timeout: Maximum waiting time in seconds (None waits forever).
+        :raises comm.ConnectionTimeout: If no data was received in time.
+        """
+        if not self.__connected.is_set():
+            comm.wait_ready(self.__connected, timeout, self.__name)
+            print('{0} connected!'.format(self.__name))
 
     def __update_readings(self):
         """  
@@ -62,10 +88,14 @@ class Object:
         self.__sub = self.__context.socket(zmq.SUB)
         self.__sub.connect(self.__sub_addr)
         self.__sub.setsockopt(zmq.SUBSCRIBE, self.__name)
-        
-        while True:
+
+        # Wake up periodically to be able to stop the thread
+        poller = zmq.Poller()
+        poller.register(self.__sub, zmq.POLLIN)
+        while not self.__stop:
+            if not poller.poll(500):
+                continue
             [name, dev, cmd, data] = self.__sub.recv_multipart()
-            self.__connected = True
             if dev == 'Pos':
                 if cmd == 'Get':
                     # Protect write with a lock
@@ -76,10 +106,22 @@ class Object:
                     self.x = pose.pose.position.x
                     self.y = pose.pose.position.y
                     self.yaw = pose.pose.orientation.z
+                    if not self.__connected.is_set():
+                        self.__connected.set()
                 else:
                     print('Unknown command {0} from {1}'.format(ranges, self.__name))
             else:
                 print('Unknown device ir for {0}'.format(self.__name))
+        self.__sub.close()
+
+    def stop(self):
+        """
+        Stop the receive thread and close the connection.
+        """
+        self.__stop = True
+        self.__comm_thread.join()
+        self.__pub.close()
+        self.__context.term()
 
 if __name__ == '__main__':
     
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ASSISI project model, shared by the deployment tools and the simulator tools.
+
+A project (.assisi) file refers to the arena (.arena), deployment (.dep),
+neighborhood graph (.nbg) and bee (.bees) files, with paths relative
+to the project folder. The files are parsed, and checked for consistency,
+once; the resulting model is cached on disk (as JSON, next to the project file),
+and reused as long as none of the files change.
+"""
+
+import os
+import hashlib
+import json
+
+import yaml
+try:
+    # libyaml is much faster than the pure Python parser
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+import neighborhood
+
+CACHE_VERSION = 2
+""" Version of the cached model format """
+
+DEP_KEYS = ['hostname', 'user', 'prefix', 'controller']
+""" Required CASU deployment specification keys """
+
+ARENA_KEYS = ['pub_addr', 'sub_addr', 'msg_addr']
+""" CASU arena specification keys required for deployment """
+
+def plain_strings(value):
+    """
+    Convert the (unicode) strings in data loaded from JSON to the
+    types the YAML parser returns: str, unless they are not ASCII.
+    """
+    if isinstance(value, dict):
+        return dict([(plain_strings(k), plain_strings(v)) for (k, v) in value.items()])
+    if isinstance(value, list):
+        return [plain_strings(item) for item in value]
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return value
+
+def load_yaml(file_name):
+    """
+    Parse a YAML file (with the libyaml based parser, if available).
+    """
+    with open(file_name) as yaml_file:
+        return yaml.load(yaml_file, Loader=SafeLoader)
+
+class Project:
+    """
+    ASSISI project model.
+
+    :param string project_file_name: Project (.assisi) file name.
+    :param require: Names of the project file entries ('arena', 'dep', 'nbg', 'bees')
+                    that have to be defined.
+    :param bool nbg: Read the neighborhood graph (requires pygraphviz, unless cached).
+    :param bool cache: Use (and update) the on-disk cache of the model.
+
+    Attributes: `root` (project folder), `name` (project name), `spec`
+    (the contents of the project file), `arena`, `dep` and `bees`
+    (the contents of the respective files, or None if not defined), and
+    `nbg` (a :class:`neighborhood.NeighborhoodIndex`, or None).
+    """
+
+    def __init__(self, project_file_name, require = ('arena', 'dep'), nbg = True, cache = True):
+        self.root = os.path.dirname(os.path.abspath(project_file_name))
+        self.name = os.path.splitext(os.path.basename(project_file_name))[0]
+        self.cache_file_name = os.path.join(self.root, '.' + self.name + '.cache')
+
+        self.spec = load_yaml(project_file_name)
+        if not isinstance(self.spec, dict):
+            raise ValueError('[F] {0} is not a valid project file!'.format(project_file_name))
+        for key in require:
+            if not self.file_name(key):
+                raise ValueError('[F] The project file {0} does not define the {1} file!'.format(
+                    project_file_name, key))
+
+        # The model only has to be parsed and validated if any of the files changed
+        self.__read_nbg = nbg
+        key = self.__digest(project_file_name)
+        model = None
+        if cache:
+            model = self.__load_cache(key)
+        if model is None:
+            model = self.__parse()
+            if cache:
+                self.__save_cache(key, model)
+
+        self.arena = model['arena']
+        self.dep = model['dep']
+        self.bees = model['bees']
+        self.nbg = None
+        if model['nbg'] is not None:
+            self.nbg = neighborhood.NeighborhoodIndex.from_dict(model['nbg'])
+
+    def file_name(self, key):
+        """
+        Returns the full path of the file the project file
+        entry key refers to (None if it is not defined).
+        """
+        name = self.spec.get(key)
+        if name is None or str(name).lower() in ['none', 'null', '']:
+            return None
+        return os.path.join(self.root, name)
+
+    def __digest(self, project_file_name):
+        """
+        Compute the digest of the contents of all the project files.
+        """
+        digest = hashlib.sha1()
+        for file_name in [project_file_name] + [self.file_name(key)
+                                                for key in ['arena', 'dep', 'nbg', 'bees']]:
+            if file_name is not None and os.path.exists(file_name):
+                with open(file_name, 'rb') as project_file:
+                    digest.update(project_file.read())
+            digest.update('\0')
+        digest.update(str(self.__read_nbg))
+        return digest.hexdigest()
+
+    def __load_cache(self, key):
+        # The cache is stored as JSON (data only), as the
+        # project folder may be writable by others
+        try:
+            with open(self.cache_file_name) as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, ValueError):
+            # No (usable) cache
+            return None
+        if (not isinstance(cached, dict) or cached.get('version') != CACHE_VERSION
+                or cached.get('key') != key):
+            return None
+        return plain_strings(cached['model'])
+
+    def __save_cache(self, key, model):
+        try:
+            text = json.dumps({'version': CACHE_VERSION, 'key': key, 'model': model})
+        except (TypeError, ValueError):
+            # Values JSON can not represent (e.g. dates)
+            return
+        if plain_strings(json.loads(text)['model']) != model:
+            # JSON would change the model (e.g. non-string keys)
+            return
+        try:
+            with open(self.cache_file_name, 'w') as cache_file:
+                cache_file.write(text)
+        except (IOError, OSError):
+            # The cache is optional (e.g. a read-only project folder)
+            pass
+
+    def __parse(self):
+        """
+        Parse and validate all the project files.
+        """
+        model = {'arena': None, 'dep': None, 'bees': None, 'nbg': None}
+        for key in ['arena', 'dep', 'bees']:
+            if self.file_name(key):
+                model[key] = load_yaml(self.file_name(key)) or {}
+        if self.__read_nbg and self.file_name('nbg'):
+            model['nbg'] = neighborhood.NeighborhoodIndex.from_file(
+                self.file_name('nbg'), model['arena'] or {}).to_dict()
+        errors = validate(model['arena'], model['dep'])
+        if errors:
+            raise ValueError('[F] Inconsistent project {0}:\n    {1}'.format(
+                self.name, '\n    '.join(errors)))
+        return model
+
+def validate(arena, dep):
+    """
+    Check the structure of the arena and deployment specifications, and
+    that every CASU in the deployment specification is in the arena.
+
+    :return: A list of error messages (empty if the specifications are valid).
+    """
+    errors = []
+    for (name, spec) in [('arena', arena), ('dep', dep)]:
+        if spec is None:
+            continue
+        if not isinstance(spec, dict):
+            errors.append('The {0} file does not define any layers.'.format(name))
+            continue
+        for layer in spec:
+            if spec[layer] is not None and not isinstance(spec[layer], dict):
+                errors.append('Layer {0} of the {1} file is not a map of CASUs.'.format(layer, name))
+    if errors or dep is None:
+        return errors
+
+    for layer in dep:
+        for casu in dep[layer] or {}:
+            if not isinstance(dep[layer][casu], dict):
+                errors.append('Deployment of {0}/{1} is not a map.'.format(layer, casu))
+                continue
+            missing = [key for key in DEP_KEYS if key not in dep[layer][casu]]
+            if missing:
+                errors.append('Deployment of {0}/{1} does not define {2}.'.format(
+                    layer, casu, ', '.join(missing)))
+            if arena is None:
+                continue
+            if casu not in (arena.get(layer) or {}):
+                errors.append('{0}/{1} is deployed, but it is not in the arena.'.format(layer, casu))
+                continue
+            missing = [key for key in ARENA_KEYS if key not in (arena[layer][casu] or {})]
+            if missing:
+                errors.append('{0}/{1} does not define {2} in the arena.'.format(
+                    layer, casu, ', '.join(missing)))
+    return errors
@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Pooled ssh connections and concurrent remote tasks,
+used by the deployment and data collection tools.
+
+Each host is connected to once (per user), and the connection is shared
+by all the tasks on that host; commands and file transfers run in their
+own channels over the shared connection.
+"""
+
+import os
+import sys
+import stat
+import select
+import zlib
+import pipes
+import tarfile
+import StringIO
+import hashlib
+import fnmatch
+import getpass
+import threading
+from multiprocessing.pool import ThreadPool
+
+import paramiko
+
+PER_HOST = 4
+""" Default maximum number of concurrent tasks per host """
+
+SYNC_WINDOW = 1 << 20
+"""
+Size of the block (the last one of the local copy) compared
+to check that a remote file was only appended to.
+"""
+
+COPY_BUFFER = 1 << 16
+
+def ssh_config(host):
+    """
+    Returns the ~/.ssh/config options for host (a dictionary,
+    empty if there is no configuration file).
+    """
+    config = paramiko.SSHConfig()
+    config_path = os.path.expanduser(os.path.join('~', '.ssh', 'config'))
+    if os.path.exists(config_path):
+        with open(config_path) as config_file:
+            config.parse(config_file)
+    return config.lookup(host)
+
+class Connection:
+    """
+    An ssh connection to a host, shared by any number of threads.
+
+    :param string host: Host name (or ~/.ssh/config alias).
+    :param string user: User name (None uses the configured or local user name).
+    """
+
+    def __init__(self, host, user = None):
+        config = ssh_config(host)
+        self.host = host
+        self.user = user or config.get('user') or getpass.getuser()
+        self.__client = paramiko.SSHClient()
+        self.__client.load_system_host_keys()
+        self.__client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        options = {'username': self.user,
+                   'port': int(config.get('port', 22))}
+        if 'identityfile' in config:
+            options['key_filename'] = config['identityfile']
+        self.__client.connect(config.get('hostname', host), **options)
+
+    def run(self, command, data = None):
+        """
+        Run command on the host.
+
+        :param string data: If given, written to the standard input of the command.
+        :return: (exit status, stdout, stderr) tuple.
+        """
+        (stdin, stdout, stderr) = self.__client.exec_command(command)
+        if data is not None:
+            stdin.write(data)
+            stdin.flush()
+        stdin.channel.shutdown_write()
+        out = stdout.read()
+        err = stderr.read()
+        return (stdout.channel.recv_exit_status(), out, err)
+
+    def check_run(self, command, data = None):
+        """
+        Like :meth:`run`, but raise RuntimeError if the command fails.
+
+        :return: The standard output of the command.
+        """
+        (status, out, err) = self.run(command, data)
+        if status != 0:
+            raise RuntimeError('{0}@{1}: {2} failed ({3}): {4}'.format(
+                self.user, self.host, command, status, err.strip()))
+        return out
+
+    def start(self, command, pty = True):
+        """
+        Start command on the host, without waiting for it to finish.
+
+        :param bool pty: Run the command in a pseudo-terminal (so it is
+                         hung up on when the channel is closed); its
+                         stderr is then merged into its stdout.
+        :return: The (paramiko) channel of the command.
+        """
+        channel = self.__client.get_transport().open_session()
+        if pty:
+            channel.get_pty()
+        channel.exec_command(command)
+        return channel
+
+    def is_active(self):
+        """
+        Returns False if the connection has been lost.
+        """
+        transport = self.__client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def sftp(self):
+        """
+        Open a new SFTP session; the caller closes it.
+        """
+        return self.__client.open_sftp()
+
+    def close(self):
+        self.__client.close()
+
+class ConnectionPool:
+    """
+    Opens one connection per (user, host), on first use, and limits the
+    number of concurrent tasks on each host.
+
+    :param int per_host: Maximum number of concurrent tasks per host.
+    """
+
+    def __init__(self, per_host = PER_HOST):
+        self.per_host = per_host
+        self.__lock = threading.Lock()
+        self.__connections = {}
+        self.__slots = {}
+
+    def get(self, host, user = None):
+        """
+        Returns the connection to user@host, connecting
+        (or reconnecting, if the connection was lost) if needed.
+        """
+        with self.__lock:
+            entry = self.__connections.setdefault((user, host), [threading.Lock(), None])
+        # Connect without blocking the tasks on other hosts
+        with entry[0]:
+            if entry[1] is None or not entry[1].is_active():
+                entry[1] = Connection(host, user)
+        return entry[1]
+
+    def slot(self, host):
+        """
+        Returns the semaphore limiting the concurrent tasks on host;
+        a task holds it (``with pool.slot(host):``) while it runs.
+        """
+        with self.__lock:
+            return self.__slots.setdefault(host, threading.BoundedSemaphore(self.per_host))
+
+    def close(self):
+        """
+        Close all the connections.
+        """
+        with self.__lock:
+            for (lock, connection) in self.__connections.values():
+                if connection is not None:
+                    connection.close()
+            self.__connections = {}
+
+def run_tasks(function, tasks, jobs = 1):
+    """
+    Call function(task) for all tasks, in a pool of jobs threads.
+
+    :return: A generator of (task, result, error) tuples, in the order
+             the tasks finish; error is the exception raised by the
+             task (None if it succeeded).
+    """
+    def call(task):
+        try:
+            return (task, function(task), None)
+        except Exception as e:
+            return (task, None, e)
+
+    pool = ThreadPool(max(1, min(jobs, len(tasks))))
+    try:
+        for result in pool.imap_unordered(call, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def relay_output(channel, name, pending, out = sys.stdout):
+    """
+    Print the output available on the channel of a remote command,
+    line by line, each line prefixed with the name of the command.
+    Never blocks.
+
+    :param dict pending: Map of channels to their incomplete last lines, updated.
+    :return: True if the command has finished (all its output has been printed).
+    """
+    lines = []
+    while channel.recv_stderr_ready():
+        lines.extend(channel.recv_stderr(COPY_BUFFER).splitlines())
+    data = None
+    # Only read when it does not block
+    if channel.recv_ready() or channel.eof_received:
+        data = channel.recv(COPY_BUFFER)
+    if data:
+        lines.extend((pending.get(channel, '') + data).split('\n'))
+        pending[channel] = lines.pop()
+    elif data == '' and pending.get(channel):
+        lines.append(pending.pop(channel))
+    for line in lines:
+        out.write('[{0}] {1}\n'.format(name, line.rstrip('\r')))
+    out.flush()
+    return data == ''
+
+def stream_output(channels, out = sys.stdout):
+    """
+    Print the output of remote commands (see :meth:`Connection.start`),
+    line by line, each line prefixed with the name of its command,
+    until all the commands finish.
+
+    :param dict channels: Map of channels to command names.
+    :return: A map of command names to exit statuses.
+    """
+    channels = dict(channels)
+    pending = {}
+    statuses = {}
+    while channels:
+        (ready, _, _) = select.select(channels.keys(), [], [], 1.0)
+        for channel in ready:
+            name = channels[channel]
+            if relay_output(channel, name, pending, out):
+                statuses[name] = channel.recv_exit_status()
+                channel.close()
+                del channels[channel]
+    return statuses
+
+class TransferStats:
+    """
+    Thread-safe per-host transfer statistics.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.hosts = {}
+
+    def __host(self, host):
+        return self.hosts.setdefault(host, {'files': 0, 'bytes': 0, 'start': None,
+                                            'end': None, 'failures': []})
+
+    def add(self, host, nbytes, files, start, end):
+        """
+        Record files transferred to or from host between the times start and end.
+        """
+        with self.__lock:
+            stats = self.__host(host)
+            stats['files'] += files
+            stats['bytes'] += nbytes
+            if stats['start'] is None or start < stats['start']:
+                stats['start'] = start
+            if stats['end'] is None or end > stats['end']:
+                stats['end'] = end
+
+    def fail(self, host, what, error):
+        """
+        Record a failed task on host.
+        """
+        with self.__lock:
+            self.__host(host)['failures'].append('{0}: {1}'.format(what, error))
+
+    def failures(self):
+        """
+        Returns the total number of failed tasks.
+        """
+        return sum([len(stats['failures']) for stats in self.hosts.values()])
+
+    def report(self):
+        """
+        Print the per-host summary.
+        """
+        for host in sorted(self.hosts):
+            stats = self.hosts[host]
+            elapsed = 0.0
+            if stats['start'] is not None:
+                elapsed = max(stats['end'] - stats['start'], 1e-6)
+            rate = stats['bytes']/1e6/elapsed if elapsed else 0.0
+            print('{0}: {1} files, {2:.1f} MB in {3:.1f} s ({4:.1f} MB/s), {5} failed'.format(
+                host, stats['files'], stats['bytes']/1e6, elapsed, rate, len(stats['failures'])))
+            for failure in stats['failures']:
+                print('    [E] ' + failure)
+
+OBJECTS_DIR = '.assisi_objects'
+"""
+Remote content-addressed file store (under each deployment prefix);
+files are stored by their sha1 digest, and hard-linked to their destinations.
+"""
+
+MANIFEST_FILE = '.assisi_manifest'
+"""
+Remote manifest of the deployed files of a folder: one 'sha1  name' line per file.
+"""
+
+def archive(files):
+    """
+    Pack local files into an in-memory tar.gz archive,
+    to be extracted remotely with 'tar -xzf - -C destination'.
+
+    :param dict files: Map of archive member names to local paths.
+    :return: The archive data.
+    """
+    data = StringIO.StringIO()
+    tar = tarfile.open(fileobj=data, mode='w:gz')
+    try:
+        for name in sorted(files):
+            tar.add(files[name], arcname=name)
+    finally:
+        tar.close()
+    return data.getvalue()
+
+def file_sha1(path):
+    """
+    Returns the sha1 hex digest of a local file.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as local_file:
+        for data in iter(lambda: local_file.read(COPY_BUFFER), ''):
+            sha1.update(data)
+    return sha1.hexdigest()
+
+def file_manifest(directory):
+    """
+    Returns a map of the paths of all the files in a local directory
+    (relative to the directory) to their sha1 digests.
+    """
+    manifest = {}
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            manifest[os.path.relpath(path, directory)] = file_sha1(path)
+    return manifest
+
+def parse_manifest(text):
+    """
+    Parse a remote manifest (see MANIFEST_FILE) into a map of names to sha1 digests.
+    """
+    manifest = {}
+    for line in text.splitlines():
+        (sha1, sep, name) = line.partition('  ')
+        if name:
+            manifest[name] = sha1
+    return manifest
+
+def link_script(objects_dir, destdir, manifest, old_manifest = {}, executable = ()):
+    """
+    Returns a shell script updating a remote folder from the files
+    of a content-addressed store (see OBJECTS_DIR): files that are new
+    or changed since old_manifest are hard-linked from the store, files
+    that are no longer deployed are removed, and other files (e.g. logs)
+    are left alone.
+
+    :param dict manifest: Map of file names to sha1 digests to deploy.
+    :param dict old_manifest: The files deployed previously.
+    :param executable: Names of the files to make executable.
+    """
+    lines = ['mkdir -p ' + pipes.quote(destdir)]
+    for name in sorted(set(old_manifest) - set(manifest)):
+        lines.append('rm -f ' + pipes.quote(os.path.join(destdir, name)))
+    for name in sorted(manifest):
+        if old_manifest.get(name) == manifest[name]:
+            continue
+        path = os.path.join(destdir, name)
+        if os.path.dirname(name):
+            lines.append('mkdir -p ' + pipes.quote(os.path.dirname(path)))
+        lines.append('ln -f {0} {1}'.format(
+            pipes.quote(os.path.join(objects_dir, manifest[name])), pipes.quote(path)))
+    for name in executable:
+        lines.append('chmod +x ' + pipes.quote(os.path.join(destdir, name)))
+    lines.append("cat > {0} <<'ASSISI_MANIFEST'".format(
+        pipes.quote(os.path.join(destdir, MANIFEST_FILE))))
+    lines.extend(['{0}  {1}'.format(manifest[name], name) for name in sorted(manifest)])
+    lines.append('ASSISI_MANIFEST')
+    return '\n'.join(lines) + '\n'
+
+def glob(sftp, directory, patterns):
+    """
+    Find the entries of a remote directory matching any of the patterns
+    (which may include subdirectories, e.g. 'results/*.txt').
+
+    :return: A list of (path, attributes) tuples.
+    """
+    listings = {}
+    found = {}
+    for pattern in patterns:
+        (subdir, name_pattern) = os.path.split(pattern)
+        path = os.path.join(directory, subdir)
+        if path not in listings:
+            try:
+                listings[path] = sftp.listdir_attr(path)
+            except IOError:
+                # The directory does not exist
+                listings[path] = []
+        for attr in listings[path]:
+            if fnmatch.fnmatch(attr.filename, name_pattern):
+                found[os.path.join(path, attr.filename)] = attr
+    return sorted(found.items())
+
+def walk(sftp, entries, local_dir):
+    """
+    Expand remote directories (see :func:`glob`) into the files they contain.
+
+    :return: A list of (path, attributes, local path) tuples.
+    """
+    files = []
+    for (path, attr) in entries:
+        local_path = os.path.join(local_dir, os.path.basename(path))
+        if stat.S_ISDIR(attr.st_mode):
+            if not os.path.isdir(local_path):
+                os.makedirs(local_path)
+            files.extend(walk(sftp, [(os.path.join(path, entry.filename), entry)
+                                     for entry in sftp.listdir_attr(path)], local_path))
+        else:
+            files.append((path, attr, local_path))
+    return files
+
+def local_md5(path, start, end):
+    """
+    Returns the md5 hex digest of bytes start to end of a local file.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as local_file:
+        local_file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = local_file.read(min(remaining, COPY_BUFFER))
+            if not data:
+                break
+            md5.update(data)
+            remaining -= len(data)
+    return md5.hexdigest()
+
+def md5_command(path, start, end):
+    """
+    Returns the shell command printing the md5 digest
+    of bytes start to end of a remote file.
+    """
+    return 'tail -c +{0} {1} | head -c {2} | md5sum'.format(
+        start + 1, pipes.quote(path), end - start)
+
+def fetch(connection, sftp, path, local_path, offset = 0, compress = False):
+    """
+    Download a remote file from byte offset on, appending to the local
+    copy (or replacing it, if offset is 0).
+
+    :param bool compress: Gzip the data in transit.
+    :return: The number of bytes transferred.
+    """
+    mode = 'ab' if offset else 'wb'
+    if compress:
+        data = connection.check_run('tail -c +{0} {1} | gzip -c'.format(
+            offset + 1, pipes.quote(path)))
+        with open(local_path, mode) as local_file:
+            local_file.truncate(offset)
+            local_file.write(zlib.decompress(data, 16 + zlib.MAX_WBITS))
+        return len(data)
+
+    nbytes = 0
+    remote_file = sftp.open(path, 'rb')
+    try:
+        remote_file.seek(offset)
+        remote_file.prefetch()
+        with open(local_path, mode) as local_file:
+            local_file.truncate(offset)
+            while True:
+                data = remote_file.read(COPY_BUFFER)
+                if not data:
+                    break
+                local_file.write(data)
+                nbytes += len(data)
+    finally:
+        remote_file.close()
+    return nbytes
+
+def sync(connection, sftp, entries, local_dir, incremental = True, compress = False):
+    """
+    Download remote files and directories (see :func:`glob`) to local_dir.
+
+    In incremental mode, files are assumed to be append-only (as logs
+    are): a local copy that is not larger than the remote file, and whose
+    last SYNC_WINDOW bytes match the remote file, is completed with the
+    bytes appended since; other files are downloaded again. All the
+    checksums of a task are computed by a single remote command.
+
+    :param bool compress: Gzip the data in transit.
+    :return: (files, bytes) tuple; the number of transferred files and bytes.
+    """
+    files = walk(sftp, entries, local_dir)
+    offsets = [0] * len(files)
+
+    if incremental:
+        checks = []
+        for (i, (path, attr, local_path)) in enumerate(files):
+            if os.path.exists(local_path):
+                size = os.path.getsize(local_path)
+                if 0 < size <= attr.st_size:
+                    checks.append((i, max(0, size - SYNC_WINDOW), size))
+        if checks:
+            out = connection.check_run('; '.join(
+                [md5_command(files[i][0], start, end) for (i, start, end) in checks]))
+            remote_sums = [line.split()[0] for line in out.splitlines() if line.strip()]
+            for ((i, start, end), remote_sum) in zip(checks, remote_sums):
+                if local_md5(files[i][2], start, end) == remote_sum:
+                    offsets[i] = end
+
+    nfiles = 0
+    nbytes = 0
+    for ((path, attr, local_path), offset) in zip(files, offsets):
+        if offset and offset == attr.st_size:
+            # Unchanged
+            continue
+        nbytes += fetch(connection, sftp, path, local_path, offset, compress)
+        nfiles += 1
+    return (nfiles, nbytes)
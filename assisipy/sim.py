@@ -5,28 +5,31 @@
 
 import argparse
 import threading
-import time
-import os
 import sys
 
-import yaml
 import zmq
 
 from msg import sim_msgs_pb2
 from msg import base_msgs_pb2
 from msg import dev_msgs_pb2
 
+import comm
+from project import Project, load_yaml
+
 class Control:
     """
     Simulator control API.
 
     Creates a command publisher and connects it to the simulator.
+    Waits for data from the simulator (unless created with :meth:`connect_async`).
 
     :param string rtc_file_name: Name of the run-time configuraiton file. This file specifies the parameters for connecting to the simulator.
+    :param float timeout: Maximum time (in seconds) to wait for the simulator; :class:`comm.ConnectionTimeout` is raised if no data is received in time. None waits forever.
+    :param bool wait: Wait for the connection (see :meth:`connect_async`).
 
     """
 
-    def __init__(self, rtc_file_name='', **kwargs):
+    def __init__(self, rtc_file_name='', timeout = None, wait = True, **kwargs):
 
         if rtc_file_name:
             # Parse the rtc file
@@ -50,16 +53,43 @@ class Control:
             #       to prevent program crashes.
             self.__absolute_time = base_msgs_pb2.Time()
             # Create the data update thread
-            self.__connected = False
-            self.__context = zmq.Context(1)
+            # (sharing the context of the publisher socket)
+            self.__connected = threading.Event()
+            self.__stop = False
             self.__comm_thread = threading.Thread(target=self.__update_readings)
             self.__comm_thread.daemon = True
             self.__lock = threading.Lock()
+            self.__messages = comm.MessageTable(self.__lock, 'sim control')
+            self.__messages.add('AbsoluteTime', 'Value', self.__absolute_time)
             # Connect to the server and start receiving data
             self.__comm_thread.start()
-            # Wait for the connection
-            while not self.__connected:
-                time.sleep(1)
+            if wait:
+                try:
+                    self.wait_connected(timeout)
+                except comm.ConnectionTimeout:
+                    # Release the connections, nobody else will
+                    self.stop()
+                    raise
+
+    @classmethod
+    def connect_async(cls, *args, **kwargs):
+        """
+        Create the simulator control without waiting for the connection;
+        call :meth:`wait_connected` before using it.
+        Takes the same parameters as the constructor.
+        """
+        kwargs['wait'] = False
+        return cls(*args, **kwargs)
+
+    def wait_connected(self, timeout = None):
+        """
+        Block until data from the simulator has been received.
+
+        :param float timeout: Maximum waiting time in seconds (None waits forever).
+        :raises comm.ConnectionTimeout: If no data was received in time.
+        """
+        if not self.__connected.is_set():
+            comm.wait_ready(self.__connected, timeout, 'the simulator')
             print('Simulator control connected!')
 
     def spawn(self,
@@ -169,47 +199,60 @@ class Control:
             sys.exit(1) # TODO: This might have some issues, as we're within a thread
         self.__sub.setsockopt(zmq.SUBSCRIBE, 'Sim')
 
-        while True:
+        # Wake up periodically to be able to stop the thread
+        poller = zmq.Poller()
+        poller.register(self.__sub, zmq.POLLIN)
+        while not self.__stop:
+            if not poller.poll(500):
+                continue
             [name, dev, cmd, data] = self.__sub.recv_multipart()
-            self.__connected = True
-            if dev == 'AbsoluteTime':
-                if cmd == 'Value':
-                    # Protect write with a lock
-                    # to make sure all data is written before access
-                    with self.__lock:
-                        self.__absolute_time.ParseFromString(data)
-                else:
-                    print('Unknown command {0} for sim control'.format(cmd))
+            self.__messages.dispatch(dev, cmd, data)
+            if not self.__connected.is_set():
+                self.__connected.set()
+        self.__sub.close()
 
+    def stop(self):
+        """
+        Stop the receive thread and close the connection.
+        """
+        self.__stop = True
+        self.__comm_thread.join()
+        self.__pub.close()
+        self.__context.term()
 
-def spawn_array_from_file(obj_type, array_filename, address, layer_select='all', sub_addr=None):
-    with open(array_filename) as array_file:
-        arrays = yaml.safe_load(array_file)
-        # Several arrays can be defined within one file
-        # Select particular layers
-        selected_layers = arrays.keys()
-        if layer_select != 'all':
-            selected_layers = [layer_select]
-            if layer_select not in arrays.keys():
-                raise ValueError (
-                    "[F] {} is not a layer in this specification! aborting.".format(
-                        layer_select))
-
-        for layer in selected_layers:
-            # Spawn only simulated arrays
-            print('Spawning objects to pub_addr {} in layer {}...'.format(address, layer))
-            if arrays[layer]:
-                ## The array is non-empty, get the first element
-                #obj_name = arrays[layer].keys()[0]
-                #sim_ctrl = Control(pub_addr = address)
-                if sub_addr is None:
-                    sim_ctrl = Control(pub_addr = address)
-                else:
-                    sim_ctrl = Control(pub_addr = address, sub_addr=sub_addr)
-
-                sim_ctrl.spawn_array(obj_type, arrays[layer])
+
+def spawn_arrays(obj_type, arrays, address, layer_select='all', sub_addr=None):
+    """
+    Spawn the object arrays of an .arena/.bees specification.
+    """
+    # Several arrays can be defined within one file
+    # Select particular layers
+    selected_layers = arrays.keys()
+    if layer_select != 'all':
+        selected_layers = [layer_select]
+        if layer_select not in arrays.keys():
+            raise ValueError (
+                "[F] {} is not a layer in this specification! aborting.".format(
+                    layer_select))
+
+    for layer in selected_layers:
+        # Spawn only simulated arrays
+        print('Spawning objects to pub_addr {} in layer {}...'.format(address, layer))
+        if arrays[layer]:
+            ## The array is non-empty, get the first element
+            #obj_name = arrays[layer].keys()[0]
+            #sim_ctrl = Control(pub_addr = address)
+            if sub_addr is None:
+                sim_ctrl = Control(pub_addr = address)
+            else:
+                sim_ctrl = Control(pub_addr = address, sub_addr=sub_addr)
+
+            sim_ctrl.spawn_array(obj_type, arrays[layer])
     # no return value here
 
+def spawn_array_from_file(obj_type, array_filename, address, layer_select='all', sub_addr=None):
+    spawn_arrays(obj_type, load_yaml(array_filename), address, layer_select, sub_addr)
+
 def main():
     parser = argparse.ArgumentParser(description='Spawn an array of objects (casus or bees), as defined in an .arena/.bees file.')
     parser.add_argument('specfile', help= 'name of file specifying the objects to spawn. Accepts: .arena or .bees direct spec, or .assisi project spec')
@@ -225,23 +268,22 @@ def main():
         spawn_array_from_file('Bee', args.specfile, args.address, args.layer, sub_addr=args.sub_addr)
     elif args.specfile.endswith('.assisi'):
         # find any contained specification files (arena, agents)
-        with open(args.specfile) as project_file:
-            project = yaml.safe_load(project_file)
-
-        project_root = os.path.dirname(os.path.abspath(args.specfile))
+        project = Project(args.specfile, require=(), nbg=False)
         found = 0
         keylist = ['arena', 'bees']
         for key in keylist:
-            if key in project:
+            if project.file_name(key):
                 found += 1
-                array_filename = os.path.join(project_root, project[key])
 
                 obj_type = 'unknown'
+                arrays = {}
                 if key == 'arena':
                     obj_type = 'Casu'
+                    arrays = project.arena
                 elif key == 'bees':
                     obj_type = 'Bee'
-                spawn_array_from_file(obj_type, array_filename, args.address, args.layer, sub_addr=args.sub_addr)
+                    arrays = project.bees
+                spawn_arrays(obj_type, arrays, args.address, args.layer, sub_addr=args.sub_addr)
 
         if found == 0:
             raise IOError, "[E] specification file ({}) does not define any spawnable subfiles ({})\ndid you really supply an .assisi file?".format(", ".join(keylist),  args.specfile)
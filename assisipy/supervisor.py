@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Supervisor of remotely running CASU controllers (see ``assisirun --supervise``).
+
+The controllers report their health in periodic heartbeats (see
+:class:`comm.Heartbeat`). The supervisor prints a table of the latest
+reports, and restarts the controllers that stall (stop reporting, or stop
+receiving data from their CASU) or fail, waiting longer after each
+consecutive failure.
+"""
+
+import sys
+import json
+import time
+
+import zmq
+
+import remote
+
+class Controller:
+    """
+    State of one supervised controller.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.channel = None
+        self.state = 'waiting'
+        self.started = None
+        self.next_start = 0.0
+        self.failures = 0
+        self.starts = 0
+        self.status = None
+        # Latest heartbeat, the time it was received,
+        # and the time the received frame count last increased
+        self.health = None
+        self.last_beat = None
+        self.last_progress = None
+
+class Supervisor:
+    """
+    Controller supervisor.
+
+    :param string address: Heartbeat address 'tcp://host:port', as seen by the
+                           controllers; the supervisor listens on port on all interfaces.
+    :param start: A function taking a controller name, (re)starting the controller,
+                  and returning its channel (see :meth:`remote.Connection.start`).
+    :param float stall_timeout: A controller is stalled if it has not received any new
+                                data for stall_timeout seconds (or since it was started).
+    :param float backoff: Delay (in seconds) before the first restart of a controller;
+                          the delay is doubled after each consecutive failure.
+    :param float backoff_max: Maximum restart delay. A controller that ran for at least
+                              this long before failing is restarted after the initial delay again.
+    :param float table_interval: Interval (in seconds) of printing the health table.
+    """
+
+    def __init__(self, address, start, stall_timeout = 20.0, backoff = 1.0,
+                 backoff_max = 60.0, table_interval = 10.0, out = sys.stdout):
+        self.address = address
+        self.__start = start
+        self.__stall_timeout = stall_timeout
+        self.__backoff = backoff
+        self.__backoff_max = backoff_max
+        self.__table_interval = table_interval
+        self.__out = out
+        self.__controllers = {}
+        # Polled channels, by file descriptor (the poller reports those)
+        self.__channels = {}
+        self.__pending = {}
+
+        self.__context = zmq.Context(1)
+        self.__heartbeats = self.__context.socket(zmq.PULL)
+        port = address.rsplit(':', 1)[-1]
+        try:
+            self.__heartbeats.bind('tcp://*:' + port)
+        except zmq.error.ZMQError:
+            print('CONNECTION ERROR: Failed to bind to port {0}'.format(port))
+            raise
+        self.__poller = zmq.Poller()
+        self.__poller.register(self.__heartbeats, zmq.POLLIN)
+
+    def add(self, name, channel = None):
+        """
+        Supervise the controller name, running on channel
+        (started by the supervisor, if channel is None).
+        """
+        controller = Controller(name)
+        self.__controllers[name] = controller
+        if channel is not None:
+            self.__attach(controller, channel, time.time())
+
+    def run(self):
+        """
+        Supervise the controllers until they all finish successfully.
+
+        :return: A map of controller names to exit statuses.
+        """
+        next_table = time.time() + self.__table_interval
+        try:
+            while [c for c in self.__controllers.values() if c.state != 'done']:
+                events = dict(self.__poller.poll(250))
+                now = time.time()
+                for socket in events:
+                    if socket is self.__heartbeats:
+                        self.__receive(now)
+                    elif socket in self.__channels:
+                        self.__relay(self.__channels[socket], now)
+                for controller in self.__controllers.values():
+                    if controller.state == 'running':
+                        self.__check(controller, now)
+                    elif controller.state == 'waiting' and now >= controller.next_start:
+                        self.__restart(controller)
+                if now >= next_table:
+                    self.print_table()
+                    next_table = now + self.__table_interval
+            self.print_table()
+        finally:
+            # Closing the channels hangs up on the controllers still running
+            for controller in self.__channels.values():
+                controller.channel.close()
+            self.__channels = {}
+        return dict([(c.name, c.status) for c in self.__controllers.values()])
+
+    def close(self):
+        self.__heartbeats.close(0)
+        self.__context.term()
+
+    def __attach(self, controller, channel, now):
+        controller.channel = channel
+        controller.state = 'running'
+        controller.started = now
+        controller.starts += 1
+        controller.health = None
+        controller.last_beat = None
+        controller.last_progress = None
+        self.__channels[channel.fileno()] = controller
+        self.__poller.register(channel.fileno(), zmq.POLLIN)
+
+    def __detach(self, controller):
+        channel = controller.channel
+        self.__poller.unregister(channel.fileno())
+        del self.__channels[channel.fileno()]
+        self.__pending.pop(channel, None)
+        controller.channel = None
+        return channel
+
+    def __receive(self, now):
+        """
+        Record all the pending heartbeats.
+        """
+        while True:
+            try:
+                (kind, name, data) = self.__heartbeats.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            controller = self.__controllers.get(name)
+            if kind != 'hb' or controller is None or controller.state != 'running':
+                continue
+            try:
+                health = json.loads(data)
+            except ValueError:
+                continue
+            previous = 0
+            if controller.health is not None:
+                previous = controller.health['frames']
+            if health['frames'] > previous:
+                controller.last_progress = now
+            controller.health = health
+            controller.last_beat = now
+
+    def __relay(self, controller, now):
+        """
+        Print the output of a controller, and handle its exit.
+        """
+        channel = controller.channel
+        if not remote.relay_output(channel, controller.name, self.__pending, self.__out):
+            return
+        self.__detach(controller)
+        controller.status = channel.recv_exit_status()
+        channel.close()
+        if controller.status == 0:
+            controller.state = 'done'
+        else:
+            self.__failed(controller, 'exited with status {0}'.format(controller.status), now)
+
+    def __check(self, controller, now):
+        """
+        Restart the controller if it is stalled.
+        """
+        if now - (controller.last_progress or controller.started) < self.__stall_timeout:
+            return
+        if controller.last_beat is None or now - controller.last_beat >= self.__stall_timeout:
+            reason = 'sends no heartbeats'
+        elif not controller.health.get('connected'):
+            reason = 'is not connected'
+        else:
+            reason = 'receives no data'
+        # Closing the channel hangs up on the controller
+        self.__detach(controller).close()
+        self.__failed(controller, 'stalled ({0})'.format(reason), now)
+
+    def __failed(self, controller, reason, now):
+        """
+        Schedule the restart of a failed controller.
+        """
+        if controller.started is not None and now - controller.started >= self.__backoff_max:
+            controller.failures = 0
+        controller.failures += 1
+        delay = min(self.__backoff_max, self.__backoff * 2 ** (controller.failures - 1))
+        controller.state = 'waiting'
+        controller.next_start = now + delay
+        self.__say('[W] {0} {1}, restarting in {2:.0f} s'.format(controller.name, reason, delay))
+
+    def __say(self, line):
+        self.__out.write(line + '\n')
+        self.__out.flush()
+
+    def __restart(self, controller):
+        now = time.time()
+        try:
+            channel = self.__start(controller.name)
+        except Exception as e:
+            controller.started = None
+            self.__failed(controller, 'failed to start: {0}'.format(e), now)
+            return
+        self.__attach(controller, channel, now)
+        self.__say('Started the controller of {0}.'.format(controller.name))
+
+    def print_table(self):
+        """
+        Print the latest health reports of all the controllers.
+        """
+        now = time.time()
+        lines = ['{0:<24} {1:<8} {2:>7} {3:>6} {4:>8} {5:>8} {6:>6} {7:>6} {8:>5} {9:>8}'.format(
+            'controller', 'state', 'up [s]', 'hb [s]', 'loop/s', 'recv/s',
+            'msg q', 'log q', 'conn', 'restarts')]
+        for name in sorted(self.__controllers):
+            c = self.__controllers[name]
+            up = beat = loop = recv = msgq = logq = conn = '-'
+            if c.state == 'running':
+                up = '{0:.0f}'.format(now - c.started)
+            if c.state == 'running' and c.health is not None:
+                beat = '{0:.1f}'.format(now - c.last_beat)
+                loop = '{0:.1f}'.format(c.health['loop_rate'])
+                recv = '{0:.1f}'.format(c.health['recv_rate'])
+                msgq = str(c.health['msg_queue'])
+                logq = str(c.health['log_queue'])
+                conn = 'yes' if c.health['connected'] else 'no'
+            lines.append('{0:<24} {1:<8} {2:>7} {3:>6} {4:>8} {5:>8} {6:>6} {7:>6} {8:>5} {9:>8}'.format(
+                name, c.state, up, beat, loop, recv, msgq, logq, conn, max(0, c.starts - 1)))
+        self.__say('\n'.join(lines))
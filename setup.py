@@ -83,7 +83,13 @@ setup(
     keywords='assisi, assisibf, collective systems',
 
     # Run-time dependencies (will be installed by pip)
-    install_requires = ['pyzmq','protobuf','pyyaml', 'pygraphviz', 'Fabric'],
+    install_requires = ['pyzmq','protobuf','pyyaml', 'pygraphviz', 'paramiko',
+                        'numpy', 'scipy'],
+
+    # Optional dependencies (pip install assisipy[hdf5])
+    extras_require = {
+        'hdf5': ['h5py'],
+    },
 
     entry_points     = {
         'console_scripts': console_scripts,
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Helpers shared by the tests.
+"""
+
+import socket
+
+def free_port():
+    """
+    Returns a TCP port that is free on the loopback interface.
+    """
+    s = socket.socket()
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+def free_address():
+    """
+    Returns a free 'tcp://127.0.0.1:port' ZMQ address.
+    """
+    return 'tcp://127.0.0.1:{0}'.format(free_port())
+
+def free_port_pair():
+    """
+    Returns a port p such that p and p + 1 are free.
+    """
+    while True:
+        sockets = [socket.socket()]
+        sockets[0].bind(('127.0.0.1', 0))
+        port = sockets[0].getsockname()[1]
+        try:
+            sockets.append(socket.socket())
+            sockets[1].bind(('127.0.0.1', port + 1))
+            return port
+        except socket.error:
+            pass
+        finally:
+            for s in sockets:
+                s.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of loading and aggregating CASU logfiles.
+"""
+
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+
+from assisipy import aggregate_data
+from assisipy import logger
+
+LOG = '2016-01-01-00-00-00-casu-001'
+
+def csv_rows(t0, n):
+    return ''.join(['temp;{0};20.0;21.0\n'.format(t0 + i) for i in range(n)])
+
+def bin_rows(t0, n):
+    """
+    Returns a binary log (including the signature) of n rows.
+    """
+    rows = [['temp', float(t0 + i), 20.0, 21.0] for i in range(n)]
+    logfile = StringFile()
+    logger.BinEncoder(logfile).write(rows)
+    return logfile.content
+
+class StringFile:
+
+    def __init__(self):
+        self.content = ''
+
+    def write(self, data):
+        self.content += data
+
+class TestAggregate(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.casu_folder = os.path.join(self.folder, 'casu-001')
+        os.mkdir(self.casu_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, filename, content):
+        path = os.path.join(self.casu_folder, filename)
+        if filename.endswith('.gz'):
+            logfile = gzip.open(path, 'wb')
+        else:
+            logfile = open(path, 'wb')
+        with logfile:
+            logfile.write(content)
+        return path
+
+    def times(self, data):
+        return list(data['casu_001']['t_temp'])
+
+    def test_segments_in_order(self):
+        self.write(LOG + '.0001.csv', csv_rows(1010, 10))
+        self.write(LOG + '.0000.csv.gz', csv_rows(1000, 10))
+        data = aggregate_data.process_folder(self.folder)
+        self.assertEqual(self.times(data), range(1000, 1020))
+        self.assertEqual(data['casu_001']['temp'].shape, (20, 2))
+
+    def test_plain_and_compressed_segment(self):
+        # The segment was collected before and after it was compressed
+        self.write(LOG + '.0000.csv', csv_rows(1000, 5))
+        gz_path = self.write(LOG + '.0000.csv.gz', csv_rows(1000, 10))
+        path = self.write(LOG + '.0001.csv', csv_rows(1010, 10))
+        self.assertEqual(sorted(aggregate_data.find_logs(self.folder)['casu_001']),
+                         [('2016-01-01-00-00-00', 0, gz_path),
+                          ('2016-01-01-00-00-00', 1, path)])
+        data = aggregate_data.process_folder(self.folder)
+        self.assertEqual(self.times(data), range(1000, 1020))
+
+class TestWriters(TestAggregate):
+
+    def aggregate(self, fmt, append = False):
+        """
+        Aggregate the logs to the fmt output format.
+
+        :return: A :class:`aggregate_data.LogStore` of the output.
+        """
+        writer = aggregate_data.WRITERS[fmt](os.path.join(self.folder, 'out'), append)
+        aggregate_data.process_folder(self.casu_folder, writer = writer)
+        writer.close()
+        return aggregate_data.LogStore(writer.path)
+
+    def test_records_without_rows(self):
+        # The accelerometer rows are not numbers, so they are skipped
+        path = self.write(LOG + '.csv', csv_rows(1000, 3) + 'Acc;1000;x;y\n')
+        for fmt in ['cols', 'hdf5']:
+            store = self.aggregate(fmt)
+            self.assertEqual(store.records('casu_001'), ['Acc', 'temp'])
+            self.assertEqual(len(store.timestamps('casu_001', 'Acc')), 0)
+            self.assertEqual(store.values('casu_001', 'Acc').shape, (0, 0))
+            self.assertEqual(store.values('casu_001', 'temp').shape, (3, 2))
+            store.close()
+        # Rows of a declared record are appended later on
+        os.remove(path)
+        self.write(LOG + '.0001.csv', 'Acc;1010;1.0;2.0\n')
+        store = self.aggregate('hdf5', append = True)
+        self.assertEqual(list(store.timestamps('casu_001', 'Acc')), [1010.0])
+        self.assertEqual(store.values('casu_001', 'Acc').shape, (1, 2))
+        store.close()
+
+    def test_query(self):
+        rows = ''.join(['temp;{0};{1};{2}\nir_raw;{0};{3}\n'.format(t, t + 0.5, t + 0.25, -t)
+                        for t in range(1000, 1010)])
+        self.write(LOG + '.csv', rows)
+        for fmt in ['cols', 'hdf5', 'mat']:
+            store = self.aggregate(fmt)
+            # [t0, t1), with bounds on and between the samples
+            (t, values) = store.query('casu_001', 'temp', 1002, 1005)
+            self.assertEqual(list(t), [1002, 1003, 1004])
+            self.assertEqual(values[:, 0].tolist(), [1002.5, 1003.5, 1004.5])
+            self.assertEqual(values[:, 1].tolist(), [1002.25, 1003.25, 1004.25])
+            (t, values) = store.query('casu_001', 'temp', 1001.5, 1002.5)
+            self.assertEqual(list(t), [1002])
+            # Open and empty ranges
+            self.assertEqual(len(store.query('casu_001', 'temp')[0]), 10)
+            self.assertEqual(list(store.query('casu_001', 'temp', t1 = 1001)[0]), [1000])
+            self.assertEqual(list(store.query('casu_001', 'temp', t0 = 1009)[0]), [1009])
+            self.assertEqual(len(store.query('casu_001', 'temp', 1020)[0]), 0)
+            self.assertEqual(len(store.query('casu_001', 'temp', 1005, 1005)[0]), 0)
+            # Each record has its own columns
+            (t, values) = store.query('casu_001', 'ir_raw', 1008)
+            self.assertEqual(list(t), [1008, 1009])
+            self.assertEqual(values.shape, (2, 1))
+            self.assertEqual(values[:, 0].tolist(), [-1008, -1009])
+            store.close()
+
+class TestIncremental(TestAggregate):
+
+    def setUp(self):
+        TestAggregate.setUp(self)
+        self.outname = os.path.join(self.folder, 'out')
+
+    def aggregate(self, record = 'temp'):
+        """
+        Aggregate the logs incrementally to a column store, like
+        ``aggregate_data.py -i -f cols`` does.
+
+        :return: The timestamps of all the aggregated rows of record.
+        """
+        outpath = self.outname + aggregate_data.ColumnWriter.extension
+        manifest = aggregate_data.load_manifest(outpath)
+        writer = aggregate_data.ColumnWriter(self.outname, append = bool(manifest))
+        aggregate_data.process_folder(self.casu_folder, manifest = manifest, writer = writer)
+        writer.close()
+        aggregate_data.save_manifest(writer.path, manifest)
+        store = aggregate_data.LogStore(writer.path)
+        times = list(store.timestamps('casu_001', record))
+        store.close()
+        return times
+
+    def test_appended_rows(self):
+        self.write(LOG + '.csv', csv_rows(1000, 5) + 'temp;1005;2')
+        self.assertEqual(self.aggregate(), range(1000, 1005))
+        # The incomplete row is completed
+        self.write(LOG + '.csv', csv_rows(1000, 10))
+        self.assertEqual(self.aggregate(), range(1000, 1010))
+        self.assertEqual(self.aggregate(), range(1000, 1010))
+
+    def test_shorter_final_row(self):
+        # Setpoint rows have a varying number of fields
+        # (rows of each length go to a dataset of their own)
+        rows = 'VibrationPattern;1.0;1;2;3\nVibrationPattern;2.0;0\n'
+        self.write(LOG + '.csv', rows)
+        self.assertEqual(self.aggregate('VibrationPattern'), [2.0])
+        self.write(LOG + '.csv', rows + 'VibrationPattern;3.0;1\n')
+        self.assertEqual(self.aggregate('VibrationPattern'), [2.0, 3.0])
+        self.assertEqual(self.aggregate('VibrationPattern_3'), [1.0])
+        # A full run gives the same rows
+        data = aggregate_data.process_folder(self.folder)
+        self.assertEqual(list(data['casu_001']['t_VibrationPattern']), [1.0, 2.0, 3.0])
+
+    def test_segment_compressed_after_aggregation(self):
+        path = self.write(LOG + '.0000.csv', csv_rows(1000, 5) + 'temp;1005;2')
+        self.assertEqual(self.aggregate(), range(1000, 1005))
+        # The logger finished the segment, compressed it and started the next one
+        os.remove(path)
+        self.write(LOG + '.0000.csv.gz', csv_rows(1000, 10))
+        self.write(LOG + '.0001.csv', csv_rows(1010, 5))
+        self.assertEqual(self.aggregate(), range(1000, 1015))
+        self.assertEqual(self.aggregate(), range(1000, 1015))
+
+    def test_stale_plain_segment(self):
+        self.write(LOG + '.0000.csv', csv_rows(1000, 5))
+        self.assertEqual(self.aggregate(), range(1000, 1005))
+        # The compressed segment was collected next to the plain one
+        self.write(LOG + '.0000.csv.gz', csv_rows(1000, 10))
+        self.assertEqual(self.aggregate(), range(1000, 1010))
+
+    def test_binary_segment_compressed_after_aggregation(self):
+        content = bin_rows(1000, 10)
+        path = self.write(LOG + '.0000.bin', content[:-10])
+        self.assertEqual(self.aggregate(), range(1000, 1009))
+        os.remove(path)
+        self.write(LOG + '.0000.bin.gz', content)
+        self.assertEqual(self.aggregate(), range(1000, 1010))
+
+    def test_version_1_manifest(self):
+        path = self.write(LOG + '.0000.csv', csv_rows(1000, 5))
+        self.aggregate()
+        outpath = self.outname + aggregate_data.ColumnWriter.extension
+        manifest = aggregate_data.load_manifest(outpath)
+        state = manifest['casu_001/2016-01-01-00-00-00.0000']
+        del state['compressed']
+        with open(aggregate_data.manifest_path(outpath), 'w') as manifest_file:
+            json.dump({'version': 1, 'files': {os.path.basename(path): state}}, manifest_file)
+        os.remove(path)
+        self.write(LOG + '.0000.csv.gz', csv_rows(1000, 10))
+        self.assertEqual(self.aggregate(), range(1000, 1010))
+
+if __name__ == '__main__':
+    unittest.main()
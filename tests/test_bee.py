@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the bee and bee swarm interfaces.
+"""
+
+import threading
+import time
+import unittest
+
+import numpy as np
+import zmq
+
+from assisipy import bee
+from assisipy import comm
+from assisipy.msg import dev_msgs_pb2
+
+from helpers import free_address
+
+class Simulator(threading.Thread):
+    """
+    Publishes the object sensor readings of some bees, until stopped,
+    and receives the commands sent to them.
+
+    :param dict ranges: Bee name -> list of object sensor ranges.
+    """
+
+    def __init__(self, context, ranges, max_range = 2.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pub_addr = free_address()
+        self.sub_addr = free_address()
+        self.frames = {}
+        for (name, bee_ranges) in ranges.items():
+            msg = dev_msgs_pb2.ObjectArray()
+            msg.range.extend(bee_ranges)
+            msg.type.extend(['Bee'] * len(bee_ranges))
+            msg.max_range = max_range
+            self.frames[name] = msg.SerializeToString()
+        # The bees publish on the simulator data address, and vice versa
+        self.data = context.socket(zmq.PUB)
+        self.data.bind(self.sub_addr)
+        self.commands = context.socket(zmq.SUB)
+        self.commands.bind(self.pub_addr)
+        self.commands.setsockopt(zmq.SUBSCRIBE, '')
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for (name, data) in self.frames.items():
+                self.data.send_multipart([name, 'Object', 'Ranges', data])
+            time.sleep(0.02)
+        self.data.close(0)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.commands.close(0)
+
+class TestBee(unittest.TestCase):
+
+    def test_connection_timeout(self):
+        threads = threading.active_count()
+        # Nothing publishes the bee data
+        self.assertRaises(comm.ConnectionTimeout, bee.Bee, name = 'Bee-001',
+                          pub_addr = free_address(), sub_addr = free_address(),
+                          timeout = 0.2)
+        # The receive thread has stopped
+        self.assertEqual(threading.active_count(), threads)
+
+class TestBeeSwarm(unittest.TestCase):
+
+    def setUp(self):
+        self.context = zmq.Context(1)
+        # Bee-1 is a prefix of Bee-10; sensors detecting nothing report 0.0
+        # (the ranges are single precision floats)
+        self.names = ['Bee-2', 'Bee-10', 'Bee-1']
+        self.simulator = Simulator(self.context, {'Bee-1': [0.25, 0.5, 0.75, 1.0, 1.25],
+                                                  'Bee-10': [1.5, 0.0, 1.75, 1.5, 1.25],
+                                                  'Bee-2': [0.0] * 5})
+        self.simulator.start()
+        self.swarm = bee.BeeSwarm(self.names, pub_addr = self.simulator.pub_addr,
+                                  sub_addr = self.simulator.sub_addr, timeout = 5.0)
+
+    def tearDown(self):
+        self.swarm.stop()
+        self.simulator.stop()
+        self.context.term()
+
+    def test_get_ranges(self):
+        ranges = self.swarm.get_ranges()
+        # One row per bee, in the order of the names
+        self.assertEqual(ranges.shape, (3, bee.N_OBJECT_SENSORS))
+        self.assertEqual(self.swarm.names(), self.names)
+        self.assertEqual(ranges[self.swarm.index('Bee-1')].tolist(), [0.25, 0.5, 0.75, 1.0, 1.25])
+        self.assertEqual(ranges[1].tolist(), [1.5, 2.0, 1.75, 1.5, 1.25])
+        self.assertEqual(ranges[0].tolist(), [2.0] * 5)
+        self.assertEqual(self.swarm.get_objects().shape, (3, bee.N_OBJECT_SENSORS))
+
+    def received_vels(self, vel_left, vel_right):
+        """
+        Returns the velocities received by the simulator, by bee name.
+        """
+        vels = {}
+        deadline = time.time() + 5.0
+        # Commands sent before the subscription is in place are lost
+        while len(vels) < len(self.names) and time.time() < deadline:
+            self.swarm.set_vels(vel_left, vel_right)
+            while self.simulator.commands.poll(50):
+                [name, dev, cmd, data] = self.simulator.commands.recv_multipart()
+                self.assertEqual((dev, cmd), ('Base', 'Vel'))
+                msg = dev_msgs_pb2.DiffDrive()
+                msg.ParseFromString(data)
+                vels[name] = (msg.vel_left, msg.vel_right)
+        return vels
+
+    def test_set_vels(self):
+        # One velocity per bee, in the order of the names, or one for all
+        self.assertEqual(self.received_vels(np.array([1.0, 2.0, 3.0]), 0.5),
+                         {'Bee-2': (1.0, 0.5), 'Bee-10': (2.0, 0.5), 'Bee-1': (3.0, 0.5)})
+        self.assertRaises(ValueError, self.swarm.set_vels, [1.0, 2.0], 0.5)
+
+    def test_connection_timeout(self):
+        threads = threading.active_count()
+        self.assertRaises(comm.ConnectionTimeout, bee.BeeSwarm, ['Bee-001', 'Bee-002'],
+                          pub_addr = free_address(), sub_addr = free_address(),
+                          timeout = 0.2)
+        self.assertEqual(threading.active_count(), threads)
+
+if __name__ == '__main__':
+    unittest.main()
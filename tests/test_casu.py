@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the Casu and CasuGroup interfaces.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import yaml
+import zmq
+
+from assisipy import casu
+from assisipy import comm
+from assisipy.msg import dev_msgs_pb2
+
+from helpers import free_address
+
+def message(sender, data):
+    return {'sender': sender, 'data': data}
+
+def temperatures(temps):
+    msg = dev_msgs_pb2.TemperatureArray()
+    msg.temp.extend(temps)
+    return msg.SerializeToString()
+
+def write_rtc(folder, name, sub_addr):
+    """
+    Write the RTC file of a Casu without neighbors, and return its name.
+    """
+    rtc = {'name': name, 'pub_addr': free_address(), 'sub_addr': sub_addr,
+           'msg_addr': free_address(), 'neighbors': {}}
+    rtc_file_name = os.path.join(folder, name + '.rtc')
+    with open(rtc_file_name, 'w') as rtc_file:
+        yaml.dump(rtc, rtc_file)
+    return rtc_file_name
+
+class CasuData(threading.Thread):
+    """
+    Publishes the sensor frames of some Casus, round after round, until stopped.
+
+    :param frames: A function returning the list of [name, dev, cmd, data]
+                   frames of round k = 1, 2, ...
+    """
+
+    def __init__(self, context, frames):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.address = free_address()
+        self.frames = frames
+        self.socket = context.socket(zmq.PUB)
+        self.socket.bind(self.address)
+        self.stopped = threading.Event()
+
+    def run(self):
+        k = 0
+        while not self.stopped.is_set():
+            k += 1
+            for frame in self.frames(k):
+                self.socket.send_multipart(frame)
+            time.sleep(0.01)
+
+    def stop(self):
+        self.stopped.set()
+        if self.ident is not None:
+            self.join()
+        self.socket.close(0)
+
+class TestMessageQueue(unittest.TestCase):
+
+    def fill(self, queue, n, senders = ['a']):
+        for i in range(n):
+            queue.put(message(senders[i % len(senders)], str(i)))
+
+    def data(self, msgs):
+        return [m['data'] for m in msgs]
+
+    def test_fifo(self):
+        queue = casu.MessageQueue(order = casu.MSG_FIFO)
+        self.fill(queue, 3)
+        self.assertEqual(queue.get()['data'], '0')
+        self.assertEqual(self.data(queue.get_many()), ['1', '2'])
+        self.assertEqual(queue.get(), None)
+
+    def test_lifo(self):
+        queue = casu.MessageQueue(order = casu.MSG_LIFO)
+        self.fill(queue, 3)
+        self.assertEqual(self.data(queue.get_many(2)), ['2', '1'])
+        self.assertEqual(len(queue), 1)
+
+    def test_latest(self):
+        queue = casu.MessageQueue(order = casu.MSG_LATEST)
+        self.fill(queue, 5, ['a', 'b'])
+        # a sent 0, 2, 4 and b sent 1, 3; b's latest is the older one
+        self.assertEqual(self.data(queue.get_many()), ['3', '4'])
+        self.assertEqual(queue.replaced, 3)
+        self.assertEqual(queue.dropped, 0)
+
+    def test_drop_oldest(self):
+        for order in [casu.MSG_FIFO, casu.MSG_LIFO]:
+            queue = casu.MessageQueue(maxlen = 3, order = order)
+            self.fill(queue, 5)
+            self.assertEqual(len(queue), 3)
+            self.assertEqual(queue.dropped, 2)
+            self.assertEqual(sorted(self.data(queue.get_many())), ['2', '3', '4'])
+
+    def test_latest_drop_oldest_sender(self):
+        queue = casu.MessageQueue(maxlen = 2, order = casu.MSG_LATEST)
+        self.fill(queue, 3, ['a', 'b', 'c'])
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual([m['sender'] for m in queue.get_many()], ['b', 'c'])
+
+    def test_unbounded(self):
+        queue = casu.MessageQueue(maxlen = None, order = casu.MSG_FIFO)
+        self.fill(queue, 2000)
+        self.assertEqual(len(queue), 2000)
+        self.assertEqual(queue.dropped, 0)
+
+    def test_unknown_order(self):
+        self.assertRaises(ValueError, casu.MessageQueue, order = 'random')
+
+class TestMessages(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.context = zmq.Context(1)
+        # The neighbor the Casu receives messages from
+        self.neighbor = self.context.socket(zmq.PUB)
+        port = self.neighbor.bind_to_random_port('tcp://127.0.0.1')
+        rtc = {'name': 'casu-001',
+               'pub_addr': 'tcp://127.0.0.1:5556',
+               'sub_addr': 'tcp://127.0.0.1:5555',
+               'msg_addr': free_address(),
+               'neighbors': {'left': {'name': 'casu-002',
+                                      'address': 'tcp://127.0.0.1:{0}'.format(port)}}}
+        self.rtc = rtc
+        self.msg_addr = rtc['msg_addr']
+        self.rtc_file_name = os.path.join(self.folder, 'casu-001.rtc')
+        with open(self.rtc_file_name, 'w') as rtc_file:
+            yaml.dump(rtc, rtc_file)
+        self.casu = casu.Casu(self.rtc_file_name, wait = False, msg_order = casu.MSG_FIFO)
+
+    def tearDown(self):
+        self.casu.stop()
+        self.neighbor.close(0)
+        self.context.term()
+        shutil.rmtree(self.folder)
+
+    def send(self, *frames):
+        self.neighbor.send_multipart(['casu-001', 'Message', 'casu-002'] + list(frames))
+
+    def receive(self, n):
+        msgs = []
+        deadline = time.time() + 5.0
+        while len(msgs) < n and time.time() < deadline:
+            msgs.extend(self.casu.read_messages())
+            time.sleep(0.01)
+        return msgs
+
+    def connect(self):
+        # Messages sent before the subscription is in place are lost
+        deadline = time.time() + 5.0
+        while not self.casu.read_messages() and time.time() < deadline:
+            self.send('hello')
+            time.sleep(0.05)
+        time.sleep(0.1)
+        self.casu.read_messages()
+
+    def test_message_formats(self):
+        self.connect()
+        received = self.casu.get_message_stats()['received']
+        # Without and with the send time, and with an invalid one
+        self.send('old')
+        self.send('new', repr(time.time()))
+        self.send('bad', 'not a time')
+        msgs = self.receive(3)
+        self.assertEqual([m['data'] for m in msgs], ['old', 'new', 'bad'])
+        self.assertEqual([m['label'] for m in msgs], ['left'] * 3)
+        stats = self.casu.get_message_stats()
+        self.assertEqual(stats['received'] - received, 3)
+        self.assertTrue(stats['latency_max'] >= 0.0)
+
+    def sent_frames(self):
+        """
+        Returns the frames of a message sent by the Casu to its neighbor.
+        """
+        neighbor = self.context.socket(zmq.SUB)
+        neighbor.connect(self.msg_addr)
+        neighbor.setsockopt(zmq.SUBSCRIBE, 'casu-002')
+        try:
+            # Messages sent before the subscription is in place are lost
+            for i in range(100):
+                self.casu.send_message('left', 'hi')
+                if neighbor.poll(50):
+                    return neighbor.recv_multipart()
+        finally:
+            neighbor.close(0)
+
+    def test_send_message(self):
+        # Neighbors with an older assisipy only accept 4 frames
+        self.assertEqual(self.sent_frames(), ['casu-002', 'Message', 'casu-001', 'hi'])
+        self.casu.stop()
+        # The stopped Casu keeps its message address bound
+        self.rtc['msg_addr'] = self.msg_addr = free_address()
+        with open(self.rtc_file_name, 'w') as rtc_file:
+            yaml.dump(self.rtc, rtc_file)
+        self.casu = casu.Casu(self.rtc_file_name, wait = False, msg_timestamps = True)
+        frames = self.sent_frames()
+        self.assertEqual(frames[:4], ['casu-002', 'Message', 'casu-001', 'hi'])
+        self.assertTrue(abs(float(frames[4]) - time.time()) < 5.0)
+
+    def test_malformed_message(self):
+        self.connect()
+        self.neighbor.send_multipart(['casu-001', 'Message'])
+        self.send('after')
+        msgs = self.receive(1)
+        self.assertEqual([m['data'] for m in msgs], ['after'])
+
+class TestConnectionTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.context = zmq.Context(1)
+        # Nothing publishes the Casu data
+        self.msg_addr = free_address()
+        rtc = {'name': 'casu-001',
+               'pub_addr': free_address(),
+               'sub_addr': free_address(),
+               'msg_addr': self.msg_addr,
+               'neighbors': {'left': {'name': 'casu-002',
+                                      'address': free_address()}}}
+        self.rtc_file_name = os.path.join(self.folder, 'casu-001.rtc')
+        with open(self.rtc_file_name, 'w') as rtc_file:
+            yaml.dump(rtc, rtc_file)
+        self.threads = threading.active_count()
+
+    def tearDown(self):
+        self.context.term()
+        shutil.rmtree(self.folder)
+
+    def assertReleased(self):
+        self.assertEqual(threading.active_count(), self.threads)
+        # The message address can be bound again
+        socket = self.context.socket(zmq.PUB)
+        socket.bind(self.msg_addr)
+        socket.close(0)
+
+    def test_casu(self):
+        self.assertRaises(comm.ConnectionTimeout, casu.Casu, self.rtc_file_name,
+                          timeout = 0.2, log = True, log_folder = self.folder)
+        self.assertReleased()
+
+    def test_group(self):
+        self.assertRaises(comm.ConnectionTimeout, casu.CasuGroup, [self.rtc_file_name],
+                          timeout = 0.2, log = True, log_folder = self.folder)
+        self.assertReleased()
+
+def sensor_frames(name, k):
+    """
+    Returns the IR, Temp and Fft frames of round k, all values of which are k.
+    """
+    ir = dev_msgs_pb2.RangeArray()
+    ir.range.extend([k] * 6)
+    ir.raw_value.extend([k] * 6)
+    fft = dev_msgs_pb2.VibrationReadingArray()
+    reading = fft.reading.add()
+    reading.freq.extend([k] * 4)
+    reading.amplitude.extend([k] * 4)
+    return [[name, 'IR', 'Ranges', ir.SerializeToString()],
+            [name, 'Temp', 'Temperatures', temperatures([k] * 8)],
+            [name, 'Fft', 'Measurements', fft.SerializeToString()]]
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.context = zmq.Context(1)
+        self.data = CasuData(self.context, lambda k: sensor_frames('casu-001', k))
+        self.casu = casu.Casu(write_rtc(self.folder, 'casu-001', self.data.address), wait = False)
+
+    def tearDown(self):
+        self.casu.stop()
+        self.data.stop()
+        self.context.term()
+        shutil.rmtree(self.folder)
+
+    def test_empty(self):
+        snapshot = self.casu.snapshot()
+        self.assertEqual((snapshot.ir_range, snapshot.temp, snapshot.fft_amp), ((), (), ()))
+        self.assertEqual((snapshot.ir_seq, snapshot.temp_seq, snapshot.fft_seq), (0, 0, 0))
+
+    def test_consistent(self):
+        self.data.start()
+        self.casu.wait_connected(5.0)
+        last = self.casu.snapshot()
+        for i in range(200):
+            if i % 10 == 0:
+                self.casu.wait_for_update(None, 1.0)
+            snapshot = self.casu.snapshot()
+            # The readings of each device come from one and the same frame
+            for readings in [snapshot.ir_range + snapshot.ir_raw, snapshot.temp,
+                             snapshot.fft_freq + snapshot.fft_amp]:
+                self.assertEqual(len(set(readings)), 1 if readings else 0)
+            self.assertEqual(len(snapshot.ir_range), len(snapshot.ir_raw))
+            self.assertEqual(len(snapshot.fft_freq), len(snapshot.fft_amp))
+            # Frames are counted and timed as they come
+            for dev in ['ir', 'temp', 'fft']:
+                self.assertTrue(getattr(snapshot, dev + '_seq') >= getattr(last, dev + '_seq'))
+                self.assertTrue(getattr(snapshot, dev + '_time') >= getattr(last, dev + '_time'))
+            last = snapshot
+        # The getters read the same readings
+        self.data.stop()
+        time.sleep(0.1)
+        snapshot = self.casu.snapshot()
+        self.assertEqual(self.casu.get_temp(casu.ARRAY), list(snapshot.temp))
+        self.assertEqual(snapshot.temp_seq, self.casu.snapshot().temp_seq)
+        self.assertTrue(snapshot.temp_seq > 1)
+
+class TestCasuGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.context = zmq.Context(1)
+
+    def tearDown(self):
+        self.context.term()
+        shutil.rmtree(self.folder)
+
+    def test_empty_group(self):
+        self.assertRaises(ValueError, casu.CasuGroup)
+
+    def test_members(self):
+        # casu-1 is a prefix of casu-10, so its subscription gets the data of both
+        data = CasuData(self.context, lambda k: [
+            ['casu-1', 'Temp', 'Temperatures', temperatures([1.0] * 8)],
+            ['casu-10', 'Temp', 'Temperatures', temperatures([10.0] * 8)]])
+        data.start()
+        try:
+            group = casu.CasuGroup([write_rtc(self.folder, name, data.address)
+                                    for name in ['casu-1', 'casu-10']], timeout = 5.0)
+            try:
+                self.assertEqual(group.names(), ['casu-1', 'casu-10'])
+                # Each member has its own readings only
+                for i in range(20):
+                    group['casu-1'].wait_for_update('Temp', 1.0)
+                    self.assertEqual(group['casu-1'].get_temp(casu.ARRAY), [1.0] * 8)
+                    self.assertEqual(group['casu-10'].get_temp(casu.TEMP_WAX), 10.0)
+            finally:
+                group.stop()
+        finally:
+            data.stop()
+
+if __name__ == '__main__':
+    unittest.main()
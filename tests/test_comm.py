@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the frame dispatch table and the synchronized start.
+"""
+
+import os
+import threading
+import unittest
+
+import zmq
+
+from assisipy import comm
+from assisipy.msg import dev_msgs_pb2
+
+from helpers import free_port_pair
+
+def temperatures(*temps):
+    msg = dev_msgs_pb2.TemperatureArray()
+    msg.temp.extend(temps)
+    return msg.SerializeToString()
+
+class TestMessageTable(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = []
+        self.buffer = dev_msgs_pb2.TemperatureArray()
+        self.setpoint = dev_msgs_pb2.Temperature()
+        self.table = comm.MessageTable(threading.Lock(), 'casu-001', self.rows.append)
+        self.table.add('Temp', 'Temperatures', self.buffer,
+                       rows = lambda t, m: [['temp', t] + list(m.temp)])
+        self.table.add('Peltier', 'On', self.setpoint, True)
+        self.table.add('Peltier', 'Off', self.setpoint, False)
+        self.table.ignore('Acc')
+
+    def test_dispatch(self):
+        self.assertTrue(self.table.dispatch('Temp', 'Temperatures', temperatures(25.0, 26.0)))
+        self.assertEqual(list(self.buffer.temp), [25.0, 26.0])
+        self.assertEqual(len(self.rows), 1)
+        self.assertEqual(self.rows[0][0], 'temp')
+        self.assertEqual(self.rows[0][2:], [25.0, 26.0])
+        self.assertEqual(self.table.count('Temp'), 1)
+        self.assertEqual(self.table.count(), 1)
+
+    def test_on_off(self):
+        self.assertFalse(self.table.is_on('Peltier'))
+        self.table.dispatch('Peltier', 'On', dev_msgs_pb2.Temperature(temp = 30).SerializeToString())
+        self.assertTrue(self.table.is_on('Peltier'))
+        self.assertEqual(self.setpoint.temp, 30)
+        self.table.dispatch('Peltier', 'Off', '')
+        self.assertFalse(self.table.is_on('Peltier'))
+
+    def test_unknown_frames(self):
+        for (dev, cmd) in [('Temp', 'Unknown'), ('Unknown', 'Temperatures'), ('Acc', 'Measurements')]:
+            self.assertFalse(self.table.dispatch(dev, cmd, ''))
+        self.assertEqual(self.table.count(), 0)
+
+    def test_callbacks(self):
+        updated = []
+        self.table.add_callback('Temp', updated.append)
+        self.table.add_callback(None, lambda dev: updated.append('any ' + dev))
+        # A failing callback does not stop the others
+        self.table.add_callback('Temp', lambda dev: 1/0)
+        self.table.dispatch('Temp', 'Temperatures', temperatures(25.0))
+        self.table.dispatch('Peltier', 'Off', '')
+        self.assertEqual(updated, ['Temp', 'any Temp', 'any Peltier'])
+
+    def test_wait(self):
+        self.assertFalse(self.table.wait('Temp', 0.05))
+        timer = threading.Timer(0.1, self.table.dispatch,
+                                ['Temp', 'Temperatures', temperatures(25.0)])
+        timer.start()
+        self.assertTrue(self.table.wait('Temp', 5.0))
+        timer.join()
+
+class Controller(threading.Thread):
+    """
+    A controller waiting for the start signal.
+    """
+
+    def __init__(self, name, timeout = None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = name
+        self.timeout = timeout
+        self.result = None
+
+    def run(self):
+        context = zmq.Context(1)
+        try:
+            self.result = comm.wait_for_start(context, self.name, self.timeout)
+        except comm.ConnectionTimeout as e:
+            self.result = e
+        context.term()
+
+class TestStartBarrier(unittest.TestCase):
+
+    def setUp(self):
+        comm._started = False
+        self.address = 'tcp://127.0.0.1:{0}'.format(free_port_pair())
+        os.environ[comm.START_ADDR_ENV] = self.address
+        self.barrier = comm.StartBarrier(self.address)
+
+    def tearDown(self):
+        self.barrier.close()
+        del os.environ[comm.START_ADDR_ENV]
+        comm._started = False
+
+    def start(self, *names):
+        controllers = [Controller(name) for name in names]
+        for controller in controllers:
+            controller.start()
+        return controllers
+
+    def test_release(self):
+        controllers = self.start('a', 'b')
+        starts = self.barrier.release(['a', 'b'], ready_timeout = 10.0)
+        self.assertEqual(sorted(starts), ['a', 'b'])
+        for controller in controllers:
+            controller.join(5.0)
+            self.assertEqual(controller.result, True)
+
+    def test_release_late(self):
+        controllers = self.start('a')
+        starts = self.barrier.release(['a', 'b'], ready_timeout = 0.5)
+        self.assertEqual(sorted(starts), ['a'])
+        releaser = threading.Thread(target = self.barrier.release_late)
+        releaser.start()
+        try:
+            # Each controller is a process of its own
+            comm._started = False
+            late = Controller('b', timeout = 10.0)
+            late.start()
+            late.join(10.0)
+            self.assertEqual(late.result, True)
+        finally:
+            self.barrier.stop()
+            releaser.join()
+
+    def test_stop(self):
+        releaser = threading.Thread(target = self.barrier.release,
+                                    args = (['a'],), kwargs = {'ready_timeout': 60.0})
+        releaser.start()
+        self.barrier.stop()
+        releaser.join(5.0)
+        self.assertFalse(releaser.is_alive())
+
+    def test_start_timeout(self):
+        controller = Controller('a', timeout = 0.5)
+        controller.start()
+        controller.join(5.0)
+        self.assertTrue(isinstance(controller.result, comm.ConnectionTimeout))
+
+    def test_start_timeout_env(self):
+        os.environ[comm.START_TIMEOUT_ENV] = '0.5'
+        try:
+            controller = Controller('a')
+            controller.start()
+            controller.join(5.0)
+        finally:
+            del os.environ[comm.START_TIMEOUT_ENV]
+        self.assertTrue(isinstance(controller.result, comm.ConnectionTimeout))
+
+class TestNoBarrier(unittest.TestCase):
+
+    def test_not_synchronized(self):
+        context = zmq.Context(1)
+        self.assertFalse(comm.wait_for_start(context, 'a'))
+        context.term()
+
+if __name__ == '__main__':
+    unittest.main()
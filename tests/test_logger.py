@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the asynchronous logfile writer.
+"""
+
+import os
+import glob
+import gzip
+import shutil
+import tempfile
+import time
+import unittest
+
+from assisipy import logger
+
+class TestLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, '2016-01-01-00-00-00-casu-001.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def segments(self, pattern = '*.csv'):
+        return sorted(glob.glob(os.path.join(self.folder, pattern)))
+
+    def lines(self, paths):
+        lines = []
+        for path in paths:
+            with self.open(path) as logfile:
+                lines.extend(logfile.read().splitlines())
+        return lines
+
+    def open(self, path):
+        if path.endswith('.gz'):
+            return gzip.open(path)
+        return open(path)
+
+    def rows(self, n):
+        return [['temp', 1000.0 + i, 20.0, 21.0] for i in range(n)]
+
+    def test_unsegmented(self):
+        log = logger.LogWriter(self.path, flush_interval = 0.01)
+        for row in self.rows(10):
+            log.write(row)
+        log.close()
+        self.assertEqual(self.segments(), [self.path])
+        self.assertEqual(len(self.lines([self.path])), 10)
+        self.assertEqual(log.stats()['written'], 10)
+
+    def test_rotate_size(self):
+        # All the rows are written in one batch
+        log = logger.LogWriter(self.path, flush_interval = 10.0, rotate_size = 200)
+        for row in self.rows(100):
+            log.write(row)
+        log.close()
+        segments = self.segments()
+        self.assertTrue(len(segments) > 1)
+        row_size = max([len(line) + 2 for line in self.lines(segments)])
+        for path in segments:
+            self.assertTrue(os.path.getsize(path) < 200 + row_size)
+        # All the rows, in order
+        times = [float(line.split(';')[1]) for line in self.lines(segments)]
+        self.assertEqual(times, [1000.0 + i for i in range(100)])
+
+    def test_rotate_interval_skips_empty_segments(self):
+        log = logger.LogWriter(self.path, flush_interval = 0.02, rotate_interval = 0.1)
+        log.write(self.rows(1)[0])
+        time.sleep(0.5)
+        log.write(self.rows(2)[1])
+        log.close()
+        segments = self.segments()
+        self.assertEqual([os.path.basename(path) for path in segments],
+                         ['2016-01-01-00-00-00-casu-001.0000.csv',
+                          '2016-01-01-00-00-00-casu-001.0001.csv'])
+        self.assertEqual([len(self.lines([path])) for path in segments], [1, 1])
+
+    def test_compress_keep(self):
+        log = logger.LogWriter(self.path, flush_interval = 10.0, rotate_size = 200,
+                               compress = True, keep = 2)
+        for row in self.rows(100):
+            log.write(row)
+        log.close()
+        self.assertEqual(self.segments(), [])
+        segments = self.segments('*.csv.gz')
+        self.assertEqual(len(segments), 2)
+        times = [float(line.split(';')[1]) for line in self.lines(segments)]
+        self.assertEqual(times[-1], 1099.0)
+        self.assertEqual(times, sorted(times))
+
+    def test_binary_segments(self):
+        path = self.path[:-4] + '.bin'
+        log = logger.LogWriter(path, logger.LOG_BIN, flush_interval = 10.0, rotate_size = 200)
+        for row in self.rows(20):
+            log.write(row)
+        log.close()
+        segments = self.segments('*.bin')
+        self.assertTrue(len(segments) > 1)
+        for segment in segments:
+            with open(segment, 'rb') as logfile:
+                self.assertTrue(logfile.read().startswith(logger.BIN_MAGIC))
+
+if __name__ == '__main__':
+    unittest.main()
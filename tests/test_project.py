@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the project model and its cache.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+try:
+    import pygraphviz as pgv
+except ImportError:
+    pgv = None
+
+from assisipy import project
+from assisipy.neighborhood import NeighborhoodIndex
+
+ARENA = {'layer1': {'casu-001': {'pub_addr': 'tcp://127.0.0.1:5556',
+                                 'sub_addr': 'tcp://127.0.0.1:5555',
+                                 'msg_addr': 'tcp://127.0.0.1:10101'}}}
+
+DEP = {'layer1': {'casu-001': {'hostname': 'localhost', 'user': 'assisi',
+                               'prefix': 'deploy', 'controller': 'ctrl.py',
+                               'args': ['--gain', '2']}}}
+
+# Two layers, with unprefixed node names in layer1, layer prefixed
+# names in layer2, edges between the layers, and an isolated CASU
+NBG_ARENA = {'layer1': {'casu-001': {'msg_addr': 'tcp://127.0.0.1:10101'},
+                        'casu-002': {'msg_addr': 'tcp://127.0.0.1:10102'},
+                        'casu-003': {'msg_addr': 'tcp://127.0.0.1:10103'}},
+             'layer2': {'casu-101': {'msg_addr': 'tcp://127.0.0.1:10201'},
+                        'casu-102': {'msg_addr': 'tcp://127.0.0.1:10202'}}}
+
+NBG = """digraph G {
+    subgraph layer1 {
+        "casu-001" -> "casu-002" [label = "east"];
+        "casu-002" -> "casu-001" [label = "west"];
+        "casu-002" -> "layer2/casu-101" [label = "up"];
+    }
+    subgraph layer2 {
+        "layer2/casu-101" -> "layer2/casu-102" [label = "east"];
+        "layer2/casu-102" -> "layer2/casu-101" [label = "west"];
+        "layer2/casu-101" -> "layer1/casu-002" [label = "down"];
+    }
+}
+"""
+
+def graph_neighbors(nbg, arena, layer, casu):
+    """
+    The neighbors of a CASU, found by walking the graph
+    (as the deployment tools did before the neighborhood index).
+    """
+    neighbors = {}
+    sg = nbg.get_subgraph(layer)
+    out_neighbors = []
+    name_prefix = ''
+    if sg is not None:
+        if sg.has_node(casu):
+            out_neighbors = sg.out_neighbors(casu)
+        elif sg.has_node(layer + '/' + casu):
+            name_prefix = layer + '/'
+            out_neighbors = sg.out_neighbors(name_prefix + casu)
+    for nb in out_neighbors:
+        side = str(nbg.get_edge(name_prefix + casu, nb).attr['label'])
+        nb_full_name = str(nb).split('/')
+        nb_name = nb_full_name[-1]
+        nb_layer = layer
+        if len(nb_full_name) > 1:
+            nb_layer = nb_full_name[0]
+        neighbors[side] = {'name': nb_name,
+                           'address': arena[nb_layer][nb_name]['msg_addr']}
+    return neighbors
+
+class TestProject(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.project_file_name = os.path.join(self.folder, 'test.assisi')
+        self.write('test.assisi', {'arena': 'test.arena', 'dep': 'test.dep'})
+        self.write('test.arena', ARENA)
+        self.write('test.dep', DEP)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name, data):
+        with open(os.path.join(self.folder, name), 'w') as spec_file:
+            yaml.dump(data, spec_file)
+
+    def test_cached_model(self):
+        parsed = project.Project(self.project_file_name)
+        with open(parsed.cache_file_name) as cache_file:
+            self.assertEqual(json.load(cache_file)['version'], project.CACHE_VERSION)
+        cached = project.Project(self.project_file_name)
+        self.assertEqual(cached.arena, ARENA)
+        self.assertEqual(cached.dep, DEP)
+        # Strings are str, as parsed from YAML
+        self.assertEqual(type(cached.dep['layer1']['casu-001']['user']), str)
+        self.assertEqual(type(cached.dep.keys()[0]), str)
+
+    def test_changed_files(self):
+        project.Project(self.project_file_name)
+        dep = {'layer1': dict(DEP['layer1'])}
+        dep['layer1']['casu-001'] = dict(dep['layer1']['casu-001'], user='other')
+        self.write('test.dep', dep)
+        self.assertEqual(project.Project(self.project_file_name).dep, dep)
+
+    def test_invalid_cache(self):
+        cache_file_name = project.Project(self.project_file_name).cache_file_name
+        for content in ['not json', '[]', '{"version": 1}']:
+            with open(cache_file_name, 'w') as cache_file:
+                cache_file.write(content)
+            self.assertEqual(project.Project(self.project_file_name).dep, DEP)
+
+    def test_not_representable(self):
+        # JSON object keys are strings, so the model is not cached
+        arena = {'layer1': {1: ARENA['layer1']['casu-001']}}
+        self.write('test.arena', arena)
+        self.write('test.dep', {})
+        parsed = project.Project(self.project_file_name)
+        self.assertFalse(os.path.exists(parsed.cache_file_name))
+        self.assertEqual(parsed.arena, arena)
+
+    def test_inconsistent(self):
+        self.write('test.arena', {'layer1': {}})
+        self.assertRaises(ValueError, project.Project, self.project_file_name)
+
+    @unittest.skipIf(pgv is None, 'requires pygraphviz')
+    def test_neighborhood(self):
+        self.write('test.assisi', {'arena': 'test.arena', 'dep': 'test.dep',
+                                   'nbg': 'test.nbg'})
+        self.write('test.arena', NBG_ARENA)
+        nbg_file_name = os.path.join(self.folder, 'test.nbg')
+        with open(nbg_file_name, 'w') as nbg_file:
+            nbg_file.write(NBG)
+        graph = pgv.AGraph(nbg_file_name)
+        index = NeighborhoodIndex.from_file(nbg_file_name, NBG_ARENA)
+        parsed = project.Project(self.project_file_name)
+        cached = project.Project(self.project_file_name)
+        for layer in NBG_ARENA:
+            for casu in NBG_ARENA[layer]:
+                expected = graph_neighbors(graph, NBG_ARENA, layer, casu)
+                self.assertEqual(index.neighbors(layer, casu), expected)
+                self.assertEqual(parsed.nbg.neighbors(layer, casu), expected)
+                self.assertEqual(cached.nbg.neighbors(layer, casu), expected)
+        self.assertEqual(index.neighbors('layer1', 'casu-002')['up'],
+                         {'name': 'casu-101', 'address': 'tcp://127.0.0.1:10201'})
+        self.assertEqual(index.neighbors('layer1', 'casu-003'), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the simulator control and physical object interfaces.
+"""
+
+import threading
+import unittest
+
+from assisipy import comm
+from assisipy import physical
+from assisipy import sim
+
+from helpers import free_address
+
+class TestConnectionTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.threads = threading.active_count()
+
+    def test_control(self):
+        # Nothing publishes the simulator data
+        self.assertRaises(comm.ConnectionTimeout, sim.Control,
+                          pub_addr = free_address(), sub_addr = free_address(),
+                          timeout = 0.2)
+        # The receive thread has stopped
+        self.assertEqual(threading.active_count(), self.threads)
+
+    def test_object(self):
+        # The object name is not published by anybody
+        self.assertRaises(comm.ConnectionTimeout, physical.Object,
+                          name = 'no-such-object', timeout = 0.2)
+        self.assertEqual(threading.active_count(), self.threads)
+
+if __name__ == '__main__':
+    unittest.main()